@@ -1,22 +1,65 @@
 # app/__init__.py
 
+import os
 from flask import Flask
 from .routes import main_bp
-from .models.phi2textgen import Phi2Generator
-from .models.sdxlImageGen import ImageGenerator
-from .models.contextRetrival import ContextRetriever
-from .models.TTS import HuggingFaceTTS
+from .models.modelRegistry import ModelRegistry
 from .database.db import DBInstance
 
-def create_app():
+# Loaders import lazily so a model's dependencies are only needed once it is used
+def _loadScriptGenModel():
+    from .models.phi2textgen import Phi2Generator
+    return Phi2Generator()
+
+def _loadImageGenModel(db=None):
+    from .models.sdxlImageGen import ImageGenerator
+    return ImageGenerator(db=db)
+
+def _loadContextModel(db=None):
+    from .models.contextRetrival import ContextRetriever
+    return ContextRetriever(db=db)
+
+def _loadTTSModel():
+    from .models.TTS import HuggingFaceTTS
+    return HuggingFaceTTS()
+    # return HuggingFaceTTS(model_name="tts_models/multilingual/multi-dataset/xtts_v2")
+
+def create_app(models=None, start_reaper=True):
+    """
+    models optionally maps a model name (e.g. 'ScriptGenModel') to a
+    zero-argument loader that replaces the default one, which lets the
+    benchmarks run the app with stub or tiny backends.
+
+    start_reaper=False leaves idle unloading to the caller; the preforking
+    server starts it in each worker so the master keeps the shared weights.
+    """
     app = Flask(__name__)
 
-    app.config['ScriptGenModel'] = Phi2Generator()
-    app.config['ImageGenModel'] = ImageGenerator()
-    app.config['contextModel'] = ContextRetriever()
-    app.config['TTSModel'] = HuggingFaceTTS()
-    # app.config['TTSModel'] = HuggingFaceTTS(model_name="tts_models/multilingual/multi-dataset/xtts_v2")
-    app.config['DB'] = DBInstance()
+    # The context model keeps its keyword index and the image model its image library in the app database
+    db = DBInstance()
+    app.config['DB'] = db
+
+    loaders = {
+        'ScriptGenModel': _loadScriptGenModel,
+        'ImageGenModel': lambda: _loadImageGenModel(db),
+        'contextModel': lambda: _loadContextModel(db),
+        'TTSModel': _loadTTSModel,
+    }
+    loaders.update(models or {})
+
+    # Models are loaded on demand and unloaded LRU-first to stay under MODEL_MEMORY_LIMIT_MB
+    registry = ModelRegistry()
+    for name, loader in loaders.items():
+        registry.register(name, loader)
+    app.config['ModelRegistry'] = registry
+
+    for name in registry.names():
+        app.config[name] = registry.proxy(name)
+
+    if os.getenv('MODEL_PRELOAD', '1') == '1':
+        registry.preload()
+    if start_reaper:
+        registry.start_idle_reaper()
 
     app.register_blueprint(main_bp)
     return app
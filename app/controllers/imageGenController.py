@@ -1,14 +1,45 @@
 from flask import current_app
+from app.utils.tracing import traced
 
-def genImagefn(prompts:list,height,width,num_inference_steps,guidance_scale)->list:
+@traced("controller.genImagefn")
+def genImagefn(prompts:list,height,width,num_inference_steps,guidance_scale,
+               image_format=None,quality=None,thumbnails=False,preview=False,seeds=None,
+               reuse=None,reuse_threshold=None):
     ImageGenModel = current_app.config['ImageGenModel']
-    # returns a list
+    # returns a list, or a dict of image and thumbnail lists
     images = ImageGenModel.generate_images(
                 prompts=prompts,
                 width=width,
                 height=height,
                 num_inference_steps=num_inference_steps,
-                guidance_scale=guidance_scale
+                guidance_scale=guidance_scale,
+                image_format=image_format,
+                quality=quality,
+                thumbnails=thumbnails,
+                preview=preview,
+                seeds=seeds,
+                reuse=reuse,
+                reuse_threshold=reuse_threshold
             )
     
+    return images
+
+@traced("controller.finalizeImagesfn")
+def finalizeImagesfn(prompts:list,seeds:list,height,width,num_inference_steps,guidance_scale,
+                     image_format=None,quality=None,thumbnails=False,reuse=None)->list:
+    ImageGenModel = current_app.config['ImageGenModel']
+    # full-resolution renders of the previews that were kept
+    images = ImageGenModel.finalize_images(
+                prompts=prompts,
+                seeds=seeds,
+                width=width,
+                height=height,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                image_format=image_format,
+                quality=quality,
+                thumbnails=thumbnails,
+                reuse=reuse
+            )
+
     return images
\ No newline at end of file
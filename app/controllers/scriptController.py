@@ -1,9 +1,11 @@
+import json
 from flask import current_app
 from app.controllers.vectorDBcontroller import retriveContext, retriveUserContextController
 from app.utils.cloudinaryDeleteFiles import delete_files_from_cloudinary
 from app.utils.subjectExtractor import extract_subject
 from app.utils.subjectReplacer import replace_pronouns_or_nouns
 from app.utils.uselessWords import useless_words
+from app.utils.tracing import traced
 
 # Simplified style guides
 STYLE_GUIDES = {
@@ -24,11 +26,14 @@ def clean_prompt(prompt: str) -> str:
 
     return prompt.strip()
 
-def genNewScript(body: dict,userDocURL) -> dict:
+def clean_script_text(text: str) -> str:
+    """Removes newlines and code characters from a generated script."""
+    return text.replace('\n', ' ').replace('{', '').replace('}', '').replace('_', '')
+
+def _scriptContext(body: dict, userDocURL):
+    """Splits topic and style guide and fetches the context for a script request."""
     topic = body['topic']
 
-    ScriptGenModel = current_app.config['ScriptGenModel']
-    
     # obtain style_guide
     style_guide = topic.split("#")[1]
     topic = topic.split("#")[0]
@@ -43,6 +48,14 @@ def genNewScript(body: dict,userDocURL) -> dict:
     print("Inside controller :",context)
 
     response = delete_files_from_cloudinary([userDocURL])
+
+    return topic, style_guide, context
+
+@traced("controller.genNewScript")
+def genNewScript(body: dict,userDocURL) -> dict:
+    ScriptGenModel = current_app.config['ScriptGenModel']
+
+    topic, style_guide, context = _scriptContext(body, userDocURL)
     
     # Generate the result
     result = ScriptGenModel.generate_with_custom_instructions(
@@ -52,24 +65,56 @@ def genNewScript(body: dict,userDocURL) -> dict:
     )
     useless_list = [w for w in useless_words if w in result['generated_text']]
     
-    tries = 5
+    # Generation is constrained at decode time, so this is only a fallback
+    tries = 2
 
-    while len(result['generated_text'].split(".")) < 5 or len(useless_list) != 0 and tries > 0:
+    while (len(result['generated_text'].split(".")) < 5 or len(useless_list) != 0) and tries > 0:
         result = ScriptGenModel.generate_with_custom_instructions(context=context,query=topic,style_guide=style_guide)
         useless_list = [w for w in useless_words if w in result['generated_text']]
         tries -= 1
     
     if 'generated_text' in result:
-        # Clean the generated text
-        cleaned_text = result['generated_text']
-        cleaned_text = cleaned_text.replace('\n', ' ').replace('{', '').replace('}', '').replace('_', '')
         # Update the result with cleaned text
-        result['generated_text'] = cleaned_text
+        result['generated_text'] = clean_script_text(result['generated_text'])
 
     print(result)
     return result
 
-def genImgPrompts(story: str) -> list:
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def streamNewScript(body: dict, userDocURL):
+    """
+    Retrieves the context up front and returns a generator of server-sent
+    events: one 'token' event per decoded chunk, then a 'done' event with
+    the cleaned and truncated script.
+    """
+    ScriptGenModel = current_app.config['ScriptGenModel']
+
+    topic, style_guide, context = _scriptContext(body, userDocURL)
+
+    def events():
+        for item in ScriptGenModel.stream_with_custom_instructions(
+            context=context,
+            query=topic,
+            style_guide=style_guide
+        ):
+            if item.get('done'):
+                result = {k: v for k, v in item.items() if k != 'done'}
+                result['generated_text'] = clean_script_text(result['generated_text'])
+                print(result)
+                yield _sse('done', result)
+            else:
+                yield _sse('token', item)
+
+    return events()
+
+def is_valid_prompt(prompt: str) -> bool:
+    """Checks a cleaned prompt against the word-count and banned-word rules."""
+    return not any(w in prompt for w in useless_words) and len(prompt.split()) >= 15
+
+@traced("controller.genImgPrompts")
+def genImgPrompts(story: str, num_candidates: int = 0) -> dict:
     ScriptGenModel = current_app.config['ScriptGenModel']
     
     parts = story.split("#")
@@ -78,22 +123,34 @@ def genImgPrompts(story: str) -> list:
     subject = parts[2] if len(parts) > 2 else ""
     
     final_prompts = []
+    rejected_candidates = 0
     
     for sentence in story_text.split("."):
         print("sentence :",sentence)
         sentence = sentence.strip()
         if not sentence:
             continue
-        
-        retries = 10  # Prevent infinite loops
-        while retries > 0:
-            prompt = ScriptGenModel.generate_concise_image_prompts(sentence + ".", style_guide=style_guide)[0]
-            prompt = clean_prompt(prompt)
-            
-            # Check if prompt is valid
-            if not any(w in prompt for w in useless_words) and len(prompt.split()) >= 15:
-                break
-            retries -= 1
+
+        if num_candidates > 0:
+            # Best-of-N: sample every candidate in one call and keep the first valid one
+            candidates = ScriptGenModel.generate_image_prompt_candidates(
+                sentence + ".", style_guide=style_guide, num_candidates=num_candidates
+            )
+            candidates = [clean_prompt(c) for c in candidates]
+            valid = [c for c in candidates if is_valid_prompt(c)]
+            rejected_candidates += len(candidates) - len(valid)
+            prompt = valid[0] if valid else (candidates[0] if candidates else "")
+        else:
+            retries = 3  # Fallback only, banned words are filtered while decoding
+            while retries > 0:
+                prompt = ScriptGenModel.generate_concise_image_prompts(sentence + ".", style_guide=style_guide)[0]
+                prompt = clean_prompt(prompt)
+                
+                # Check if prompt is valid
+                if is_valid_prompt(prompt):
+                    break
+                rejected_candidates += 1
+                retries -= 1
         
         # **Skip invalid prompts**
         # if not prompt or "[image]" in prompt or "self." in prompt or "sentences =" in prompt:
@@ -106,5 +163,6 @@ def genImgPrompts(story: str) -> list:
     final_prompts = replace_pronouns_or_nouns(final_prompts, subject)
     
     print(final_prompts)
+    print("Rejected prompt candidates :",rejected_candidates)
     
-    return final_prompts
\ No newline at end of file
+    return {'prompts': final_prompts, 'rejected_candidates': rejected_candidates}
\ No newline at end of file
@@ -2,6 +2,7 @@ from flask import current_app
 from typing import List,Dict,Union
 from werkzeug.datastructures import FileStorage
 import io
+from app.utils.tracing import traced
 
 # Simplified style guides
 STYLE_GUIDES = {
@@ -11,11 +12,13 @@ STYLE_GUIDES = {
     'artistic': "digital art, stylized"
 }
 
+@traced("controller.retriveContext")
 def retriveContext(topic:str)->list:
     ContextModel = current_app.config['contextModel']
 
+    # Only the best chunk goes into the prompt, so only its text is fetched
     context = ContextModel.retrieve_context(
-                topic
+                topic, max_chunks=1
             )
 
     # print("Generated Context:",context[0]['text'])
@@ -24,6 +27,7 @@ def retriveContext(topic:str)->list:
     return context
 
 # def uploadDocument(files: List[Union[FileStorage, io.BytesIO]], filenames: List[str]):
+@traced("controller.uploadDocument")
 def uploadDocument():
     ContextModel = current_app.config['contextModel']
     DB = current_app.config['DB']
@@ -31,10 +35,17 @@ def uploadDocument():
 
     uploaded_files = status['uploaded_files']
 
-    DB.insert_data(uploaded_files)
+    # Topics and their ingest metadata are committed together
+    with DB.transaction():
+        DB.insert_data(uploaded_files)
+        DB.record_ingests([
+            {'filename': f, 'chunks': sum(1 for c in status['chunk_names'] if c.startswith(f"{f}_chunk_"))}
+            for f in uploaded_files
+        ])
 
     return status
 
+@traced("controller.retriveUserContextController")
 def retriveUserContextController(topic:str,userDocURL:str):
     ContextModel = current_app.config['contextModel']
 
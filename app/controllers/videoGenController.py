@@ -1,8 +1,18 @@
-from app.utils.generateVideo import VideoGenerator
+from flask import current_app, url_for
+from app.utils.generateVideo import VIDEO_OUTPUT_FORMAT, VideoGenerator
 from app.utils.translateToHindi import translator
 import asyncio
+import json
+import os
+import threading
+from app.utils.tracing import traced
 
-def videoGenController(story:str,image_urls:list,audio_urls:list,caption_lang='en'):
+# How long an HLS request waits for its first segment before answering anyway
+HLS_FIRST_SEGMENT_TIMEOUT = float(os.getenv('HLS_FIRST_SEGMENT_TIMEOUT', '120'))
+
+@traced("controller.videoGenController")
+def videoGenController(story:str,image_urls:list,audio_urls:list,caption_lang='en',subtitle_mode=None,
+                       output_format=None)->dict:
     storyInModifiedLanguage = ""
     if caption_lang == "hi":
         storyInModifiedLanguage = asyncio.run(translator(story))
@@ -16,7 +26,60 @@ def videoGenController(story:str,image_urls:list,audio_urls:list,caption_lang='e
     print(storyInModifiedLanguage)
     print(image_urls)
     print(audio_urls)
-    video_gen = VideoGenerator(image_urls, audio_urls,story=storyInModifiedLanguage)
+    video_gen = VideoGenerator(image_urls, audio_urls,story=storyInModifiedLanguage,subtitle_mode=subtitle_mode)
+
+    if (output_format or VIDEO_OUTPUT_FORMAT) == "hls":
+        return startHLSJob(video_gen)
 
     videoUrl = video_gen.generateVideo()
-    return videoUrl
+    response = {"url": videoUrl}
+    # Sidecar mode delivers the subtitles as a separate WebVTT file
+    if video_gen.subtitles_url:
+        response["subtitles_url"] = video_gen.subtitles_url
+    return response
+
+def startHLSJob(video_gen:VideoGenerator)->dict:
+    """
+    Renders the video on a background thread, recording uploaded segments
+    on a job so any worker can serve the playlist, and answers as soon as
+    the first segment is playable.
+    """
+    DB = current_app.config['DB']
+    job_id = DB.create_job("video_hls", payload=json.dumps({"image_urls": video_gen.image_urls}))
+    state = {"segments": [], "target_duration": None, "total": len(video_gen.image_urls), "subtitles_url": None}
+    first_segment = threading.Event()
+
+    def on_segment(segment, index, total, target_duration):
+        state["segments"].append(segment)
+        state["target_duration"] = target_duration
+        state["total"] = total
+        state["subtitles_url"] = video_gen.subtitles_url
+        status = "done" if index + 1 == total else "running"
+        DB.update_job(job_id, status, result=json.dumps(state))
+        first_segment.set()
+
+    def run():
+        try:
+            DB.update_job(job_id, "running")
+            video_gen.generateHLS(on_segment)
+        except Exception as e:
+            print(f"HLS generation failed: {e}")
+            DB.update_job(job_id, "failed", error=str(e))
+        finally:
+            first_segment.set()
+
+    threading.Thread(target=run, name=f"hls-{job_id[:8]}", daemon=True).start()
+    first_segment.wait(HLS_FIRST_SEGMENT_TIMEOUT)
+
+    job = DB.get_job(job_id)
+    response = {
+        "url": url_for('main.hlsPlaylist', job_id=job_id, _external=True),
+        "job_id": job_id,
+        "status": job["status"],
+    }
+    if video_gen.subtitles_url:
+        response["subtitles_url"] = video_gen.subtitles_url
+    if job["status"] == "failed":
+        response["url"] = None
+        response["error"] = job["error"]
+    return response
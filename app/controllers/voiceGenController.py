@@ -3,8 +3,10 @@ from app.utils.audioProcessor import process_audio
 from app.utils.translateToHindi import translator
 
 import asyncio
+from app.utils.tracing import traced
 
-def genAudioController(texts, url, lang="en"):
+@traced("controller.genAudioController")
+def genAudioController(texts, url, lang="en", audio_format=None, include_format=False):
     try:
         TTSModel = current_app.config['TTSModel']
 
@@ -23,7 +25,9 @@ def genAudioController(texts, url, lang="en"):
         audioUrls = TTSModel.synthesize_and_upload(
             sentences, 
             url=url, 
-            language=lang
+            language=lang,
+            audio_format=audio_format,
+            include_format=include_format
         )
 
         return audioUrls or []
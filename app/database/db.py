@@ -1,71 +1,270 @@
+import json
+import os
+import re
 import sqlite3
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# Schema versions, applied in order and tracked with PRAGMA user_version.
+# Append new migrations, never edit applied ones.
+MIGRATIONS = [
+    # 1: uploaded topics (matches databases created before versioning)
+    """
+    CREATE TABLE IF NOT EXISTS topics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT UNIQUE NOT NULL
+    );
+    """,
+    # 2: background job and document ingest metadata
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        payload TEXT,
+        result TEXT,
+        error TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, updated_at);
+    CREATE TABLE IF NOT EXISTS ingests (
+        filename TEXT PRIMARY KEY,
+        chunks INTEGER NOT NULL,
+        content_hash TEXT,
+        ingested_at REAL NOT NULL
+    );
+    """,
+    # 3: keyword index over ingested chunks, keyed by their vector ids
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+        vector_id UNINDEXED,
+        filename UNINDEXED,
+        text,
+        tokenize = 'porter unicode61'
+    );
+    """,
+    # 4: compressed chunk text store keyed by vector id; the keyword index
+    #    becomes contentless and shares its rowids, so text is stored once
+    """
+    CREATE TABLE IF NOT EXISTS chunk_texts (
+        id INTEGER PRIMARY KEY,
+        vector_id TEXT UNIQUE NOT NULL,
+        filename TEXT NOT NULL,
+        text BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS chunk_texts_filename ON chunk_texts (filename);
+    INSERT OR IGNORE INTO chunk_texts (vector_id, filename, text)
+        SELECT vector_id, filename, compress_text(text) FROM chunks_fts;
+    DROP TABLE chunks_fts;
+    CREATE VIRTUAL TABLE chunks_fts USING fts5(
+        text,
+        content = '',
+        tokenize = 'porter unicode61'
+    );
+    INSERT INTO chunks_fts (rowid, text) SELECT id, decompress_text(text) FROM chunk_texts;
+    """,
+    # 5: generated images indexed by prompt embedding, for reuse
+    """
+    CREATE TABLE IF NOT EXISTS image_library (
+        id INTEGER PRIMARY KEY,
+        prompt TEXT NOT NULL,
+        embedding BLOB NOT NULL,
+        url TEXT NOT NULL,
+        thumbnail_url TEXT,
+        seed INTEGER,
+        width INTEGER NOT NULL,
+        height INTEGER NOT NULL,
+        format TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    """,
+    # 6: finished request traces, shared by the preforked workers
+    """
+    CREATE TABLE IF NOT EXISTS traces (
+        request_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        duration_ms REAL,
+        data TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS traces_created_at ON traces (created_at);
+    """,
+]
+
+# Words left out of keyword queries
+STOPWORDS = frozenset(
+    "a an and are as at be by for from how in into is it of on or that the this to was were what when "
+    "where which who why with about story write provide account history historical biography".split()
+)
+
+# Applied to every new connection
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",        # readers never block the writer and vice versa
+    "PRAGMA synchronous=NORMAL",      # durable with WAL, fsync only at checkpoints
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",       # 16 MB page cache per connection
+    "PRAGMA mmap_size=268435456",
+)
+
+
+def compress_text(text: str) -> bytes:
+    return zlib.compress(text.encode("utf-8"), 6)
+
+
+def decompress_text(blob: bytes) -> str:
+    return zlib.decompress(blob).decode("utf-8")
+
+
+class _ThreadConnection:
+    """Holds a thread's connection; when the thread exits and drops it, the connection is closed."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.finalizer = weakref.finalize(self, _close_connection, conn, os.getpid())
+
+
+def _close_connection(conn: sqlite3.Connection, pid: int):
+    # A forked child must not close the connection it inherited from its parent
+    if os.getpid() != pid:
+        return
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
 
 class DBInstance:
-    def __init__(self):
-        self.sqliteConnection = sqlite3.connect('topics.db',check_same_thread=False)
-        self.cursor = self.sqliteConnection.cursor()
-        self.table_name = "topics"  # Constant table name
+    """
+    SQLite access layer with one connection per thread (and per process,
+    so it stays valid in forked workers), closed when its thread exits.
+    WAL mode lets concurrent requests read while another one writes;
+    writers wait on busy_timeout instead of failing. Group several writes
+    into one commit with transaction().
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or os.getenv("DB_PATH", "topics.db")
+        self._local = threading.local()
+        # Only tracks live connections for close_connection(); does not keep them open
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
         print("Init DB successful")
-        self.create_table()
+        self.migrate()
 
-    def create_table(self):
-        """Creates the table (topics) if it doesn't exist."""
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The calling thread's connection, opened on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            # isolation_level=None: transactions are only the ones opened by transaction()
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            conn.create_function("compress_text", 1, compress_text, deterministic=True)
+            conn.create_function("decompress_text", 1, decompress_text, deterministic=True)
+            holder = _ThreadConnection(conn)
+            self._local.holder = holder
+            self._local.conn, self._local.pid, self._local.depth = conn, os.getpid(), 0
+            with self._connections_lock:
+                self._connections.add(holder)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block in a single write transaction on this thread's
+        connection, committing on success and rolling back on error. Nested
+        calls join the outer transaction.
+        """
+        conn = self.connection
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
         try:
-            query = f"""
-            CREATE TABLE IF NOT EXISTS {self.table_name} (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                filename TEXT UNIQUE NOT NULL
-            )
-            """
-            self.cursor.execute(query)
-            self.sqliteConnection.commit()
-            print(f"Table '{self.table_name}' created or already exists.")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.depth = 0
+
+    @property
+    def in_transaction(self) -> bool:
+        """Whether this thread is inside transaction(), where errors must reach the outer block."""
+        return bool(getattr(self._local, "depth", 0))
+
+    def migrate(self):
+        """Applies pending schema migrations."""
+        try:
+            with self.transaction() as conn:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                    for statement in filter(str.strip, script.split(";")):
+                        conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version = {number}")
+                    print(f"Applied database migration {number}")
         except sqlite3.Error as e:
-            print(f"Error creating table: {e}")
-            if self.sqliteConnection:
-                self.sqliteConnection.rollback()
+            print(f"Error migrating database: {e}")
+
+    def create_table(self):
+        """Creates the tables if they don't exist."""
+        self.migrate()
 
     def insert_data(self, filenames):
-        """Inserts multiple filenames into the topics table."""
+        """Inserts multiple filenames into the topics table, skipping ones already present."""
         try:
             print(filenames)
-            query = f"INSERT INTO {self.table_name} (filename) VALUES (?)"
-            self.cursor.executemany(query, [(filename,) for filename in filenames])
-            self.sqliteConnection.commit()
+            with self.transaction() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO topics (filename) VALUES (?)",
+                    [(filename,) for filename in filenames]
+                )
             print("Data inserted successfully")
         except sqlite3.Error as e:
+            if self.in_transaction:
+                raise
             print(f"Error inserting data: {e}")
-            if self.sqliteConnection:
-                self.sqliteConnection.rollback()
 
     def delete_data(self, where_clause, params=None):
         """Deletes data from the topics table."""
         try:
-            query = f"DELETE FROM {self.table_name} WHERE {where_clause}"
-            if params:
-                self.cursor.execute(query, params)
-            else:
-                self.cursor.execute(query)
-            self.sqliteConnection.commit()
+            with self.transaction() as conn:
+                conn.execute(f"DELETE FROM topics WHERE {where_clause}", params or ())
             print("Data deleted successfully")
         except sqlite3.Error as e:
+            if self.in_transaction:
+                raise
             print(f"Error deleting data: {e}")
-            if self.sqliteConnection:
-                self.sqliteConnection.rollback()
 
     def close_connection(self):
-        if self.sqliteConnection:
-            self.cursor.close()
-            self.sqliteConnection.close()
-            print("Database connection closed")
+        """Closes every connection opened by this instance."""
+        with self._connections_lock:
+            holders, self._connections = list(self._connections), weakref.WeakSet()
+        for holder in holders:
+            holder.finalizer()
+        self._local = threading.local()
+        print("Database connection closed")
 
     def get_all_filenames(self):
         """Retrieves all filenames as a list without their index."""
         try:
-            query = f"SELECT filename FROM {self.table_name}"
-            self.cursor.execute(query)
-            filenames = [row[0] for row in self.cursor.fetchall()]
-            return filenames
+            rows = self.connection.execute("SELECT filename FROM topics ORDER BY id").fetchall()
+            return [row[0] for row in rows]
         except sqlite3.Error as e:
             print(f"Error retrieving filenames: {e}")
             return []
@@ -73,11 +272,194 @@ class DBInstance:
     def delete_all_data(self):
         """Deletes all data in the table without removing the structure."""
         try:
-            query = f"DELETE FROM {self.table_name}"
-            self.cursor.execute(query)
-            self.sqliteConnection.commit()
-            print(f"All data deleted from '{self.table_name}'.")
+            with self.transaction() as conn:
+                conn.execute("DELETE FROM topics")
+                conn.execute("DELETE FROM ingests")
+                conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('delete-all')")
+                conn.execute("DELETE FROM chunk_texts")
+            print("All data deleted from 'topics'.")
         except sqlite3.Error as e:
+            if self.in_transaction:
+                raise
             print(f"Error deleting data: {e}")
-            if self.sqliteConnection:
-                self.sqliteConnection.rollback()
\ No newline at end of file
+
+    def record_ingests(self, ingests: List[Dict]):
+        """Upserts ingest metadata: dicts with filename, chunks and optional content_hash."""
+        now = time.time()
+        try:
+            with self.transaction() as conn:
+                conn.executemany(
+                    "INSERT INTO ingests (filename, chunks, content_hash, ingested_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(filename) DO UPDATE SET chunks = excluded.chunks, "
+                    "content_hash = excluded.content_hash, ingested_at = excluded.ingested_at",
+                    [(i["filename"], i["chunks"], i.get("content_hash"), now) for i in ingests]
+                )
+        except sqlite3.Error as e:
+            if self.in_transaction:
+                raise
+            print(f"Error recording ingests: {e}")
+
+    def get_ingests(self) -> List[Dict]:
+        try:
+            rows = self.connection.execute(
+                "SELECT filename, chunks, content_hash, ingested_at FROM ingests ORDER BY ingested_at"
+            ).fetchall()
+            return [dict(zip(("filename", "chunks", "content_hash", "ingested_at"), row)) for row in rows]
+        except sqlite3.Error as e:
+            print(f"Error retrieving ingests: {e}")
+            return []
+
+    def index_chunks(self, filename: str, chunks: List[Dict]):
+        """
+        Replaces the stored text and keyword index entries of a file with
+        chunks given as dicts with id and text.
+        """
+        with self.transaction() as conn:
+            self._delete_chunks(conn, "filename = ?", (filename,))
+            self._insert_chunks(conn, [{**c, "filename": filename} for c in chunks])
+
+    def add_chunks(self, chunks: List[Dict]):
+        """Upserts individual chunks given as dicts with id, filename and text."""
+        if not chunks:
+            return
+        with self.transaction() as conn:
+            placeholders = ",".join("?" for _ in chunks)
+            self._delete_chunks(conn, f"vector_id IN ({placeholders})", [c["id"] for c in chunks])
+            self._insert_chunks(conn, chunks)
+
+    @staticmethod
+    def _delete_chunks(conn, where: str, params):
+        # A contentless index can only forget a row when given its original text
+        rows = conn.execute(f"SELECT id, text FROM chunk_texts WHERE {where}", params).fetchall()
+        conn.executemany(
+            "INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', ?, ?)",
+            [(row_id, decompress_text(text)) for row_id, text in rows]
+        )
+        conn.execute(f"DELETE FROM chunk_texts WHERE {where}", params)
+
+    @staticmethod
+    def _insert_chunks(conn, chunks: List[Dict]):
+        for chunk in chunks:
+            row_id = conn.execute(
+                "INSERT INTO chunk_texts (vector_id, filename, text) VALUES (?, ?, ?)",
+                (chunk["id"], chunk["filename"], compress_text(chunk["text"]))
+            ).lastrowid
+            conn.execute("INSERT INTO chunks_fts (rowid, text) VALUES (?, ?)", (row_id, chunk["text"]))
+
+    def get_chunk_texts(self, vector_ids: List[str]) -> Dict[str, Dict]:
+        """Returns {vector_id: {'text', 'filename'}} for the stored chunks among vector_ids."""
+        found = {}
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(vector_ids), 500):
+            batch = vector_ids[start:start + 500]
+            placeholders = ",".join("?" for _ in batch)
+            rows = self.connection.execute(
+                f"SELECT vector_id, filename, text FROM chunk_texts WHERE vector_id IN ({placeholders})", batch
+            ).fetchall()
+            for vector_id, filename, text in rows:
+                found[vector_id] = {"text": decompress_text(text), "filename": filename}
+        return found
+
+    @staticmethod
+    def keyword_terms(query: str) -> List[str]:
+        terms = re.findall(r"\w+", query.lower())
+        return list(dict.fromkeys(t for t in terms if len(t) > 2 and t not in STOPWORDS))
+
+    def search_chunks(self, query: str, limit: int = 10, match_all: bool = False) -> List[Dict]:
+        """
+        BM25 keyword search over the indexed chunks. With match_all every
+        query term must appear in a chunk, otherwise any term may. Returns
+        dicts with id, filename and score (higher is better); fetch the
+        texts that are needed with get_chunk_texts.
+        """
+        terms = self.keyword_terms(query)
+        if not terms:
+            return []
+        # Quote every term so user input cannot inject FTS syntax
+        match = f" {'AND' if match_all else 'OR'} ".join(f'"{t}"' for t in terms)
+        try:
+            rows = self.connection.execute(
+                "SELECT c.vector_id, c.filename, m.rank FROM "
+                "(SELECT rowid, bm25(chunks_fts) AS rank FROM chunks_fts WHERE chunks_fts MATCH ? "
+                "ORDER BY rank LIMIT ?) AS m JOIN chunk_texts AS c ON c.id = m.rowid ORDER BY m.rank",
+                (match, limit)
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error searching chunks: {e}")
+            return []
+        return [{"id": r[0], "filename": r[1], "score": -r[2]} for r in rows]
+
+    def create_job(self, kind: str, payload: Optional[str] = None) -> str:
+        """Creates a queued job and returns its id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, payload, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, payload, now, now)
+            )
+        return job_id
+
+    def update_job(self, job_id: str, status: str, result: Optional[str] = None, error: Optional[str] = None):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = COALESCE(?, result), error = COALESCE(?, error), "
+                "updated_at = ? WHERE id = ?",
+                (status, result, error, time.time(), job_id)
+            )
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        row = self.connection.execute(
+            "SELECT id, kind, status, payload, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("id", "kind", "status", "payload", "result", "error", "created_at", "updated_at"), row))
+
+    def save_trace(self, trace: Dict, keep: int):
+        """Stores a finished trace (Trace.to_dict()) and prunes all but the newest keep traces."""
+        root = trace["spans"][0] if trace["spans"] else {}
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO traces (request_id, name, duration_ms, data, created_at) VALUES (?, ?, ?, ?, ?)",
+                (trace["request_id"], trace["name"], root.get("duration_ms"), json.dumps(trace), time.time())
+            )
+            conn.execute(
+                "DELETE FROM traces WHERE created_at < "
+                "(SELECT created_at FROM traces ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+                (keep - 1,)
+            )
+
+    def get_trace(self, request_id: str) -> Optional[Dict]:
+        row = self.connection.execute("SELECT data FROM traces WHERE request_id = ?", (request_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_recent_traces(self, limit: int) -> List[Dict]:
+        """Summaries of the newest traces, newest first."""
+        rows = self.connection.execute(
+            "SELECT request_id, name, duration_ms FROM traces ORDER BY created_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [dict(zip(("request_id", "name", "duration_ms"), row)) for row in rows]
+
+    def add_library_image(self, prompt: str, embedding: bytes, url: str, width: int, height: int,
+                          image_format: str, seed: Optional[int] = None, thumbnail_url: Optional[str] = None) -> int:
+        """Stores a generated image with its prompt embedding and returns its id."""
+        with self.transaction() as conn:
+            return conn.execute(
+                "INSERT INTO image_library (prompt, embedding, url, thumbnail_url, seed, width, height, format, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (prompt, embedding, url, thumbnail_url, seed, width, height, image_format, time.time())
+            ).lastrowid
+
+    def get_library_images(self, after_id: int = 0) -> List[Dict]:
+        """Returns the library images with an id above after_id, oldest first."""
+        rows = self.connection.execute(
+            "SELECT id, prompt, embedding, url, thumbnail_url, seed, width, height, format FROM image_library "
+            "WHERE id > ? ORDER BY id",
+            (after_id,)
+        ).fetchall()
+        return [
+            dict(zip(("id", "prompt", "embedding", "url", "thumbnail_url", "seed", "width", "height", "format"), row))
+            for row in rows
+        ]
@@ -6,14 +6,48 @@ import os
 import requests
 from tempfile import NamedTemporaryFile
 from TTS.api import TTS
-from app.utils.cloudinaryUploader import upload_audio_to_cloudinary
+from app.utils import audioProcessor
+from app.utils.audioProcessor import audio_format_info, encode_batch, postprocess_batch
+from app.utils.cloudinaryUploader import upload_audio_buffer
+from app.utils.diskCache import DiskLRUCache, file_digest, hash_key
+from app.utils.metrics import record_bytes, record_cache, track_stage
+from app.utils.tracing import propagate
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+import numpy as np
 import time
+import uuid
+
+# Encoded speech and its URL per sentence, so repeated sentences skip synthesis
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "data/cache/tts")
+TTS_CACHE_MAX_MB = int(os.getenv("TTS_CACHE_MAX_MB", "512"))
+_tts_cache = None
+
+def get_tts_cache():
+    global _tts_cache
+    if _tts_cache is None and os.getenv("TTS_CACHE", "1") == "1":
+        _tts_cache = DiskLRUCache(TTS_CACHE_DIR, TTS_CACHE_MAX_MB * 1024 * 1024, name="tts")
+    return _tts_cache
+
+def tts_cache_key(text, language, speaker_digest, model_name, sample_rate, audio_format):
+    """
+    Key of one sentence's uploaded audio: the text with whitespace
+    collapsed, the language, the speaker reference's digest, the model and
+    every setting that changes the post-processed, encoded result.
+    """
+    return hash_key(
+        " ".join(text.split()), language, speaker_digest or b"", model_name, sample_rate,
+        audioProcessor.AUDIO_DENOISE, audioProcessor.AUDIO_TRIM_SILENCE,
+        audioProcessor.SILENCE_THRESHOLD_DB, audioProcessor.SILENCE_PAD_MS,
+        audioProcessor.TARGET_LOUDNESS_DB, audio_format, audioProcessor.AUDIO_BITRATE
+    )
 
 class HuggingFaceTTS:
-    def __init__(self, model_name="tts_models/multilingual/multi-dataset/xtts_v2"):
-        self.tts = TTS(model_name=model_name)
+    def __init__(self, model_name="tts_models/multilingual/multi-dataset/xtts_v2", tts=None):
+        # tts replaces the Coqui model with any object of the same tts()/synthesizer interface
+        self.model_name = model_name
+        self.tts = tts if tts is not None else TTS(model_name=model_name)
+        self.sample_rate = self.tts.synthesizer.output_sample_rate
         self.max_workers = 3
         self.max_retries = 3
         self.timeout = 300  # 5 minutes
@@ -21,9 +55,12 @@ class HuggingFaceTTS:
     def download_audio(self, url):
         try:
             with NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
-                response = requests.get(url, stream=True, timeout=30)
-                response.raise_for_status()
-                temp_file.write(response.content)
+                with track_stage("download"):
+                    response = requests.get(url, stream=True, timeout=30)
+                    response.raise_for_status()
+                    content = response.content
+                record_bytes("download", len(content))
+                temp_file.write(content)
                 temp_file.flush()
                 return temp_file.name
         except requests.exceptions.RequestException as e:
@@ -48,25 +85,25 @@ class HuggingFaceTTS:
                     text = text[:497] + "..."
                 
                 print(f"Attempt {attempt + 1} - Processing text {i}: {text}")
-                output_path = f"output_{i}_{attempt}.wav"
                 
                 # Generate audio with appropriate parameters
                 kwargs = {
                     "text": text,
-                    "file_path": output_path,
                     "language": language
                 }
                 if reference_wav:
                     kwargs["speaker_wav"] = reference_wav
                 
-                self.tts.tts_to_file(**kwargs)
+                # Samples stay in memory; nothing is written to disk
+                with track_stage("tts"):
+                    samples = np.asarray(self.tts.tts(**kwargs), dtype=np.float32)
                 
                 # Verify output
-                if os.path.exists(output_path) and os.path.getsize(output_path) > 1024:  # Min 1KB
+                if len(samples) > self.sample_rate // 20:  # Min 50 ms
                     print(f"Successfully generated audio for text {i}")
-                    return output_path
+                    return samples
                 else:
-                    raise ValueError("Generated file is too small or invalid")
+                    raise ValueError("Generated audio is too short or invalid")
                     
             except Exception as e:
                 print(f"Attempt {attempt + 1} failed for text {i}: {str(e)}")
@@ -75,9 +112,15 @@ class HuggingFaceTTS:
                     return None
                 time.sleep(1)  # Wait before retry
     
-    def synthesize_and_upload(self, texts, url, language="en"):
+    def synthesize_and_upload(self, texts, url, language="en", audio_format=None, include_format=False):
+        """
+        Synthesizes, post-processes, encodes (AUDIO_UPLOAD_FORMAT unless
+        audio_format is given) and uploads one audio file per text.
+        Returns the URLs, or with include_format a dict of the URLs under
+        'audio' and the encoding details under 'format'.
+        """
         try:
-            audio_files = []
+            audio_segments = []
             reference_wav = None
             
             if url:
@@ -97,43 +140,102 @@ class HuggingFaceTTS:
                     valid_texts.append(cleaned_text)
             
             print(f"Processing {len(valid_texts)} valid text segments")
+
+            # Sentences already synthesized with the same voice and settings are served from the cache
+            requested_format = (audio_format or audioProcessor.AUDIO_UPLOAD_FORMAT).lower()
+            cache = get_tts_cache()
+            batch_id = uuid.uuid4().hex[:12]
+            uploaded_urls = [None] * len(valid_texts)
+            cache_keys = [None] * len(valid_texts)
+            if cache is not None:
+                speaker_digest = file_digest(reference_wav) if reference_wav else None
+                for i, text in enumerate(valid_texts):
+                    cache_keys[i] = tts_cache_key(
+                        text, language, speaker_digest, self.model_name, self.sample_rate, requested_format
+                    )
+                    uploaded_urls[i] = self._cached_url(cache, cache_keys[i], f"speech_{batch_id}_{i}")
+            pending = [i for i, url in enumerate(uploaded_urls) if not url]
+            if len(pending) < len(valid_texts):
+                print(f"Reusing cached audio for {len(valid_texts) - len(pending)} segments")
             
             # Process texts with better error handling
             with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
                 future_to_index = {
                     executor.submit(
-                        self.generate_single_audio,
-                        text,
+                        propagate(self.generate_single_audio),
+                        valid_texts[i],
                         i,
                         reference_wav,
                         language
-                    ): i for i, text in enumerate(valid_texts)
+                    ): i for i in pending
                 }
                 
                 for future in future_to_index:
                     try:
                         result = future.result(timeout=self.timeout)
-                        if result:
-                            audio_files.append(result)
+                        if result is not None:
+                            audio_segments.append((future_to_index[future], result))
                     except Exception as e:
                         print(f"Error processing future {future_to_index[future]}: {str(e)}")
             
-            if not audio_files:
+            if not audio_segments and not any(uploaded_urls):
                 print("No audio files were generated successfully")
-                return []
+                return {"audio": [], "format": None} if include_format else []
             
-            print(f"Uploading {len(audio_files)} files to Cloudinary")
-            uploaded_urls = upload_audio_to_cloudinary(audio_files)
+            audio_format = requested_format
+            if audio_segments:
+                # Denoise, trim and level all segments of the story together
+                indices = [i for i, _ in audio_segments]
+                processed = postprocess_batch([samples for _, samples in audio_segments], self.sample_rate)
+                encoded, audio_format = encode_batch(processed, self.sample_rate, requested_format)
+
+                print(f"Uploading {len(encoded)} files to Cloudinary")
+                for i, (data, ext) in zip(indices, encoded):
+                    url = upload_audio_buffer(data, f"speech_{batch_id}_{i}{ext}")
+                    uploaded_urls[i] = url
+                    # A WAV fallback is not what the key asked for, so it is not cached
+                    if url and cache_keys[i] and audio_format == requested_format:
+                        cache.store_bytes(cache_keys[i], data, ext)
+                        cache.store_bytes(hash_key(cache_keys[i], "url"), url.encode("utf-8"), ".url")
+            uploaded_urls = [url for url in uploaded_urls if url]
             
             # Cleanup
-            self._cleanup_files(audio_files + ([reference_wav] if reference_wav else []))
+            self._cleanup_files([reference_wav] if reference_wav else [])
             
+            if include_format:
+                return {"audio": uploaded_urls, "format": audio_format_info(audio_format, self.sample_rate)}
             return uploaded_urls
             
         except Exception as e:
             print(f"Error in synthesize_and_upload: {str(e)}")
-            return []
+            return {"audio": [], "format": None} if include_format else []
     
+    def _cached_url(self, cache, key, filename):
+        """
+        URL of a cached sentence: its earlier upload, or a new upload of
+        the cached audio if only that is left. None on a miss. Records one
+        hit or miss per sentence.
+        """
+        url = cache.get_bytes(hash_key(key, "url"), record=False)
+        if url:
+            record_cache(cache.name, hit=True)
+            return url.decode("utf-8")
+        path = cache.get_path(key, record=False)
+        data = None
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+        record_cache(cache.name, hit=data is not None)
+        if data is None:
+            return None
+        url = upload_audio_buffer(data, f"{filename}{os.path.splitext(path)[1]}")
+        if url:
+            cache.store_bytes(hash_key(key, "url"), url.encode("utf-8"), ".url")
+        return url or None
+
     def _cleanup_files(self, files):
         for file in files:
             try:
@@ -12,11 +12,17 @@ import tempfile
 import PyPDF2
 import docx
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from app.utils.metrics import record_bytes, record_cache, track_stage
+from app.utils.tracing import propagate, span
 
 load_dotenv()
 
+# Reciprocal rank fusion constant, dampens the weight of top ranks
+RRF_K = 60
+
 class ContextRetriever:
-    def __init__(self):
+    def __init__(self, db=None):
         # Get API key from environment variables
         api_key = os.getenv('PINECONE_API_KEY')
         index_name = os.getenv('PINECONE_INDEX_NAME')
@@ -40,33 +46,142 @@ class ContextRetriever:
         self.chunk_size = 5
         self.chunk_overlap = 2
 
-    def retrieve_context(self, topic: str, top_k: int = 10) -> List[Dict]:
-        """Retrieve context based on the topic passed as an argument."""
+        # Local keyword index (SQLite FTS5) used alongside the vector index
+        self.db = db
+        self.hybrid = db is not None and os.getenv('HYBRID_RETRIEVAL', '1') == '1'
+        # Skip the vector query when this many chunks contain every keyword
+        self.keyword_confident_hits = int(os.getenv('HYBRID_CONFIDENT_HITS', '3'))
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retrieval")
+
+    def retrieve_context(self, topic: str, top_k: int = 10, max_chunks: int = None,
+                         max_chars: int = None) -> List[Dict]:
+        """
+        Retrieve context based on the topic passed as an argument.
+
+        With a keyword index, BM25 matches and dense matches are fused with
+        reciprocal rank fusion. When enough chunks contain every keyword of
+        the topic (typical for named entities) those are returned directly
+        and the remote vector query is skipped.
+
+        Chunks are ranked by id only; texts are then read from the local
+        chunk store for the best max_chunks chunks that fit in max_chars.
+        """
         try:
-            # Generate embedding for the topic
-            topic_embedding = self.model.encode(topic)
+            with track_stage("retrieval"):
+                if not self.hybrid:
+                    ranked = self._vector_search(self.model.encode(topic), top_k)
+                    return self._attach_texts(ranked, max_chunks, max_chars)
+
+                # Embed the topic while the keyword index is searched
+                embedding = self.executor.submit(propagate(self.model.encode), topic)
+                with span("keyword_search"):
+                    strict = self.db.search_chunks(topic, top_k, match_all=True)
+                confident = len(strict) >= min(self.keyword_confident_hits, top_k)
+                record_cache("keyword_retrieval", hit=confident)
+                if confident:
+                    embedding.cancel()
+                    ranked = [
+                        {'id': c['id'], 'source': c['filename'], 'score': c['score'], 'retrieval': 'keyword'}
+                        for c in strict
+                    ]
+                    return self._attach_texts(ranked, max_chunks, max_chars)
+
+                dense = self.executor.submit(propagate(self._vector_search), embedding.result(), top_k)
+                with span("keyword_search"):
+                    keyword = strict or self.db.search_chunks(topic, top_k)
+                ranked = self._fuse(dense.result(), keyword, top_k)
+                return self._attach_texts(ranked, max_chunks, max_chars)
 
+        except Exception as e:
+            print(f"Error during context retrieval: {str(e)}")
+            return []
+
+    def _vector_search(self, topic_embedding, top_k: int) -> List[Dict]:
+        # With a local chunk store the index only needs to return ids and scores
+        local = self.db is not None
+        with span("vector_search"):
             # Query Pinecone index
             results = self.index.query(
                 vector=topic_embedding.tolist(),
                 top_k=top_k,
-                include_metadata=True
+                include_metadata=not local
             )
 
-            # Format results
-            formatted_results = []
-            for match in results['matches']:
-                formatted_results.append({
-                    'text': match['metadata']['text'],
-                    'source': match['metadata']['filename'],
-                    'score': match['score']
-                })
+        # Format results
+        formatted_results = []
+        for match in results['matches']:
+            result = {'id': match['id'], 'score': match['score']}
+            if not local:
+                result['text'] = match['metadata']['text']
+                result['source'] = match['metadata']['filename']
+            formatted_results.append(result)
 
-            return formatted_results
+        return formatted_results
 
-        except Exception as e:
-            print(f"Error during context retrieval: {str(e)}")
-            return []
+    def _attach_texts(self, ranked: List[Dict], max_chunks: int = None, max_chars: int = None) -> List[Dict]:
+        """
+        Adds text (and source) to the ranked chunks, keeping the best ones
+        that fit in max_chunks chunks and max_chars characters. The top
+        chunk is always kept.
+        """
+        if self.db is not None and ranked:
+            with span("chunk_texts", chunks=len(ranked)):
+                ids = [match['id'] for match in ranked]
+                stored = self.db.get_chunk_texts(ids)
+                missing = [i for i in ids if i not in stored]
+                if missing:
+                    stored.update(self._backfill_chunks(missing))
+            record_cache("chunk_text", hit=not missing)
+
+            for match in ranked:
+                chunk = stored.get(match['id'])
+                if chunk is not None:
+                    match['text'] = chunk['text']
+                    match.setdefault('source', chunk['filename'])
+            ranked = [match for match in ranked if 'text' in match]
+
+        # Chunks without text are dropped first so they don't use up the budget
+        if max_chunks is not None:
+            ranked = ranked[:max_chunks]
+
+        results, used = [], 0
+        for match in ranked:
+            if max_chars is not None and results and used + len(match['text']) > max_chars:
+                break
+            used += len(match['text'])
+            results.append(match)
+        return results
+
+    def _backfill_chunks(self, vector_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Fetches the texts of chunks uploaded before the local store existed
+        from the vector index metadata and stores them for next time.
+        """
+        fetched = self.index.fetch(ids=vector_ids)
+        chunks = []
+        for vector_id, vector in fetched['vectors'].items():
+            metadata = vector['metadata'] or {}
+            if 'text' in metadata:
+                chunks.append({'id': vector_id, 'filename': metadata.get('filename', ''), 'text': metadata['text']})
+        self.db.add_chunks(chunks)
+        return {c['id']: {'text': c['text'], 'filename': c['filename']} for c in chunks}
+
+    @staticmethod
+    def _fuse(dense: List[Dict], keyword: List[Dict], top_k: int) -> List[Dict]:
+        """Reciprocal rank fusion of dense and keyword results, keyed by vector id."""
+        fused = {}
+        for rank, match in enumerate(dense):
+            fused[match['id']] = {
+                **match, 'score': 1 / (RRF_K + rank + 1), 'retrieval': 'vector'
+            }
+        for rank, match in enumerate(keyword):
+            entry = fused.setdefault(match['id'], {
+                'id': match['id'], 'source': match['filename'], 'score': 0.0, 'retrieval': 'keyword'
+            })
+            entry['score'] += 1 / (RRF_K + rank + 1)
+            if entry['retrieval'] == 'vector':
+                entry['retrieval'] = 'hybrid'
+        return sorted(fused.values(), key=lambda m: m['score'], reverse=True)[:top_k]
         
     def _split_into_sentences(self, text: str) -> List[str]:
         """
@@ -155,6 +270,11 @@ class ContextRetriever:
                     chunks = self._create_chunks(text_content)
                     chunk_embeddings = self.model.encode(chunks)
 
+                    if self.db is not None:
+                        self.db.index_chunks(clean_filename, [
+                            {'id': f"{clean_filename}_{i}", 'text': chunk} for i, chunk in enumerate(chunks)
+                        ])
+
                     for i, (chunk, embedding) in enumerate(zip(chunks, chunk_embeddings)):
                         vector_id = f"{clean_filename}_{i}"
                         chunk_name = f"{clean_filename}_chunk_{i}"
@@ -211,8 +331,10 @@ class ContextRetriever:
             
             # Download and save file to upload directory
             print(f"Downloading document from: {userDocURL}")
-            response = requests.get(userDocURL, timeout=10)
-            response.raise_for_status()
+            with track_stage("download"):
+                response = requests.get(userDocURL, timeout=10)
+                response.raise_for_status()
+            record_bytes("download", len(response.content))
             print(f"Document downloaded successfully. Saving to: {filepath}")
 
             with open(filepath, "wb") as file:
@@ -240,12 +362,13 @@ class ContextRetriever:
             if not extracted_text:
                 raise ValueError("No text extracted from the document.")
             
-            # Compute embeddings
-            topic_embedding = self.model.encode(topic, convert_to_tensor=True)
-            doc_embeddings = self.model.encode(extracted_text, convert_to_tensor=True)
-            
-            # Compute similarity scores
-            similarity_scores = util.pytorch_cos_sim(topic_embedding, doc_embeddings)[0]
+            with track_stage("retrieval"):
+                # Compute embeddings
+                topic_embedding = self.model.encode(topic, convert_to_tensor=True)
+                doc_embeddings = self.model.encode(extracted_text, convert_to_tensor=True)
+                
+                # Compute similarity scores
+                similarity_scores = util.pytorch_cos_sim(topic_embedding, doc_embeddings)[0]
             
             # Get top 5 matches
             top_indices = np.argsort(similarity_scores.cpu().numpy())[::-1][:5]
@@ -0,0 +1,144 @@
+import logging
+from typing import List, Optional, Tuple
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+logger = logging.getLogger(__name__)
+
+# Characters that show up when Phi-2 drifts into code or markdown
+CODE_MARKERS = ["```", "`", "*", "_", "#", "{", "}", "[", "]", "<", ">", "=", "\\", "|", "::"]
+SENTENCE_ENDINGS = (".", "!", "?")
+
+
+class TokenMaskLogitsProcessor(LogitsProcessor):
+    """Sets the score of every banned token id to -inf at each decoding step."""
+
+    def __init__(self, banned_token_ids: List[int]):
+        self.banned_token_ids = sorted(set(banned_token_ids))
+        self._mask = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self._mask is None or self._mask.shape[-1] != scores.shape[-1] or self._mask.device != scores.device:
+            mask = torch.zeros(scores.shape[-1], dtype=torch.bool, device=scores.device)
+            ids = [i for i in self.banned_token_ids if i < scores.shape[-1]]
+            mask[ids] = True
+            self._mask = mask
+        return scores.masked_fill(self._mask, float("-inf"))
+
+
+class MinSentencesLogitsProcessor(LogitsProcessor):
+    """Blocks the EOS token until the generated text holds enough sentences and words."""
+
+    def __init__(self, tokenizer, prompt_length: int, eos_token_id: int,
+                 min_sentences: int = 0, min_words: int = 0):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.eos_token_id = eos_token_id
+        self.min_sentences = min_sentences
+        self.min_words = min_words
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for row in range(input_ids.shape[0]):
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+            sentences, words = count_sentences_and_words(text)
+            if sentences < self.min_sentences or words < self.min_words:
+                scores[row, self.eos_token_id] = float("-inf")
+        return scores
+
+
+class SentenceWordStoppingCriteria(StoppingCriteria):
+    """
+    Stops a sequence at the first sentence boundary once both the minimum
+    sentence and word counts are met, or as soon as max_words is exceeded.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, min_sentences: int = 1,
+                 min_words: int = 0, max_words: Optional[int] = None):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.min_sentences = min_sentences
+        self.min_words = min_words
+        self.max_words = max_words
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = []
+        for row in range(input_ids.shape[0]):
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True).strip()
+            sentences, words = count_sentences_and_words(text)
+            at_boundary = text.endswith(SENTENCE_ENDINGS)
+            done.append(
+                (at_boundary and sentences >= self.min_sentences and words >= self.min_words)
+                or (self.max_words is not None and words > self.max_words)
+            )
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def count_sentences_and_words(text: str) -> Tuple[int, int]:
+    """Counts complete sentences and words the same way genNewScript validates them."""
+    sentences = sum(text.count(end) for end in SENTENCE_ENDINGS)
+    return sentences, len(text.split())
+
+
+class DecodingConstraints:
+    """
+    Precomputes the banned token ids for a tokenizer so that outputs the
+    controllers would reject (useless words, digits, code markers) are never
+    sampled in the first place.
+    """
+
+    def __init__(self, tokenizer, banned_words: List[str]):
+        self.tokenizer = tokenizer
+        markers = [w for w in banned_words if not w.isalnum()] + CODE_MARKERS
+        words = [w for w in banned_words if w.isalpha()]
+
+        # Every vocabulary entry containing a banned word, digit or marker
+        banned_ids = []
+        for token_id in range(len(tokenizer)):
+            piece = tokenizer.decode([token_id])
+            if (any(ch.isdigit() for ch in piece)
+                    or any(m in piece for m in markers)
+                    or any(w in piece for w in words)):
+                banned_ids.append(token_id)
+
+        special_ids = set(tokenizer.all_special_ids)
+        self.banned_token_ids = [i for i in banned_ids if i not in special_ids]
+
+        # Words that only appear as multi-token sequences are banned via bad_words_ids
+        self.bad_words_ids = []
+        for word in words:
+            for variant in (word, " " + word):
+                ids = tokenizer.encode(variant, add_special_tokens=False)
+                if len(ids) > 1:
+                    self.bad_words_ids.append(ids)
+
+        logger.info(f"Decoding constraints: {len(self.banned_token_ids)} banned tokens, "
+                    f"{len(self.bad_words_ids)} banned sequences")
+
+    def story_constraints(self, prompt_length: int, min_sentences: int = 5,
+                          min_words: int = 100, max_words: int = 150
+                          ) -> Tuple[LogitsProcessorList, StoppingCriteriaList]:
+        """Processors and stopping criteria for genNewScript narratives."""
+        processors = LogitsProcessorList([
+            TokenMaskLogitsProcessor(self.banned_token_ids),
+            MinSentencesLogitsProcessor(self.tokenizer, prompt_length, self.tokenizer.eos_token_id,
+                                        min_sentences=min_sentences, min_words=min_words),
+        ])
+        stopping = StoppingCriteriaList([
+            SentenceWordStoppingCriteria(self.tokenizer, prompt_length, min_sentences=min_sentences,
+                                         min_words=min_words, max_words=max_words),
+        ])
+        return processors, stopping
+
+    def prompt_constraints(self, prompt_length: int, min_words: int = 15,
+                           max_words: int = 30) -> Tuple[LogitsProcessorList, StoppingCriteriaList]:
+        """Processors and stopping criteria for single-sentence image prompts."""
+        processors = LogitsProcessorList([
+            TokenMaskLogitsProcessor(self.banned_token_ids),
+            MinSentencesLogitsProcessor(self.tokenizer, prompt_length, self.tokenizer.eos_token_id,
+                                        min_words=min_words),
+        ])
+        stopping = StoppingCriteriaList([
+            SentenceWordStoppingCriteria(self.tokenizer, prompt_length, min_sentences=1,
+                                         min_words=min_words, max_words=max_words),
+        ])
+        return processors, stopping
@@ -0,0 +1,291 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Optional
+import torch
+from transformers import (
+    LogitsProcessorList,
+    MinNewTokensLengthLogitsProcessor,
+    NoBadWordsLogitsProcessor,
+    NoRepeatNGramLogitsProcessor,
+    RepetitionPenaltyLogitsProcessor,
+    StoppingCriteriaList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+from transformers.cache_utils import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+# generate() arguments that have no meaning for single-sequence sampling
+IGNORED_KWARGS = ("min_length", "max_length", "length_penalty", "pad_token_id", "token_type_ids")
+
+
+class GenerationRequest:
+    """One sequence waiting for, or taking part in, a shared decode batch."""
+
+    def __init__(self, input_ids: torch.LongTensor, processors: LogitsProcessorList,
+                 stopping: StoppingCriteriaList, max_new_tokens: int, do_sample: bool,
+                 eos_token_id: Optional[int], streamer=None):
+        self.tokens = input_ids
+        self.prompt_length = input_ids.shape[0]
+        self.processors = processors
+        self.stopping = stopping
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.eos_token_id = eos_token_id
+        self.streamer = streamer
+        self.future = Future()
+        # Logits the next token is sampled from (from prefill or the last batched step)
+        self.next_logits = None
+
+    @property
+    def new_tokens(self) -> int:
+        return self.tokens.shape[0] - self.prompt_length
+
+
+class GenerationScheduler:
+    """
+    Continuous-batching decoder shared by every thread that calls generate().
+
+    Requests are queued from any thread and merged into one running batch:
+    each new request is prefilled on its own, its KV cache is left-padded to
+    the batch length and joined to the batch, then all sequences advance one
+    token per forward pass. Sampling and stopping are evaluated per
+    sequence, finished sequences leave the batch immediately and their
+    caller is unblocked with the same output generate() would return.
+
+    Only PyTorch models are supported; the KV cache of stateful OpenVINO
+    models lives inside the compiled graph and cannot be merged.
+    """
+
+    def __init__(self, model, pad_token_id: int, max_batch_size: int = 8):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.max_batch_size = max_batch_size
+        self.requests = queue.Queue()
+
+        self.active: List[GenerationRequest] = []
+        self.past = None          # legacy cache: per layer (key, value) of shape [B, H, T, D]
+        self.attention_mask = None
+
+        self.closed = False
+        self.thread = threading.Thread(target=self._loop, name="generation-scheduler", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Stops the decode thread once the running batch has drained."""
+        self.closed = True
+        self.requests.put(None)
+
+    def generate(self, input_ids: torch.LongTensor, attention_mask: Optional[torch.Tensor] = None,
+                 num_return_sequences: int = 1, **kwargs) -> torch.LongTensor:
+        """
+        Blocking drop-in for model.generate() for a single prompt. Returns
+        [num_return_sequences, length] token ids right-padded with pad_token_id.
+        """
+        if input_ids.shape[0] != 1:
+            raise ValueError("GenerationScheduler.generate takes one prompt at a time")
+
+        prompt = input_ids[0]
+        if attention_mask is not None:
+            prompt = prompt[attention_mask[0].bool()]
+        prompt = prompt.to(self.model.device)
+
+        requests = [self._build_request(prompt, dict(kwargs)) for _ in range(num_return_sequences)]
+        for request in requests:
+            self.requests.put(request)
+
+        outputs = [request.future.result() for request in requests]
+        length = max(o.shape[0] for o in outputs)
+        padded = torch.full((len(outputs), length), self.pad_token_id, dtype=torch.long)
+        for row, output in enumerate(outputs):
+            padded[row, :output.shape[0]] = output
+        return padded
+
+    def _build_request(self, prompt: torch.LongTensor, kwargs: dict) -> GenerationRequest:
+        """Translates generate() keyword arguments into per-sequence processors."""
+        for key in IGNORED_KWARGS:
+            kwargs.pop(key, None)
+
+        eos_token_id = kwargs.pop("eos_token_id", None)
+        if eos_token_id is None:
+            eos_token_id = self.model.generation_config.eos_token_id
+        max_new_tokens = kwargs.pop("max_new_tokens", 20)
+        do_sample = kwargs.pop("do_sample", False)
+        streamer = kwargs.pop("streamer", None)
+
+        processors = LogitsProcessorList()
+        min_new_tokens = kwargs.pop("min_new_tokens", None)
+        if min_new_tokens and eos_token_id is not None:
+            processors.append(MinNewTokensLengthLogitsProcessor(prompt.shape[0], min_new_tokens, eos_token_id))
+        repetition_penalty = kwargs.pop("repetition_penalty", None)
+        if repetition_penalty and repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        no_repeat_ngram_size = kwargs.pop("no_repeat_ngram_size", None)
+        if no_repeat_ngram_size:
+            processors.append(NoRepeatNGramLogitsProcessor(no_repeat_ngram_size))
+        bad_words_ids = kwargs.pop("bad_words_ids", None)
+        if bad_words_ids:
+            processors.append(NoBadWordsLogitsProcessor(bad_words_ids, eos_token_id))
+        processors.extend(kwargs.pop("logits_processor", None) or [])
+
+        temperature = kwargs.pop("temperature", None)
+        top_k = kwargs.pop("top_k", None)
+        top_p = kwargs.pop("top_p", None)
+        if do_sample:
+            if temperature and temperature != 1.0:
+                processors.append(TemperatureLogitsWarper(temperature))
+            if top_k:
+                processors.append(TopKLogitsWarper(top_k))
+            if top_p and top_p < 1.0:
+                processors.append(TopPLogitsWarper(top_p))
+
+        stopping = StoppingCriteriaList(kwargs.pop("stopping_criteria", None) or [])
+        if kwargs:
+            raise ValueError(f"Unsupported generate() arguments for batched decoding: {list(kwargs)}")
+
+        return GenerationRequest(prompt, processors, stopping, max_new_tokens, do_sample, eos_token_id, streamer)
+
+    def _loop(self):
+        while not (self.closed and not self.active and self.requests.empty()):
+            try:
+                with torch.inference_mode():
+                    self._step()
+            except Exception as e:
+                logger.error(f"Generation scheduler step failed: {str(e)}")
+                for request in self.active:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                    if request.streamer is not None:
+                        request.streamer.end()
+                self.active, self.past, self.attention_mask = [], None, None
+
+    def _step(self):
+        # Block while idle, otherwise only take what is already waiting
+        if not self.active:
+            request = self.requests.get()
+            if request is None:
+                return
+            self._admit(request)
+        while len(self.active) < self.max_batch_size:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                self._admit(request)
+        if not self.active:
+            return
+
+        # Sample one token for every sequence and retire the finished ones
+        keep = []
+        for row, request in enumerate(self.active):
+            if self._sample(request):
+                self._finish(request)
+            else:
+                keep.append(row)
+
+        if len(keep) != len(self.active):
+            self.active = [self.active[row] for row in keep]
+            if not keep:
+                self.past, self.attention_mask = None, None
+                return
+            index = torch.tensor(keep, device=self.attention_mask.device)
+            self.past = tuple((k.index_select(0, index), v.index_select(0, index)) for k, v in self.past)
+            self.attention_mask = self.attention_mask.index_select(0, index)
+            # Padding that only the retired rows needed would otherwise be attended over on every step
+            start = int(self.attention_mask.any(dim=0).int().argmax())
+            if start > 0:
+                self.past = tuple((k[:, :, start:], v[:, :, start:]) for k, v in self.past)
+                self.attention_mask = self.attention_mask[:, start:]
+
+        # One forward pass advances the whole batch
+        last_tokens = torch.stack([request.tokens[-1:] for request in self.active])
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones((len(self.active), 1))], dim=1
+        )
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True) - 1
+        outputs = self.model(
+            input_ids=last_tokens,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(self.past),
+            use_cache=True,
+        )
+        self.past = _to_legacy(outputs.past_key_values)
+        for row, request in enumerate(self.active):
+            request.next_logits = outputs.logits[row, -1:, :].float()
+
+    def _admit(self, request: GenerationRequest):
+        """
+        Prefills a new request and joins its KV cache to the running batch.
+        If the prefill fails only this request fails; the batch is untouched.
+        """
+        try:
+            outputs = self.model(input_ids=request.tokens[None], use_cache=True)
+            next_logits = outputs.logits[:, -1, :].float()
+            past = _to_legacy(outputs.past_key_values)
+            mask = torch.ones((1, request.prompt_length), dtype=torch.long, device=request.tokens.device)
+            if self.past is None:
+                joined_past, joined_mask = past, mask
+            else:
+                length = max(self.attention_mask.shape[1], mask.shape[1])
+                joined_past = tuple(
+                    (torch.cat([_left_pad(k, length), _left_pad(nk, length)]),
+                     torch.cat([_left_pad(v, length), _left_pad(nv, length)]))
+                    for (k, v), (nk, nv) in zip(self.past, past)
+                )
+                joined_mask = torch.cat([_left_pad(self.attention_mask, length), _left_pad(mask, length)])
+        except Exception as e:
+            logger.error(f"Generation scheduler prefill failed: {str(e)}")
+            request.future.set_exception(e)
+            if request.streamer is not None:
+                request.streamer.end()
+            return
+
+        request.next_logits = next_logits
+        if request.streamer is not None:
+            request.streamer.put(request.tokens[None].cpu())
+        self.past, self.attention_mask = joined_past, joined_mask
+        self.active.append(request)
+
+    def _sample(self, request: GenerationRequest) -> bool:
+        """Appends the next token to the request and returns True once it is finished."""
+        ids = request.tokens[None]
+        scores = request.processors(ids, request.next_logits)
+        if request.do_sample:
+            token = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)[0]
+        else:
+            token = scores.argmax(dim=-1)
+        request.tokens = torch.cat([request.tokens, token])
+        if request.streamer is not None:
+            request.streamer.put(token.cpu())
+
+        if request.eos_token_id is not None and token.item() == request.eos_token_id:
+            return True
+        if request.new_tokens >= request.max_new_tokens:
+            return True
+        return bool(request.stopping and request.stopping(request.tokens[None], scores).all())
+
+    def _finish(self, request: GenerationRequest):
+        if request.streamer is not None:
+            request.streamer.end()
+        request.future.set_result(request.tokens.cpu())
+
+
+def _to_legacy(past):
+    return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+
+def _left_pad(tensor: torch.Tensor, length: int) -> torch.Tensor:
+    """Left-pads the sequence dimension (dim 2 for KV tensors, dim 1 for masks) with zeros."""
+    dim = 2 if tensor.dim() == 4 else 1
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
@@ -0,0 +1,228 @@
+import gc
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import psutil
+
+from app.utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class ModelEntry:
+    def __init__(self, name: str, loader: Callable, pinned: bool = False):
+        self.name = name
+        self.loader = loader
+        self.pinned = pinned
+        self.instance = None
+        self.size_mb = 0.0
+        self.last_used = 0.0
+        self.in_use = 0
+        self.loads = 0
+        self.load_lock = threading.Lock()
+
+
+class ModelRegistry:
+    """
+    Loads models on demand and keeps their combined resident memory under
+    a configurable cap (MODEL_MEMORY_LIMIT_MB, 0 means unlimited).
+
+    The resident size of each model is measured as the RSS growth while it
+    loads. When a load would exceed the cap, idle models are unloaded in
+    least-recently-used order; models that are in use or pinned are never
+    evicted. Models idle for longer than MODEL_IDLE_TIMEOUT seconds are
+    unloaded by a background reaper and reloaded on their next use.
+    """
+
+    def __init__(self, memory_limit_mb: Optional[float] = None, idle_timeout: Optional[float] = None):
+        self.memory_limit_mb = memory_limit_mb if memory_limit_mb is not None else float(os.getenv("MODEL_MEMORY_LIMIT_MB", "0"))
+        self.idle_timeout = idle_timeout if idle_timeout is not None else float(os.getenv("MODEL_IDLE_TIMEOUT", "0"))
+        self._entries: Dict[str, ModelEntry] = {}
+        self._lock = threading.RLock()
+        self._reaper = None
+
+    def register(self, name: str, loader: Callable, pinned: bool = False):
+        """Registers a zero-argument loader that builds the model instance."""
+        self._entries[name] = ModelEntry(name, loader, pinned)
+
+    def names(self) -> List[str]:
+        return list(self._entries)
+
+    def proxy(self, name: str) -> "ModelProxy":
+        return ModelProxy(self, name)
+
+    def get(self, name: str):
+        """Returns the model instance, loading it (and evicting others) if needed."""
+        entry = self._entries[name]
+        with entry.load_lock:
+            if entry.instance is None:
+                self._load(entry)
+        entry.last_used = time.monotonic()
+        return entry.instance
+
+    @contextmanager
+    def acquire(self, name: str):
+        """Marks the model as in use for the duration of the block so it cannot be evicted."""
+        entry = self._entries[name]
+        with self._lock:
+            entry.in_use += 1
+        try:
+            yield self.get(name)
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+
+    def preload(self, names: Optional[List[str]] = None):
+        for name in names or self.names():
+            self.get(name)
+
+    def warm_up(self, names: Optional[List[str]] = None):
+        """Loads the models and runs their warm_up() hook, if they have one."""
+        for name in names or self.names():
+            instance = self.get(name)
+            if hasattr(instance, "warm_up"):
+                start = time.perf_counter()
+                instance.warm_up()
+                logger.info(f"Warmed up model {name} in {time.perf_counter() - start:.1f}s")
+
+    def after_fork(self):
+        """
+        Resets per-process state in a forked worker: locks and the idle
+        reaper thread are not inherited usefully, and models with an
+        after_fork() hook restart their own threads.
+        """
+        self._lock = threading.RLock()
+        self._reaper = None
+        for entry in self._entries.values():
+            entry.load_lock = threading.Lock()
+            entry.in_use = 0
+            if entry.instance is not None and hasattr(entry.instance, "after_fork"):
+                entry.instance.after_fork()
+
+    def unload(self, name: str) -> bool:
+        """Drops the model instance so its memory can be reclaimed. Returns False if it is busy."""
+        entry = self._entries[name]
+        with self._lock:
+            if entry.instance is None or entry.in_use:
+                return False
+            instance, entry.instance = entry.instance, None
+
+        if hasattr(instance, "close"):
+            instance.close()
+        del instance
+        gc.collect()
+        if "torch" in sys.modules:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        logger.info(f"Unloaded model {name} ({entry.size_mb:.0f} MB)")
+        return True
+
+    def resident_mb(self) -> float:
+        return sum(e.size_mb for e in self._entries.values() if e.instance is not None)
+
+    def resident(self) -> List[Dict]:
+        """Describes every registered model and whether it is currently loaded."""
+        now = time.monotonic()
+        return [
+            {
+                "name": e.name,
+                "resident": e.instance is not None,
+                "size_mb": round(e.size_mb, 1),
+                "in_use": e.in_use,
+                "pinned": e.pinned,
+                "loads": e.loads,
+                "idle_seconds": round(now - e.last_used, 1) if e.instance is not None else None,
+            }
+            for e in self._entries.values()
+        ]
+
+    def _load(self, entry: ModelEntry):
+        # Make room using the size measured on a previous load, if any
+        self._evict_for(entry.size_mb, exclude=entry.name)
+
+        process = psutil.Process()
+        gc.collect()
+        rss_before = process.memory_info().rss
+        start = time.perf_counter()
+        instance = entry.loader()
+        entry.size_mb = max(process.memory_info().rss - rss_before, 0) / (1024 * 1024)
+        entry.instance = instance
+        entry.loads += 1
+        logger.info(f"Loaded model {entry.name} ({entry.size_mb:.0f} MB) in {time.perf_counter() - start:.1f}s")
+
+        # First loads are only measured afterwards
+        self._evict_for(0, exclude=entry.name)
+
+    def _evict_for(self, incoming_mb: float, exclude: str):
+        if not self.memory_limit_mb:
+            return
+        with self._lock:
+            candidates = sorted(
+                (e for e in self._entries.values()
+                 if e.instance is not None and not e.in_use and not e.pinned and e.name != exclude),
+                key=lambda e: e.last_used
+            )
+        for entry in candidates:
+            if self.resident_mb() + incoming_mb <= self.memory_limit_mb:
+                break
+            self.unload(entry.name)
+        if self.resident_mb() + incoming_mb > self.memory_limit_mb:
+            logger.warning(
+                f"Model memory {self.resident_mb() + incoming_mb:.0f} MB exceeds the "
+                f"{self.memory_limit_mb:.0f} MB cap; remaining models are busy or pinned"
+            )
+
+    def start_idle_reaper(self, interval: float = 30.0):
+        """Starts a daemon thread that unloads models idle for longer than idle_timeout."""
+        if not self.idle_timeout or self._reaper is not None:
+            return
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                now = time.monotonic()
+                for entry in list(self._entries.values()):
+                    if (entry.instance is not None and not entry.in_use and not entry.pinned
+                            and now - entry.last_used > self.idle_timeout):
+                        self.unload(entry.name)
+
+        self._reaper = threading.Thread(target=reap, name="model-idle-reaper", daemon=True)
+        self._reaper.start()
+
+
+class ModelProxy:
+    """
+    Stands in for a registered model in app.config. Method calls load the
+    model on demand and hold it in use until they return (or, for
+    generators, until they are exhausted).
+    """
+
+    def __init__(self, registry: ModelRegistry, name: str):
+        self._registry = registry
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._registry.get(self._name), attr)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            with span(f"{self._name}.{attr}"), self._registry.acquire(self._name) as instance:
+                result = getattr(instance, attr)(*args, **kwargs)
+            if inspect.isgenerator(result):
+                return self._hold(result)
+            return result
+
+        return call
+
+    def _hold(self, generator):
+        with self._registry.acquire(self._name):
+            yield from generator
@@ -1,15 +1,20 @@
 import logging
-from typing import Dict, Optional, Union, List
+import os
+import time
+from typing import Dict, Iterator, Optional, Union, List
+from threading import Thread
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
 from sentence_transformers import SentenceTransformer
 from sklearn.metrics.pairwise import cosine_similarity
 from app.utils.subjectExtractor import extract_subject
+from app.utils.uselessWords import useless_words
+from app.models.decodingConstraints import DecodingConstraints
+from app.models.generationScheduler import GenerationScheduler
+from app.models.speculativeDecoding import SpeculativeStats, load_draft_model
+from app.utils.metrics import record_tokens, track_stage
+from app.utils.tracing import propagate
 import re
-from langchain.llms import HuggingFacePipeline
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from transformers import pipeline
 
 # pip install torch==2.5.1+cu121 torchvision torchaudio --index-url https://download.pytorch.org/whl/cu121
 # As per colab configuration, the torch version is 1.9.0+cu102
@@ -20,41 +25,78 @@ from transformers import pipeline
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Text-generation backends selectable with PHI2_BACKEND
+BACKENDS = ("torch", "openvino")
+
 class Phi2Generator:
     def __init__(self, 
                  model_name: str = "microsoft/phi-2",
                  embedding_model: str = 'sentence-transformers/all-mpnet-base-v2',
-                 device: Optional[str] = None):
+                 device: Optional[str] = None,
+                 backend: Optional[str] = None,
+                 weight_format: Optional[str] = None,
+                 batching: Optional[bool] = None,
+                 max_batch_size: Optional[int] = None,
+                 draft_model_name: Optional[str] = None):
         try:
-            self.device = device if device else ("cuda" if torch.cuda.is_available() else "cpu")
+            self.backend = backend or os.getenv("PHI2_BACKEND", "torch")
+            if self.backend not in BACKENDS:
+                raise ValueError(f"Unknown Phi-2 backend '{self.backend}'. Choose from {BACKENDS}")
+
+            # OpenVINO models are compiled for the CPU plugin
+            if self.backend == "openvino":
+                self.device = "cpu"
+            else:
+                self.device = device if device else ("cuda" if torch.cuda.is_available() else "cpu")
             logger.info(f"Using device: {self.device}")
 
-            logger.info(f"Loading Phi-2 model: {model_name}")
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                trust_remote_code=True
-            )
+            logger.info(f"Loading Phi-2 model: {model_name} ({self.backend} backend)")
+            self.model = self._load_model(model_name, weight_format)
             logger.info("Model loaded, starting tokenizer...")
             self.tokenizer = AutoTokenizer.from_pretrained(model_name)
 
-            logger.info(f"Loading embedding model: {embedding_model}")
-            self.encoder = SentenceTransformer(embedding_model)
+            # The embedding model is only needed for relevance scoring, load it on first use
+            self.embedding_model = embedding_model
+            self._encoder = None
 
-            self.model = self.model.to(self.device)
+            if self.backend == "torch":
+                self.model = self.model.to(self.device)
 
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
 
-            self.pipe = pipeline(
-                "text-generation",
-                model=self.model,
-                tokenizer=self.tokenizer,
-                max_new_tokens=150,
-                do_sample=True,
-                temperature=0.7
-            )
-            self.llm = HuggingFacePipeline(pipeline=self.pipe)
+            # Token bans and stopping rules shared by all constrained generations
+            self.constraints = DecodingConstraints(self.tokenizer, useless_words)
+
+            # Merge concurrent requests into shared decode steps (PyTorch backend only)
+            if batching is None:
+                batching = os.getenv("PHI2_BATCHING", "0") == "1"
+            self.scheduler = None
+            if batching and self.backend == "torch":
+                self.scheduler = GenerationScheduler(
+                    self.model,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    max_batch_size=max_batch_size or int(os.getenv("PHI2_MAX_BATCH", "8"))
+                )
+            elif batching:
+                logger.warning(f"Continuous batching is not supported on the {self.backend} backend")
+
+            # Optional speculative decoding with a small draft model sharing the tokenizer
+            draft_model_name = draft_model_name or os.getenv("PHI2_DRAFT_MODEL")
+            self.draft_model = None
+            self.speculative_stats = None
+            if draft_model_name and self.backend == "torch":
+                logger.info(f"Loading draft model: {draft_model_name}")
+                self.draft_model = load_draft_model(
+                    draft_model_name,
+                    self.tokenizer,
+                    self.device,
+                    num_assistant_tokens=int(os.getenv("PHI2_DRAFT_TOKENS", "5")),
+                    schedule=os.getenv("PHI2_DRAFT_SCHEDULE", "heuristic")
+                )
+                self.speculative_stats = SpeculativeStats(self.model, self.draft_model)
+            elif draft_model_name:
+                logger.warning(f"Speculative decoding is not supported on the {self.backend} backend")
 
             # Initialize LangChain components
             # self._setup_chains()
@@ -65,6 +107,104 @@ class Phi2Generator:
             logger.error(f"Error initializing Phi2Generator: {str(e)}")
             raise
 
+    def _load_model(self, model_name: str, weight_format: Optional[str] = None):
+        """
+        Loads the causal LM for the selected backend. Both backends expose the
+        same generate() interface, so the generation methods are shared.
+
+        The OpenVINO backend exports Phi-2 through optimum-intel with int8 or
+        int4 weight compression (PHI2_OV_WEIGHTS). Point PHI2_OV_MODEL at a
+        previously exported directory to skip the export on startup.
+        """
+        if self.backend == "openvino":
+            from optimum.intel import OVModelForCausalLM, OVWeightQuantizationConfig
+
+            exported_path = os.getenv("PHI2_OV_MODEL")
+            if exported_path and os.path.isdir(exported_path):
+                return OVModelForCausalLM.from_pretrained(exported_path, ov_config={"CACHE_DIR": ""})
+
+            weight_format = weight_format or os.getenv("PHI2_OV_WEIGHTS", "int8")
+            bits = {"int8": 8, "int4": 4}.get(weight_format)
+            if bits is None:
+                raise ValueError(f"Unsupported OpenVINO weight format '{weight_format}'. Use int8 or int4")
+
+            model = OVModelForCausalLM.from_pretrained(
+                model_name,
+                export=True,
+                quantization_config=OVWeightQuantizationConfig(bits=bits),
+                ov_config={"CACHE_DIR": ""},
+                trust_remote_code=True
+            )
+            if exported_path:
+                model.save_pretrained(exported_path)
+            return model
+
+        return AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+            trust_remote_code=True
+        )
+
+    def generate(self, **kwargs):
+        """
+        Routes a generate() call to assisted generation when a draft model is
+        loaded (single sequences only), then to the batching scheduler when
+        it is enabled, otherwise straight to the model.
+        """
+        start = time.perf_counter()
+        with track_stage("llm_generate"):
+            if self.draft_model is not None and kwargs.get("num_return_sequences", 1) == 1:
+                outputs = self._assisted_generate(**kwargs)
+            elif self.scheduler is not None:
+                outputs = self.scheduler.generate(**kwargs)
+            else:
+                outputs = self.model.generate(**kwargs)
+        new_tokens = (outputs.shape[1] - kwargs["input_ids"].shape[1]) * outputs.shape[0]
+        record_tokens(new_tokens, time.perf_counter() - start)
+        return outputs
+
+    def _assisted_generate(self, **kwargs):
+        """Speculative decoding: the draft model proposes, Phi-2 verifies in one pass."""
+        self.speculative_stats.start()
+        new_tokens = 0
+        try:
+            outputs = self.model.generate(assistant_model=self.draft_model, **kwargs)
+            new_tokens = outputs.shape[1] - kwargs["input_ids"].shape[1]
+            return outputs
+        finally:
+            self.speculative_stats.stop(new_tokens)
+
+    def get_speculative_stats(self) -> Dict[str, float]:
+        """Draft acceptance metrics, or an empty dict when speculative decoding is off."""
+        return self.speculative_stats.snapshot() if self.speculative_stats else {}
+
+    @property
+    def encoder(self) -> SentenceTransformer:
+        if self._encoder is None:
+            logger.info(f"Loading embedding model: {self.embedding_model}")
+            self._encoder = SentenceTransformer(self.embedding_model)
+        return self._encoder
+
+    def warm_up(self):
+        """Runs one short generation so lazy initialisation happens before serving."""
+        encoded = self.tokenizer("Once upon a time", return_tensors="pt").to(self.device)
+        self.model.generate(**encoded, max_new_tokens=2, pad_token_id=self.tokenizer.pad_token_id)
+
+    def after_fork(self):
+        """Restarts the batching thread in a forked worker, threads do not survive fork()."""
+        if self.scheduler is not None:
+            self.scheduler = GenerationScheduler(
+                self.model,
+                pad_token_id=self.scheduler.pad_token_id,
+                max_batch_size=self.scheduler.max_batch_size
+            )
+
+    def close(self):
+        """Stops the batching scheduler so the model can be released."""
+        if self.scheduler is not None:
+            self.scheduler.close()
+            self.scheduler = None
+
     def get_context_relevance(self, text: str, context: str) -> float:
         """
         Compute the similarity between query and context.
@@ -73,135 +213,170 @@ class Phi2Generator:
         similarity = cosine_similarity([embeddings[0]], [embeddings[1]])[0][0]
         return similarity
     
-    def generate_with_custom_instructions(
+    def _story_generation_kwargs(
         self,
         context: str,
         query: str,
-        style_guide:str="Historical",
-        words_per_sentence: int = 15,
-        temperature: float = 0.9,
-    ) -> Dict[str, Union[str, float]]:
-        try:
-            # Set absolute minimum and maximum token limits
-            MIN_CONTEXT_LENGTH = 50
-            MAX_NEW_TOKENS = 200
-            TOTAL_MAX_LENGTH = 2048
-            TARGET_WORDS = 125
-            
-            # Ensure inputs are strings
-            context = str(context) if context is not None else ""
-            query = str(query) if query is not None else ""
-
-            style_map = {
-                "Historical": "Provide a historical account of",
-                "Biography": "Write an inspiring biography of",
-                "Cinematic": "Write a cinematic narration of"
-            }
-            
-            # Get the appropriate style instruction or use default if style not found
-            style_instruction = style_map.get(style_guide, "Provide a historical account of")
-            
-            # Prepare the base prompt template with emphasis on narrative flow
-            sentence_instruction = (f"\nImportant: Write in a clear narrative style using approximately {words_per_sentence} words per sentence. Your response MUST be between 100-150 words total. Do not exceed 150 words." 
-            if words_per_sentence else 
-                "\nImportant: Write in a clear narrative style. Your response MUST be between 100-150 words total. Do not exceed 150 words.")
-            # base_prompt = """Based on this context:
-            # {context}
-
-            # {style_instruction} {query}{instruction}
-            
-            # Focus on creating a flowing story with clear progression and connections between ideas. Each sentence should naturally lead to the next, maintaining narrative coherence while being concise and informative.
-            # Count your total words carefully before submitting. If your narrative exceeds 150 words, revise it to fit within the 100-150 word limit while preserving the most important information.
-            # Narrative:"""
-            base_prompt = """Based on the following context:
+        style_guide: str,
+        words_per_sentence: int,
+        temperature: float,
+        constrained: bool
+    ) -> Dict:
+        """Builds the prompt and the model.generate arguments for a story."""
+        # Set absolute minimum and maximum token limits
+        MIN_CONTEXT_LENGTH = 50
+        MAX_NEW_TOKENS = 200
+        TOTAL_MAX_LENGTH = 2048
+        TARGET_WORDS = 125
+        
+        # Ensure inputs are strings
+        context = str(context) if context is not None else ""
+        query = str(query) if query is not None else ""
+
+        style_map = {
+            "Historical": "Provide a historical account of",
+            "Biography": "Write an inspiring biography of",
+            "Cinematic": "Write a cinematic narration of"
+        }
+        
+        # Get the appropriate style instruction or use default if style not found
+        style_instruction = style_map.get(style_guide, "Provide a historical account of")
+        
+        # Prepare the base prompt template with emphasis on narrative flow
+        sentence_instruction = (f"\nImportant: Write in a clear narrative style using approximately {words_per_sentence} words per sentence. Your response MUST be between 100-150 words total. Do not exceed 150 words." 
+        if words_per_sentence else 
+            "\nImportant: Write in a clear narrative style. Your response MUST be between 100-150 words total. Do not exceed 150 words.")
+        # base_prompt = """Based on this context:
+        # {context}
+
+        # {style_instruction} {query}{instruction}
+        
+        # Focus on creating a flowing story with clear progression and connections between ideas. Each sentence should naturally lead to the next, maintaining narrative coherence while being concise and informative.
+        # Count your total words carefully before submitting. If your narrative exceeds 150 words, revise it to fit within the 100-150 word limit while preserving the most important information.
+        # Narrative:"""
+        base_prompt = """Based on the following context:
 {context}
 
 {style_instruction} {query}{instruction}
 
 As an expert, your task is to craft a precise, factually accurate narrative using only the provided context. Ensure your narrative reflects deep subject matter expertise and avoids any unverified details. Create a flowing story with clear progression between ideas, where each sentence naturally leads to the next while remaining concise and informative. Maintain a tone of authority and factual precision throughout. Count your total words carefully before submitting; if your narrative exceeds 150 words, revise it to fit within the 100-150 word limit while preserving the most essential information.
 Narrative:"""
-            
-            # Rest of the function remains the same...
-            context_tokens = self.tokenizer.encode(
-                context,
-                add_special_tokens=False,
-                truncation=True,
-                max_length=TOTAL_MAX_LENGTH - MAX_NEW_TOKENS
-            )
-            
-            if len(context_tokens) > (TOTAL_MAX_LENGTH - MAX_NEW_TOKENS - MIN_CONTEXT_LENGTH):
-                context_tokens = context_tokens[:TOTAL_MAX_LENGTH - MAX_NEW_TOKENS - MIN_CONTEXT_LENGTH]
-            
-            truncated_context = self.tokenizer.decode(context_tokens, skip_special_tokens=True)
-            
-            full_prompt = base_prompt.format(
-                context=truncated_context,
-                query=query,
-                instruction=sentence_instruction,
-                style_instruction=style_instruction
-            )
-            
-            encoded_input = self.tokenizer(
-                full_prompt,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,
-                max_length=TOTAL_MAX_LENGTH - MAX_NEW_TOKENS
+        
+        # Rest of the function remains the same...
+        context_tokens = self.tokenizer.encode(
+            context,
+            add_special_tokens=False,
+            truncation=True,
+            max_length=TOTAL_MAX_LENGTH - MAX_NEW_TOKENS
+        )
+        
+        if len(context_tokens) > (TOTAL_MAX_LENGTH - MAX_NEW_TOKENS - MIN_CONTEXT_LENGTH):
+            context_tokens = context_tokens[:TOTAL_MAX_LENGTH - MAX_NEW_TOKENS - MIN_CONTEXT_LENGTH]
+        
+        truncated_context = self.tokenizer.decode(context_tokens, skip_special_tokens=True)
+        
+        full_prompt = base_prompt.format(
+            context=truncated_context,
+            query=query,
+            instruction=sentence_instruction,
+            style_instruction=style_instruction
+        )
+        
+        encoded_input = self.tokenizer(
+            full_prompt,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=TOTAL_MAX_LENGTH - MAX_NEW_TOKENS
+        )
+        
+        input_ids = encoded_input["input_ids"].to(self.device)
+        attention_mask = encoded_input["attention_mask"].to(self.device)
+        
+        target_tokens = int(TARGET_WORDS * 1.3)
+
+        # Ban rejected words at decode time and stop once the story is long enough
+        constraint_kwargs = {}
+        if constrained:
+            processors, stopping = self.constraints.story_constraints(
+                prompt_length=input_ids.shape[1],
+                min_sentences=5,
+                min_words=TARGET_WORDS,
+                max_words=150
             )
-            
-            input_ids = encoded_input["input_ids"].to(self.device)
-            attention_mask = encoded_input["attention_mask"].to(self.device)
-            
-            target_tokens = int(TARGET_WORDS * 1.3)
-            
-            outputs = self.model.generate(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                max_new_tokens=target_tokens + 50,
-                min_length=int(target_tokens * 0.8),
-                max_length=int(target_tokens * 1.2),
-                temperature=temperature,
-                top_p=0.92,
-                top_k=40,
-                repetition_penalty=1.1,
-                do_sample=True,
-                pad_token_id=self.tokenizer.pad_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,
-                length_penalty=1.0
+            constraint_kwargs = {
+                "logits_processor": processors,
+                "stopping_criteria": stopping,
+                "bad_words_ids": self.constraints.bad_words_ids or None
+            }
+        
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "max_new_tokens": target_tokens + 50,
+            "min_length": int(target_tokens * 0.8),
+            "max_length": int(target_tokens * 1.2),
+            "temperature": temperature,
+            "top_p": 0.92,
+            "top_k": 40,
+            "repetition_penalty": 1.1,
+            "do_sample": True,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "eos_token_id": self.tokenizer.eos_token_id,
+            "length_penalty": 1.0,
+            **constraint_kwargs
+        }
+
+    def _finalize_story(self, story: str, query: str, context: str) -> Dict[str, Union[str, float]]:
+        """Strips prompt echoes and truncates the story to at most 150 words."""
+        if "Narrative:" in story:
+            story = story.split("Narrative:")[-1].strip()
+        story = story.replace("Context:", "").replace("Query:", "").strip()
+        
+        # relevance_score = self.get_context_relevance(query, context)
+        sentences = [s.strip() for s in story.split('.') if s.strip()]
+        avg_words = sum(len(s.split()) for s in sentences) / len(sentences) if sentences else 0
+        total_words = sum(len(s.split()) for s in sentences)
+        
+        if total_words > 150:
+            cumulative_words = 0
+            truncated_sentences = []
+            for sentence in sentences:
+                sentence_words = len(sentence.split())
+                if cumulative_words + sentence_words <= 150:
+                    truncated_sentences.append(sentence)
+                    cumulative_words += sentence_words
+                else:
+                    break
+            story = '. '.join(truncated_sentences) + '.'
+            sentences = truncated_sentences
+            total_words = cumulative_words
+        
+        return {
+            'generated_text': story,
+            # 'relevance_score': relevance_score,
+            # 'avg_words_per_sentence': avg_words,
+            # 'num_sentences': len(sentences),
+            # 'total_words': total_words
+        }
+
+    def generate_with_custom_instructions(
+        self,
+        context: str,
+        query: str,
+        style_guide:str="Historical",
+        words_per_sentence: int = 15,
+        temperature: float = 0.9,
+        constrained: bool = True,
+    ) -> Dict[str, Union[str, float]]:
+        try:
+            generation_kwargs = self._story_generation_kwargs(
+                context, query, style_guide, words_per_sentence, temperature, constrained
             )
-            
+            outputs = self.generate(**generation_kwargs)
+
             story = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            
-            if "Narrative:" in story:
-                story = story.split("Narrative:")[-1].strip()
-            story = story.replace("Context:", "").replace("Query:", "").strip()
-            
-            relevance_score = self.get_context_relevance(query, context)
-            sentences = [s.strip() for s in story.split('.') if s.strip()]
-            avg_words = sum(len(s.split()) for s in sentences) / len(sentences) if sentences else 0
-            total_words = sum(len(s.split()) for s in sentences)
-            
-            if total_words > 150:
-                cumulative_words = 0
-                truncated_sentences = []
-                for sentence in sentences:
-                    sentence_words = len(sentence.split())
-                    if cumulative_words + sentence_words <= 150:
-                        truncated_sentences.append(sentence)
-                        cumulative_words += sentence_words
-                    else:
-                        break
-                story = '. '.join(truncated_sentences) + '.'
-                sentences = truncated_sentences
-                total_words = cumulative_words
-            
-            return {
-                'generated_text': story,
-                # 'relevance_score': relevance_score,
-                # 'avg_words_per_sentence': avg_words,
-                # 'num_sentences': len(sentences),
-                # 'total_words': total_words
-            }
+            return self._finalize_story(story, query, context)
             
         except Exception as e:
             logger.error(f"Error in story generation: {str(e)}")
@@ -210,69 +385,185 @@ Narrative:"""
                 'error': str(e)
             }
     
-    def generate_concise_image_prompts(
-          self,
-          story: str,
-          style_guide: str = "cinematic, 8k",
-          max_words: int = 20,
-          temperature: float = 0.7
-      ) -> List[str]:
+    def stream_with_custom_instructions(
+        self,
+        context: str,
+        query: str,
+        style_guide: str = "Historical",
+        words_per_sentence: int = 15,
+        temperature: float = 0.9,
+        constrained: bool = True,
+    ) -> Iterator[Dict[str, Union[str, float]]]:
+        """
+        Streams the story while it is being generated.
+
+        Yields {'token': text} for every decoded chunk and a final dict with
+        'done': True and the cleaned, truncated 'generated_text'.
+        """
         try:
-            sentences = [s.strip() for s in story.split('.') if s.strip()]
-            image_prompts = []
+            generation_kwargs = self._story_generation_kwargs(
+                context, query, style_guide, words_per_sentence, temperature, constrained
+            )
+            streamer = TextIteratorStreamer(
+                self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=300
+            )
+            generation_kwargs["streamer"] = streamer
+
+            errors = []
 
-            style_map = {
-                "Historical": "vintage. antique. period.",
-                "Biography": "portrait. candid. iconic",
-                "Cinematic": "dramatic. scenic. cinematography"
+            def run_generation():
+                try:
+                    self.generate(**generation_kwargs)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    # Always stop the iterator, or a failed generation leaves the reader waiting for the timeout
+                    streamer.end()
+
+            thread = Thread(target=propagate(run_generation), daemon=True)
+            thread.start()
+
+            chunks = []
+            for text in streamer:
+                if text:
+                    chunks.append(text)
+                    yield {'token': text}
+            thread.join()
+            if errors:
+                raise errors[0]
+
+            yield {'done': True, **self._finalize_story("".join(chunks), query, context)}
+
+        except Exception as e:
+            logger.error(f"Error in story streaming: {str(e)}")
+            yield {
+                'done': True,
+                'generated_text': "Error occurred during text generation.",
+                'error': str(e)
             }
-            # Retrieve style details or default to "Cinematic"
-            style_guide = style_map.get(style_guide, "Cinematic")
 
-            # Modified system prompt that includes the complete story context.
-            system_prompt = f"""You are an expert prompt engineer for AI image generation using PHI.
+    IMAGE_PROMPT_STYLES = {
+        "Historical": "vintage. antique. period.",
+        "Biography": "portrait. candid. iconic",
+        "Cinematic": "dramatic. scenic. cinematography"
+    }
+
+    IMAGE_PROMPT_SYSTEM = """You are an expert prompt engineer for AI image generation using PHI.
 Using the complete story context provided, transform the following sentence into a vivid, detailed, and visually rich prompt that can be directly used by an image generation model.
 Incorporate any relevant character names, cultural or ethnic details, and context from the full story.
 Include specific visual details such as setting, mood, lighting, style, and key objects.
 **Important:** Retain all specific details, including proper names and key objects, exactly as mentioned in the sentence and context. Do not substitute these details with names or items from other contexts.
 Ensure the refined prompt is strictly between 20 and 30 words, and do not add any extra commentary."""
 
-            for sentence in sentences:
-                input_prompt = f"""{system_prompt}
+    def _sample_image_prompts(
+        self,
+        story: str,
+        sentence: str,
+        style_suffix: str,
+        temperature: float,
+        constrained: bool,
+        num_return_sequences: int = 1
+    ) -> List[str]:
+        """
+        Runs a single generate call for one sentence and returns
+        num_return_sequences prompts with the style suffix appended.
+        """
+        input_prompt = f"""{self.IMAGE_PROMPT_SYSTEM}
     Complete Story Context: "{story}"
     Sentence: "{sentence}"
 
     Brief image prompt:"""
 
-                inputs = self.tokenizer(
-                    input_prompt,
-                    return_tensors="pt",
-                    truncation=True,
-                    padding=True
-                ).to(self.device)
-
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=50,
-                    min_length=10,
-                    temperature=temperature,
-                    top_p=0.85,
-                    top_k=40,
-                    repetition_penalty=1.3,
-                    do_sample=True,
-                    num_return_sequences=1,
-                    no_repeat_ngram_size=2
-                )
+        inputs = self.tokenizer(
+            input_prompt,
+            return_tensors="pt",
+            truncation=True,
+            padding=True
+        ).to(self.device)
+
+        constraint_kwargs = {}
+        if constrained:
+            processors, stopping = self.constraints.prompt_constraints(
+                prompt_length=inputs["input_ids"].shape[1],
+                min_words=15,
+                max_words=30
+            )
+            constraint_kwargs = {
+                "logits_processor": processors,
+                "stopping_criteria": stopping,
+                "bad_words_ids": self.constraints.bad_words_ids or None
+            }
 
-                generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-                prompt = generated_text.split("Brief image prompt:")[-1].strip()
+        outputs = self.generate(
+            **inputs,
+            max_new_tokens=50,
+            min_length=10,
+            temperature=temperature,
+            top_p=0.85,
+            top_k=40,
+            repetition_penalty=1.3,
+            do_sample=True,
+            num_return_sequences=num_return_sequences,
+            no_repeat_ngram_size=2,
+            pad_token_id=self.tokenizer.pad_token_id,
+            **constraint_kwargs
+        )
 
-                # Append the chosen style guide to the prompt
-                prompt = f"{prompt}, {style_guide}"
-                image_prompts.append(prompt)
+        prompts = []
+        for output in outputs:
+            generated_text = self.tokenizer.decode(output, skip_special_tokens=True)
+            prompt = generated_text.split("Brief image prompt:")[-1].strip()
+
+            # Append the chosen style guide to the prompt
+            prompts.append(f"{prompt}, {style_suffix}")
+        return prompts
+
+    def generate_concise_image_prompts(
+          self,
+          story: str,
+          style_guide: str = "cinematic, 8k",
+          max_words: int = 20,
+          temperature: float = 0.7,
+          constrained: bool = True
+      ) -> List[str]:
+        try:
+            sentences = [s.strip() for s in story.split('.') if s.strip()]
+            image_prompts = []
+
+            # Retrieve style details or default to "Cinematic"
+            style_guide = self.IMAGE_PROMPT_STYLES.get(style_guide, "Cinematic")
+
+            for sentence in sentences:
+                image_prompts.extend(
+                    self._sample_image_prompts(story, sentence, style_guide, temperature, constrained)
+                )
 
             return image_prompts
 
         except Exception as e:
             print(f"Error generating image prompts: {str(e)}")
-            return []
\ No newline at end of file
+            return []
+
+    def generate_image_prompt_candidates(
+          self,
+          sentence: str,
+          style_guide: str = "cinematic, 8k",
+          num_candidates: int = 4,
+          temperature: float = 0.7,
+          constrained: bool = True
+      ) -> List[str]:
+        """
+        Samples num_candidates image prompts for a single sentence in one
+        batched generate call, so the context is encoded only once.
+        """
+        try:
+            sentence = sentence.strip()
+            style_guide = self.IMAGE_PROMPT_STYLES.get(style_guide, "Cinematic")
+            return self._sample_image_prompts(
+                sentence, sentence.rstrip('.'), style_guide, temperature, constrained,
+                num_return_sequences=num_candidates
+            )
+
+        except Exception as e:
+            print(f"Error generating image prompt candidates: {str(e)}")
+            return []
@@ -1,14 +1,37 @@
 from optimum.intel.openvino.modeling_diffusion import OVStableDiffusionXLPipeline
-from app.utils.cloudinaryUploader import upload_images_to_cloudinary
+from app.utils.cloudinaryUploader import upload_image_buffer
+from app.utils.imageEncoder import encode_image, make_thumbnail, resolve_format
+from app.utils.imageLibrary import ImageLibrary
+from app.utils.metrics import record_cache, track_stage
 from diffusers import StableDiffusionPipeline
 from diffusers import StableDiffusionXLPipeline
+import os
+import random
 import torch
+import torch.nn.functional as F
+import uuid
+
+# Preview renders: resolution divisor and steps (SDXL-turbo is usable from one step)
+PREVIEW_SCALE = int(os.getenv('IMAGE_PREVIEW_SCALE', '2'))
+PREVIEW_STEPS = int(os.getenv('IMAGE_PREVIEW_STEPS', '1'))
+# SDXL latents have 4 channels at 1/8 of the image resolution
+LATENT_CHANNELS = 4
+# Default for the per-request reuse flag
+IMAGE_REUSE = os.getenv('IMAGE_REUSE', '0') == '1'
 
 class ImageGenerator:
-    def __init__(self):
+    def __init__(self, db=None, pipeline=None, encoder=None):
         """
         Initializes the image generation pipeline with a predefined model path.
+        With a database, generated images can be reused through the image library.
+        A pipeline (any callable with the diffusers pipeline signature) and a
+        prompt encoder for the library can be passed in instead, as the
+        benchmarks do.
         """
+        self.library = ImageLibrary(db, encoder=encoder) if db is not None else None
+        if pipeline is not None:
+            self.pipeline = pipeline
+            return
         model_path = "rupeshs/sdxl-turbo-openvino-int8"
         # model_path = "rupeshs/SDXL-Lightning-2steps-openvino-int8"
         self.pipeline = OVStableDiffusionXLPipeline.from_pretrained(
@@ -45,37 +68,146 @@ class ImageGenerator:
         #     print(f"Warning: Could not enable xFormers: {e}")
         #     print("Falling back to default attention mechanism")
 
+    def _initial_latents(self, seed: int, width: int, height: int, scale: int = 1):
+        """
+        Seeded starting noise for a width x height render. Previews pool the
+        full-resolution noise down by scale (rescaled to unit variance), so a
+        preview and its final render start from the same low-frequency noise
+        and share their composition.
+        """
+        generator = torch.Generator().manual_seed(seed)
+        latents = torch.randn((1, LATENT_CHANNELS, height // 8, width // 8), generator=generator)
+        if scale > 1:
+            latents = F.avg_pool2d(latents, scale) * scale
+        return latents
+
     def generate_images(self, prompts: list, width: int = 1024, height: int = 576, 
                         num_inference_steps: int = 10, guidance_scale: float = 2.0, 
-                        output_dir: str = "./"):
+                        image_format: str = None, quality: int = None, thumbnails: bool = False,
+                        preview: bool = False, seeds: list = None, reuse: bool = None,
+                        reuse_threshold: float = None):
         
         # w --> 512, h --> 384, inf --> 3
         """
-        Generates images for a list of prompts and saves each to a file.
+        Generates images for a list of prompts, encodes them in memory and
+        uploads them straight from the buffers.
         
         :param prompts: List of text prompts to guide image generation.
         :param width: Width of the generated images.
         :param height: Height of the generated images.
         :param num_inference_steps: Number of inference steps for image generation.
         :param guidance_scale: Scale for guidance during generation.
-        :param output_dir: Directory to save the generated images.
+        :param image_format: webp, jpeg or png (defaults to IMAGE_FORMAT).
+        :param quality: Encoding quality from 1 to 100 (defaults to IMAGE_QUALITY).
+        :param thumbnails: Also upload a small thumbnail of every image.
+        :param preview: Render quickly at 1/IMAGE_PREVIEW_SCALE of width and
+                        height with IMAGE_PREVIEW_STEPS steps; finalize_images
+                        re-renders the kept ones at width x height.
+        :param seeds: One seed per prompt; random seeds are drawn if omitted.
+        :param reuse: Reuse library images of prompts at least reuse_threshold
+                      similar instead of rendering, and add new renders to the
+                      library (defaults to IMAGE_REUSE). Explicit seeds and
+                      previews always render.
+        :param reuse_threshold: Cosine similarity needed for reuse (defaults to
+                                IMAGE_REUSE_THRESHOLD).
+        :return: List of image URLs, or with thumbnails, preview or reuse a
+                 dict with the 'images', 'seeds' and optionally 'thumbnails'
+                 and 'reused' lists in the same order.
         """
-        image_paths = []
-        for idx, prompt in enumerate(prompts):
-            output_path = f"{output_dir}/image_{idx + 1}.png"
-            images = self.pipeline(
-                prompt=prompt,
-                width=width,
-                height=height,
-                num_inference_steps=num_inference_steps,
-                guidance_scale=guidance_scale,
-                # added_cond_kwargs={} if self.pipeline.config.get("requires_text_embeds", False) else None
-            ).images
+        reuse = IMAGE_REUSE if reuse is None else reuse
+        use_library = reuse and not preview and self.library is not None
+        # Finalizing a preview must keep its seed, so only fresh renders look up
+        lookup = use_library and not seeds
+        seeds = list(seeds) if seeds else [random.randrange(2 ** 32) for _ in prompts]
+        if len(seeds) != len(prompts):
+            raise ValueError("Expected one seed per prompt.")
 
-            images[0].save(output_path)
-            image_paths.append(output_path)
-            print(f"Image for prompt {idx + 1} saved to {output_path}")
-        
-        # upload images to cloudinary and obtain the urls
-        cloudinary_urls = upload_images_to_cloudinary(image_paths)
-        return cloudinary_urls
\ No newline at end of file
+        # Snap to whole latent cells, and for previews to whole pooling windows
+        scale = PREVIEW_SCALE if preview else 1
+        width -= width % (8 * scale)
+        height -= height % (8 * scale)
+        render_width, render_height = width // scale, height // scale
+        steps = PREVIEW_STEPS if preview else num_inference_steps
+        image_format = resolve_format(image_format)
+
+        embeddings = None
+        if use_library:
+            with track_stage("image_lookup"):
+                embeddings = self.library.embed(prompts)
+
+        # Unique names so concurrent requests never collide
+        batch_id = uuid.uuid4().hex[:12]
+        image_urls, thumbnail_urls, image_seeds, reused = [], [], [], []
+        for idx, (prompt, seed) in enumerate(zip(prompts, seeds)):
+            if lookup:
+                # Earlier renders of this request are in the library too
+                with track_stage("image_lookup"):
+                    match = self.library.find(embeddings[idx], width, height, image_format,
+                                              reuse_threshold, need_thumbnail=thumbnails)
+                record_cache("image_library", hit=match is not None)
+                if match is not None:
+                    image_urls.append(match['url'])
+                    image_seeds.append(match['seed'])
+                    reused.append(True)
+                    if thumbnails:
+                        thumbnail_urls.append(match['thumbnail_url'])
+                    print(f"Image for prompt {idx + 1} reused (similarity {match['similarity']:.3f})")
+                    continue
+
+            with track_stage("image_preview" if preview else "image_diffusion"):
+                images = self.pipeline(
+                    prompt=prompt,
+                    width=render_width,
+                    height=render_height,
+                    num_inference_steps=steps,
+                    guidance_scale=0.0 if preview else guidance_scale,
+                    latents=self._initial_latents(seed, width, height, scale),
+                    # added_cond_kwargs={} if self.pipeline.config.get("requires_text_embeds", False) else None
+                ).images
+
+            with track_stage("image_encode"):
+                data, ext = encode_image(images[0], image_format, quality)
+                thumbnail = make_thumbnail(images[0]) if thumbnails else None
+
+            # upload images to cloudinary and obtain the urls
+            url = upload_image_buffer(data, f"image_{batch_id}_{idx + 1}{ext}")
+            if not url:
+                continue
+            image_urls.append(url)
+            image_seeds.append(seed)
+            reused.append(False)
+            thumbnail_url = None
+            if thumbnail is not None:
+                thumb_data, thumb_ext = thumbnail
+                thumbnail_url = upload_image_buffer(thumb_data, f"thumb_{batch_id}_{idx + 1}{thumb_ext}")
+                thumbnail_urls.append(thumbnail_url)
+            print(f"Image for prompt {idx + 1} uploaded ({len(data)} bytes)")
+
+            if use_library:
+                self.library.add(prompt, embeddings[idx], url, width, height, image_format,
+                                 seed=seed, thumbnail_url=thumbnail_url or None)
+
+        if not (thumbnails or preview or reuse):
+            return image_urls
+        result = {'images': image_urls, 'seeds': image_seeds}
+        if thumbnails:
+            result['thumbnails'] = thumbnail_urls
+        if reuse:
+            result['reused'] = reused
+        return result
+
+    def finalize_images(self, prompts: list, seeds: list, width: int = 1024, height: int = 576,
+                        num_inference_steps: int = 10, guidance_scale: float = 2.0,
+                        image_format: str = None, quality: int = None, thumbnails: bool = False,
+                        reuse: bool = None):
+        """
+        Re-renders previews the user kept at full resolution, from the same
+        prompts and seeds that produced them. With reuse the renders are
+        added to the image library.
+        """
+        return self.generate_images(
+            prompts, width=width, height=height,
+            num_inference_steps=num_inference_steps, guidance_scale=guidance_scale,
+            image_format=image_format, quality=quality, thumbnails=thumbnails, seeds=seeds,
+            reuse=reuse
+        )
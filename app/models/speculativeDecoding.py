@@ -0,0 +1,75 @@
+import logging
+import threading
+from typing import Dict
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+logger = logging.getLogger(__name__)
+
+
+def load_draft_model(model_name: str, tokenizer, device: str, num_assistant_tokens: int = 5,
+                     schedule: str = "heuristic"):
+    """
+    Loads a small causal LM to draft tokens for assisted generation.
+    The draft model must share the target tokenizer's vocabulary.
+    """
+    draft_tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+        raise ValueError(f"Draft model '{model_name}' does not share the Phi-2 tokenizer vocabulary")
+
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+        trust_remote_code=True
+    ).to(device)
+    draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+    draft_model.generation_config.num_assistant_tokens_schedule = schedule
+    return draft_model
+
+
+class SpeculativeStats:
+    """
+    Counts forward passes of the target and draft models during assisted
+    generation to derive the draft acceptance rate.
+
+    Every verification pass of the target emits the accepted draft tokens
+    plus one token of its own, so accepted = new_tokens - target_passes,
+    and every draft forward pass proposes one token.
+    """
+
+    def __init__(self, target_model, draft_model):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.totals = {"calls": 0, "new_tokens": 0, "target_passes": 0, "draft_passes": 0}
+        target_model.register_forward_hook(self._hook("target_passes"))
+        draft_model.register_forward_hook(self._hook("draft_passes"))
+
+    def _hook(self, counter: str):
+        def hook(module, inputs, outputs):
+            counts = getattr(self._local, "counts", None)
+            if counts is not None:
+                counts[counter] += 1
+        return hook
+
+    def start(self):
+        self._local.counts = {"target_passes": 0, "draft_passes": 0}
+
+    def stop(self, new_tokens: int):
+        counts = self._local.counts
+        self._local.counts = None
+        with self._lock:
+            self.totals["calls"] += 1
+            self.totals["new_tokens"] += new_tokens
+            self.totals["target_passes"] += counts["target_passes"]
+            self.totals["draft_passes"] += counts["draft_passes"]
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            totals = dict(self.totals)
+        accepted = max(totals["new_tokens"] - totals["target_passes"], 0)
+        totals["accepted_tokens"] = accepted
+        totals["acceptance_rate"] = accepted / totals["draft_passes"] if totals["draft_passes"] else 0.0
+        totals["tokens_per_target_pass"] = (
+            totals["new_tokens"] / totals["target_passes"] if totals["target_passes"] else 0.0
+        )
+        return totals
@@ -1,18 +1,25 @@
-from flask import render_template, Blueprint, jsonify, request, current_app
+from flask import render_template, Blueprint, jsonify, request, current_app, Response, stream_with_context, g
 from flask_cors import CORS
-from app.controllers.scriptController import genNewScript, genImgPrompts
-from app.controllers.imageGenController import genImagefn
+from app.controllers.scriptController import genNewScript, genImgPrompts, streamNewScript
+from app.controllers.imageGenController import finalizeImagesfn, genImagefn
 from app.controllers.vectorDBcontroller import uploadDocument
 from app.controllers.voiceGenController import genAudioController
 from app.controllers.videoGenController import videoGenController
+import json
 import re
 import os
+import time
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+from app.utils.audioProcessor import AUDIO_FORMATS
 from app.utils.cloudinaryUploader import upload_audio_to_cloudinary
+from app.utils.generateVideo import OUTPUT_FORMATS, SUBTITLE_MODES, build_hls_playlist
+from app.utils.imageEncoder import EXTENSIONS as IMAGE_FORMATS
+from app.utils.metrics import REGISTRY as METRICS, HTTP_DURATION, HTTP_IN_FLIGHT
+from app.utils.tracing import RequestProfiler, finish_trace, get_trace, recent_traces, start_trace
 
 main_bp = Blueprint('main', __name__)
 CORS(main_bp)  # Allow CORS for all routes in this blueprint
@@ -25,6 +32,88 @@ CORS(main_bp)  # Allow CORS for all routes in this blueprint
 
 os.makedirs("uploads", exist_ok=True)
 
+# Each candidate is a full sampled sequence per sentence
+MAX_PROMPT_CANDIDATES = 8
+
+def imageOptionsError(bodyJson):
+    """The 400 message for bad format or quality options of the image routes, or None."""
+    image_format = bodyJson.get('format')
+    if image_format is not None and str(image_format).lower() not in (*IMAGE_FORMATS, 'jpg'):
+        return f"format must be one of {', '.join(IMAGE_FORMATS)}"
+    quality = bodyJson.get('quality')
+    if quality is not None and (type(quality) is not int or not 1 <= quality <= 100):
+        return "quality must be an integer from 1 to 100"
+    return None
+
+@main_bp.before_app_request
+def startRequestMetrics():
+    g.request_start = time.perf_counter()
+    g.request_endpoint = request.endpoint or "unknown"
+    HTTP_IN_FLIGHT.inc(endpoint=g.request_endpoint)
+
+    # Trace every request; ?profile=cprofile|sample (or X-Profile) also profiles it
+    g.trace = start_trace(f"{request.method} {request.path}", request.headers.get('X-Request-ID'))
+    g.profiler = None
+    profile = request.args.get('profile') or request.headers.get('X-Profile')
+    if profile:
+        try:
+            g.profiler = RequestProfiler(profile)
+            g.profiler.start()
+        except ValueError as e:
+            logger.warning(str(e))
+
+@main_bp.after_app_request
+def recordRequestMetrics(response):
+    if hasattr(g, 'request_start'):
+        HTTP_DURATION.observe(
+            time.perf_counter() - g.request_start,
+            endpoint=g.request_endpoint,
+            method=request.method,
+            status=response.status_code
+        )
+    if hasattr(g, 'trace'):
+        request_id = g.trace[0].request_id
+        response.headers['X-Request-ID'] = request_id
+        if g.profiler is not None:
+            response.headers['X-Trace-URL'] = f"/api/traces/{request_id}"
+        # Streamed bodies are produced after teardown, so close the request once the stream ends
+        if response.is_streamed:
+            endpoint, trace, profiler = g.pop('request_endpoint'), g.pop('trace'), g.profiler
+            response.call_on_close(lambda: finishRequest(endpoint, trace, profiler, None))
+    return response
+
+@main_bp.teardown_app_request
+def endRequestMetrics(exc):
+    if hasattr(g, 'trace'):
+        finishRequest(g.pop('request_endpoint'), g.pop('trace'), g.profiler, exc)
+
+def finishRequest(endpoint, trace, profiler, exc):
+    HTTP_IN_FLIGHT.dec(endpoint=endpoint)
+    profile = profiler.stop() if profiler is not None else None
+    finish_trace(trace, status="error" if exc else "ok", profile=profile)
+
+@main_bp.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@main_bp.route('/ready', methods=['GET'])
+def ready():
+    # serve.py clears READY until a worker has warmed up and again while it drains
+    if current_app.config.get('READY', True):
+        return jsonify({"ready": True})
+    return jsonify({"ready": False}), 503
+
+@main_bp.route('/api/traces', methods=['GET'])
+def traces():
+    return jsonify({"traces": recent_traces()})
+
+@main_bp.route('/api/traces/<request_id>', methods=['GET'])
+def traceDetail(request_id):
+    trace = get_trace(request_id)
+    if trace is None:
+        return jsonify({"error": "Trace not found"}), 404
+    return jsonify(trace)
+
 @main_bp.route('/')
 @main_bp.route('/index')
 def index():
@@ -34,6 +123,14 @@ def index():
 def newScriptRoute():
     bodyJson = request.get_json()
     userDocURL = bodyJson.get('userDocURL',None)
+    # Stream tokens as server-sent events when the client asks for it
+    if bodyJson.get('stream') or request.accept_mimetypes.best == 'text/event-stream':
+        events = streamNewScript(bodyJson,userDocURL)
+        return Response(
+            stream_with_context(events),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
     response = genNewScript(bodyJson,userDocURL)
     return response
 
@@ -41,18 +138,67 @@ def newScriptRoute():
 def newImgPrompts():
     bodyJson = request.get_json()
     print(bodyJson)
-    response = genImgPrompts(bodyJson['story'])
-    return jsonify({'prompts': response})
+    try:
+        num_candidates = int(bodyJson.get('num_candidates', os.getenv('IMAGE_PROMPT_CANDIDATES', 0)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "num_candidates must be an integer"}), 400
+    if num_candidates < 0:
+        return jsonify({"error": "num_candidates must not be negative"}), 400
+    num_candidates = min(num_candidates, MAX_PROMPT_CANDIDATES)
+    response = genImgPrompts(bodyJson['story'], num_candidates=num_candidates)
+    return jsonify(response)
 
 @main_bp.route('/api/genImage', methods=['POST'])
 def genImage():
     bodyJson = request.get_json()
+    error = imageOptionsError(bodyJson)
+    if error:
+        return jsonify({"error": error}), 400
+    reuse_threshold = bodyJson.get('reuse_threshold')
+    if reuse_threshold is not None:
+        try:
+            reuse_threshold = float(reuse_threshold)
+        except (TypeError, ValueError):
+            return jsonify({"error": "reuse_threshold must be a number"}), 400
+        if not -1 <= reuse_threshold <= 1:
+            return jsonify({"error": "reuse_threshold must be between -1 and 1"}), 400
     response = genImagefn(
         prompts=bodyJson['prompts'],
         width=bodyJson['width'],
         height=bodyJson['height'],
         num_inference_steps=bodyJson['inference_steps'],
         guidance_scale=bodyJson['guidance_scale'],
+        image_format=bodyJson.get('format'),
+        quality=bodyJson.get('quality'),
+        thumbnails=bool(bodyJson.get('thumbnails', False)),
+        preview=bool(bodyJson.get('preview', False)),
+        seeds=bodyJson.get('seeds'),
+        reuse=bodyJson.get('reuse'),
+        reuse_threshold=reuse_threshold,
+        )
+    return jsonify(response)
+
+@main_bp.route('/api/genImage/finalize', methods=['POST'])
+def finalizeImages():
+    # Prompts and seeds of the kept previews, with the full-resolution settings
+    bodyJson = request.get_json()
+    prompts, seeds = bodyJson['prompts'], bodyJson.get('seeds') or []
+    if len(seeds) != len(prompts):
+        return jsonify({"error": "Expected one seed per prompt"}), 400
+    error = imageOptionsError(bodyJson)
+    if error:
+        return jsonify({"error": error}), 400
+    response = finalizeImagesfn(
+        prompts=prompts,
+        seeds=seeds,
+        width=bodyJson.get('width', 1024),
+        height=bodyJson.get('height', 576),
+        num_inference_steps=bodyJson.get('inference_steps', 10),
+        guidance_scale=bodyJson.get('guidance_scale', 2.0),
+        image_format=bodyJson.get('format'),
+        quality=bodyJson.get('quality'),
+        thumbnails=bool(bodyJson.get('thumbnails', False)),
+        reuse=bodyJson.get('reuse'),
         )
     return jsonify(response)
 
@@ -75,13 +221,16 @@ def genAudio():
         texts = bodyJson.get('texts')
         url = bodyJson.get('url')
         lang = bodyJson.get('lang', 'en')
+        audio_format = bodyJson.get('format')
         
         if not texts:
             return jsonify({"error": "No texts provided"}), 400
+        if audio_format is not None and audio_format not in AUDIO_FORMATS:
+            return jsonify({"error": f"format must be one of {', '.join(AUDIO_FORMATS)}"}), 400
         
         logger.info(f"Received request to generate {len(texts.split('.'))} audio files")
         
-        response = genAudioController(texts, url, lang)
+        response = genAudioController(texts, url, lang, audio_format, bool(bodyJson.get('include_format', False)))
         logger.info("Controller processing completed")
         
         if "error" in response:
@@ -103,8 +252,28 @@ def genVideo():
     bodyJson = request.get_json()
     story, image_urls, audio_urls = bodyJson['story'], bodyJson['image_urls'], bodyJson['audio_urls']
     caption_lang = bodyJson.get('caption_lang','en')
-    response = videoGenController(story, image_urls, audio_urls,caption_lang)
-    return jsonify({"url": response})
+    subtitle_mode = bodyJson.get('subtitle_mode')
+    if subtitle_mode is not None and subtitle_mode not in SUBTITLE_MODES:
+        return jsonify({"error": f"subtitle_mode must be one of {', '.join(SUBTITLE_MODES)}"}), 400
+    output_format = bodyJson.get('output')
+    if output_format is not None and output_format not in OUTPUT_FORMATS:
+        return jsonify({"error": f"output must be one of {', '.join(OUTPUT_FORMATS)}"}), 400
+    response = videoGenController(story, image_urls, audio_urls,caption_lang,subtitle_mode,output_format)
+    return jsonify(response)
+
+@main_bp.route('/api/genVideo/<job_id>/playlist.m3u8', methods=['GET'])
+def hlsPlaylist(job_id):
+    # Rebuilt from the job on every poll, so it grows as segments are uploaded
+    job = current_app.config['DB'].get_job(job_id)
+    if job is None or job['kind'] != 'video_hls':
+        return jsonify({"error": "Video job not found"}), 404
+    if job['status'] == 'failed':
+        return jsonify({"error": job['error']}), 500
+    state = json.loads(job['result'] or '{}')
+    if not state.get('segments'):
+        return jsonify({"error": "No segment is ready yet"}), 404
+    playlist = build_hls_playlist(state['segments'], state['target_duration'], complete=job['status'] == 'done')
+    return Response(playlist, mimetype='application/vnd.apple.mpegurl', headers={'Cache-Control': 'no-cache'})
 
 @main_bp.route('/api/getWords', methods=['GET'])
 def getWords():
@@ -121,3 +290,16 @@ def deleteWords():
     # DBInstance.close_connection()
     return jsonify({"message":"DB cleared succesfully" })
 
+@main_bp.route('/api/speculativeStats', methods=['GET'])
+def speculativeStats():
+    ScriptGenModel = current_app.config['ScriptGenModel']
+    return jsonify(ScriptGenModel.get_speculative_stats())
+
+@main_bp.route('/api/models', methods=['GET'])
+def residentModels():
+    registry = current_app.config['ModelRegistry']
+    return jsonify({
+        "memory_limit_mb": registry.memory_limit_mb,
+        "resident_mb": round(registry.resident_mb(), 1),
+        "models": registry.resident()
+    })
@@ -1,69 +1,228 @@
+import io
 import os
+import subprocess
+import tempfile
+import wave
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from pydub import AudioSegment
-from scipy.io import wavfile
 import noisereduce as nr
 import numpy as np
-from app.utils.cloudinaryUploader import upload_audio_to_cloudinary
+from app.utils.cloudinaryUploader import upload_audio_buffer
+from app.utils.metrics import record_bytes, track_stage
+from app.utils.tracing import propagate
 
-def process_audio(url):
+# Post-processing applied to every synthesized segment
+AUDIO_DENOISE = os.getenv("AUDIO_DENOISE", "1") == "1"
+AUDIO_TRIM_SILENCE = os.getenv("AUDIO_TRIM_SILENCE", "1") == "1"
+# Frames this far below the segment's peak count as silence
+SILENCE_THRESHOLD_DB = float(os.getenv("AUDIO_SILENCE_THRESHOLD_DB", "-40"))
+SILENCE_PAD_MS = int(os.getenv("AUDIO_SILENCE_PAD_MS", "60"))
+# Target loudness (gated RMS, dBFS); 0 disables normalization
+TARGET_LOUDNESS_DB = float(os.getenv("AUDIO_TARGET_LOUDNESS_DB", "-20"))
+PEAK_CEILING_DB = -1.0
+
+# Format synthesized speech is uploaded in (opus, aac or wav) and its bitrate
+AUDIO_UPLOAD_FORMAT = os.getenv("AUDIO_UPLOAD_FORMAT", "opus").lower()
+AUDIO_BITRATE = os.getenv("AUDIO_BITRATE", "32k")
+
+# Per format: ffmpeg encoder and muxer, file extension and MIME type
+AUDIO_FORMATS = {
+    "opus": ("libopus", "ogg", ".ogg", "audio/ogg"),
+    "aac": ("aac", "mp4", ".m4a", "audio/mp4"),
+    "wav": (None, None, ".wav", "audio/wav"),
+}
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("AUDIO_POSTPROCESS_WORKERS", str(os.cpu_count() or 2))),
+    thread_name_prefix="audio-post"
+)
+
+
+def _frame_rms(samples: np.ndarray, frame: int) -> np.ndarray:
+    """RMS of consecutive frames, computed in one vectorized pass."""
+    count = len(samples) // frame
+    if count == 0:
+        return np.sqrt(np.mean(samples ** 2, keepdims=True)) if len(samples) else np.zeros(0)
+    frames = samples[:count * frame].reshape(count, frame)
+    return np.sqrt(np.mean(frames ** 2, axis=1))
+
+
+def reduce_noise(samples: np.ndarray, rate: int) -> np.ndarray:
+    return nr.reduce_noise(
+        y=samples,
+        sr=rate,
+        prop_decrease=0.3,  # Lower noise reduction intensity
+        n_std_thresh_stationary=1.5  # Adjust noise threshold
+    ).astype(np.float32)
+
+
+def trim_silence(samples: np.ndarray, rate: int, threshold_db: float = None, pad_ms: int = None) -> np.ndarray:
+    """Cuts leading and trailing frames quieter than threshold_db below the peak, keeping pad_ms around speech."""
+    threshold_db = SILENCE_THRESHOLD_DB if threshold_db is None else threshold_db
+    pad_ms = SILENCE_PAD_MS if pad_ms is None else pad_ms
+    frame = max(1, rate // 100)  # 10 ms
+    rms = _frame_rms(samples, frame)
+    peak = np.max(np.abs(samples)) if len(samples) else 0.0
+    if peak == 0.0:
+        return samples
+    voiced = np.flatnonzero(rms >= peak * 10 ** (threshold_db / 20))
+    if len(voiced) == 0:
+        return samples
+    pad = int(rate * pad_ms / 1000)
+    start = max(0, voiced[0] * frame - pad)
+    end = min(len(samples), (voiced[-1] + 1) * frame + pad)
+    return samples[start:end]
+
+
+def loudness_db(samples: np.ndarray, rate: int) -> float:
     """
-    Downloads an audio file from the provided URL, reduces noise, 
-    and saves the noise-reduced audio to a new file.
+    Gated RMS level in dBFS, in the spirit of ITU-R BS.1770 without its
+    K-weighting: 400 ms blocks below -70 dBFS, then those more than 10 dB
+    below the remaining mean, are ignored so pauses do not drag it down.
+    """
+    rms = _frame_rms(samples, max(1, int(rate * 0.4)))
+    power = rms ** 2
+    power = power[power > 10 ** (-70 / 10)]
+    if len(power) == 0:
+        return float("-inf")
+    power = power[power > np.mean(power) * 10 ** (-10 / 10)]
+    return float(10 * np.log10(np.mean(power)))
 
-    Args:
-        url (str): URL of the audio file to process.
 
-    Returns:
-        str: Path to the noise-reduced audio file.
+def normalize_loudness(samples: np.ndarray, rate: int, target_db: float = None) -> np.ndarray:
+    """Applies the gain that brings the segment to target_db, limited so peaks stay below -1 dBFS."""
+    target_db = TARGET_LOUDNESS_DB if target_db is None else target_db
+    level = loudness_db(samples, rate)
+    if not target_db or not np.isfinite(level):
+        return samples
+    gain = 10 ** ((target_db - level) / 20)
+    peak = np.max(np.abs(samples))
+    if peak * gain > 10 ** (PEAK_CEILING_DB / 20):
+        gain = 10 ** (PEAK_CEILING_DB / 20) / peak
+    return (samples * gain).astype(np.float32)
+
+
+def postprocess_audio(samples, rate: int) -> np.ndarray:
+    """Noise reduction, silence trimming and loudness normalization of one mono float segment."""
+    samples = np.asarray(samples, dtype=np.float32)
+    if samples.ndim > 1:
+        samples = samples[:, 0]
+    if AUDIO_DENOISE:
+        samples = reduce_noise(samples, rate)
+    if AUDIO_TRIM_SILENCE:
+        samples = trim_silence(samples, rate)
+    return normalize_loudness(samples, rate)
+
+
+def postprocess_batch(segments: list, rate: int) -> list:
+    """Post-processes all segments of a story in parallel on the shared worker pool, keeping their order."""
+    with track_stage("audio_postprocess"):
+        futures = [_executor.submit(propagate(postprocess_audio), samples, rate) for samples in segments]
+        return [future.result() for future in futures]
+
+
+def encode_wav(samples: np.ndarray, rate: int) -> bytes:
+    """16-bit mono WAV bytes of a float segment in [-1, 1]."""
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def encode_audio(samples: np.ndarray, rate: int, fmt: str = None, bitrate: str = None) -> tuple:
     """
-    temp_dir = "temp_audio"
-    os.makedirs(temp_dir, exist_ok=True)
+    Encodes a float segment in memory by piping it through ffmpeg.
 
-    temp_input_file = os.path.join(temp_dir, "input_audio.mp3")
-    temp_wav_file = os.path.join(temp_dir, "input_audio.wav")
-    output_file = os.path.join(temp_dir, "noise_reduced_audio.wav")
+    :param samples: Mono float samples in [-1, 1].
+    :param rate: Sample rate of the samples.
+    :param fmt: opus, aac or wav (defaults to AUDIO_UPLOAD_FORMAT).
+    :param bitrate: ffmpeg bitrate such as '32k' (defaults to AUDIO_BITRATE).
+    :return: Tuple of the encoded bytes and the file extension for them.
+    """
+    fmt = (fmt or AUDIO_UPLOAD_FORMAT).lower()
+    if fmt not in AUDIO_FORMATS:
+        raise ValueError(f"Unsupported audio format '{fmt}'. Use opus, aac or wav.")
+    codec, muxer, ext, _ = AUDIO_FORMATS[fmt]
+    if codec is None:
+        return encode_wav(samples, rate), ext
 
-    # Download the audio file from the URL
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(temp_input_file, "wb") as f:
-            f.write(response.content)
-    else:
-        raise Exception(f"Failed to download audio file from URL. Status code: {response.status_code}")
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "f32le", "-ar", str(rate), "-ac", "1",
+        "-i", "pipe:0",
+        "-c:a", codec, "-b:a", bitrate or AUDIO_BITRATE,
+        "-f", muxer,
+    ]
+    pcm = np.clip(samples, -1.0, 1.0).astype("<f4").tobytes()
+    if muxer == "ogg":
+        return subprocess.run(command + ["pipe:1"], input=pcm, check=True, capture_output=True).stdout, ext
 
-    # Convert MP3 to WAV if needed
-    if not temp_input_file.lower().endswith('.wav'):
-        AudioSegment.from_file(temp_input_file).export(temp_wav_file, format="wav")
-    else:
-        temp_wav_file = temp_input_file
+    # The mp4 muxer has to seek back to write its index, so it cannot write to a pipe
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f"audio{ext}")
+        subprocess.run(command + ["-movflags", "+faststart", path], input=pcm, check=True, capture_output=True)
+        with open(path, "rb") as f:
+            return f.read(), ext
 
-    # Read audio file
-    rate, data = wavfile.read(temp_wav_file)
 
-    # Handle multi-channel audio by taking the first channel
-    if len(data.shape) > 1:
-        data = data[:, 0]
+def encode_batch(segments: list, rate: int, fmt: str = None, bitrate: str = None) -> tuple:
+    """
+    Encodes all segments in parallel on the shared worker pool, keeping
+    their order. Falls back to WAV if the format cannot be encoded here
+    (for example without ffmpeg). Returns the encoded segments, each as
+    (bytes, extension), and the format actually used.
+    """
+    fmt = (fmt or AUDIO_UPLOAD_FORMAT).lower()
+    with track_stage("audio_encode"):
+        try:
+            futures = [_executor.submit(propagate(encode_audio), samples, rate, fmt, bitrate) for samples in segments]
+            return [future.result() for future in futures], fmt
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Encoding audio as {fmt} failed, uploading WAV instead: {e}")
+            return [(encode_wav(samples, rate), ".wav") for samples in segments], "wav"
 
-    # Normalize data
-    data = data.astype(np.float32) / np.max(np.abs(data))
 
-    # Perform noise reduction
-    reduced_noise = nr.reduce_noise(
-        y=data, 
-        sr=rate, 
-        prop_decrease=0.3,  # Lower noise reduction intensity
-        n_std_thresh_stationary=1.5  # Adjust noise threshold
-    )
+def audio_format_info(fmt: str, rate: int, bitrate: str = None) -> dict:
+    """Describes uploaded audio for clients: format, MIME type, sample rate and bitrate."""
+    _, _, ext, mime_type = AUDIO_FORMATS[fmt]
+    return {
+        "format": fmt,
+        "extension": ext,
+        "mime_type": mime_type,
+        "sample_rate": rate,
+        "channels": 1,
+        "bitrate": None if fmt == "wav" else (bitrate or AUDIO_BITRATE),
+    }
 
-    # Write noise-reduced audio
-    wavfile.write(output_file, rate, (reduced_noise * 32767).astype(np.int16))
 
-    # Cleanup temporary files
-    os.remove(temp_input_file)
-    if temp_input_file != temp_wav_file:
-        os.remove(temp_wav_file)
+def process_audio(url):
+    """
+    Downloads an audio file from the provided URL, post-processes it in
+    memory and uploads the result.
+
+    Args:
+        url (str): URL of the audio file to process.
+
+    Returns:
+        str: URL of the processed audio file.
+    """
+    # Download the audio file from the URL
+    with track_stage("download"):
+        response = requests.get(url, timeout=30)
+        content = response.content
+    if response.status_code != 200:
+        raise Exception(f"Failed to download audio file from URL. Status code: {response.status_code}")
+    record_bytes("download", len(content))
 
-    uploadedUrl = upload_audio_to_cloudinary(output_file)
+    # Decode any format ffmpeg understands without touching the disk
+    segment = AudioSegment.from_file(io.BytesIO(content)).set_channels(1)
+    samples = np.array(segment.get_array_of_samples(), dtype=np.float32) / (1 << (8 * segment.sample_width - 1))
 
-    return uploadedUrl
\ No newline at end of file
+    processed = postprocess_batch([samples], segment.frame_rate)[0]
+    [(data, ext)], _ = encode_batch([processed], segment.frame_rate)
+    return upload_audio_buffer(data, f"processed_audio{ext}")
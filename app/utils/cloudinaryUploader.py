@@ -2,7 +2,9 @@ import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 from dotenv import load_dotenv
+import io
 import os
+from app.utils.metrics import record_bytes, track_stage
 
 # Load environment variables from .env file
 load_dotenv()
@@ -26,10 +28,12 @@ def upload_images_to_cloudinary(image_paths: list) -> list:
     for image_path in image_paths:
         try:
             # Upload the image to Cloudinary using the 'canvas-upload' preset
-            response = cloudinary.uploader.upload(
-                image_path,
-                upload_preset="canvas-upload"
-            )
+            with track_stage("upload"):
+                response = cloudinary.uploader.upload(
+                    image_path,
+                    upload_preset="canvas-upload"
+                )
+            record_bytes("upload", os.path.getsize(image_path))
 
             # Extract the secure URL from the response
             uploaded_urls.append(response.get("secure_url"))
@@ -39,6 +43,31 @@ def upload_images_to_cloudinary(image_paths: list) -> list:
 
     return uploaded_urls
 
+def upload_image_buffer(data: bytes, filename: str, upload_preset="canvas-upload") -> str:
+    """
+    Uploads an image encoded in memory to Cloudinary and returns its URL,
+    or an empty string if the upload failed.
+
+    :param data: Encoded image bytes.
+    :param filename: Name for the upload; its extension tells the format.
+    :param upload_preset: Cloudinary upload preset (default is 'canvas-upload').
+    :return: URL of the uploaded image.
+    """
+    try:
+        buffer = io.BytesIO(data)
+        buffer.name = filename
+        with track_stage("upload"):
+            response = cloudinary.uploader.upload(
+                buffer,
+                upload_preset=upload_preset
+            )
+        record_bytes("upload", len(data))
+        print(f"Uploaded {filename} successfully.")
+        return response.get("secure_url")
+    except Exception as e:
+        print(f"Failed to upload {filename}: {e}")
+        return ""
+
 def upload_audio_to_cloudinary(audio_paths: list, upload_preset="canvas-upload") -> list:
     """
     Uploads a list of audio files to Cloudinary using a specified preset
@@ -52,11 +81,13 @@ def upload_audio_to_cloudinary(audio_paths: list, upload_preset="canvas-upload")
     for audio_path in audio_paths:
         try:
             # Upload the audio file to Cloudinary using the specified upload preset
-            response = cloudinary.uploader.upload(
-                audio_path,
-                upload_preset=upload_preset,
-                resource_type="auto"  # Automatically detects the file type (audio or video)
-            )
+            with track_stage("upload"):
+                response = cloudinary.uploader.upload(
+                    audio_path,
+                    upload_preset=upload_preset,
+                    resource_type="auto"  # Automatically detects the file type (audio or video)
+                )
+            record_bytes("upload", os.path.getsize(audio_path))
 
             # Extract the secure URL from the response
             uploaded_urls.append(response.get("secure_url"))
@@ -68,6 +99,32 @@ def upload_audio_to_cloudinary(audio_paths: list, upload_preset="canvas-upload")
 
     return uploaded_urls
 
+def upload_audio_buffer(data: bytes, filename: str, upload_preset="canvas-upload") -> str:
+    """
+    Uploads audio encoded in memory to Cloudinary and returns its URL,
+    or an empty string if the upload failed.
+
+    :param data: Encoded audio bytes.
+    :param filename: Name for the upload; its extension tells the format.
+    :param upload_preset: Cloudinary upload preset (default is 'canvas-upload').
+    :return: URL of the uploaded audio.
+    """
+    try:
+        buffer = io.BytesIO(data)
+        buffer.name = filename
+        with track_stage("upload"):
+            response = cloudinary.uploader.upload(
+                buffer,
+                upload_preset=upload_preset,
+                resource_type="auto"  # Automatically detects the file type (audio or video)
+            )
+        record_bytes("upload", len(data))
+        print(f"Uploaded {filename} successfully.")
+        return response.get("secure_url")
+    except Exception as e:
+        print(f"Failed to upload {filename}: {e}")
+        return ""
+
 def upload_video_to_cloudinary(video_path: str, upload_preset="canvas-upload") -> str:
     """
     Uploads a video file to Cloudinary using a specified preset
@@ -79,11 +136,13 @@ def upload_video_to_cloudinary(video_path: str, upload_preset="canvas-upload") -
     """
     try:
         # Upload the video file to Cloudinary using the specified upload preset
-        response = cloudinary.uploader.upload(
-            video_path,
-            upload_preset=upload_preset,
-            resource_type="video"  # Explicitly specify the resource type as video
-        )
+        with track_stage("upload"):
+            response = cloudinary.uploader.upload(
+                video_path,
+                upload_preset=upload_preset,
+                resource_type="video"  # Explicitly specify the resource type as video
+            )
+        record_bytes("upload", os.path.getsize(video_path))
 
         # Extract the secure URL from the response
         uploaded_url = response.get("secure_url")
@@ -92,4 +151,28 @@ def upload_video_to_cloudinary(video_path: str, upload_preset="canvas-upload") -
 
     except Exception as e:
         print(f"Failed to upload {video_path}: {e}")
-        return ""
\ No newline at end of file
+        return ""
+
+def upload_raw_to_cloudinary(file_path: str, upload_preset="canvas-upload") -> str:
+    """
+    Uploads a non-media file (e.g. a WebVTT subtitle track) to Cloudinary
+    and returns its URL, or an empty string if the upload failed.
+
+    :param file_path: Local file path.
+    :param upload_preset: Cloudinary upload preset (default is 'canvas-upload').
+    :return: URL of the uploaded file.
+    """
+    try:
+        with track_stage("upload"):
+            response = cloudinary.uploader.upload(
+                file_path,
+                upload_preset=upload_preset,
+                resource_type="raw"  # Served as-is, keeping the file extension
+            )
+        record_bytes("upload", os.path.getsize(file_path))
+        print(f"Uploaded {file_path} successfully.")
+        return response.get("secure_url")
+
+    except Exception as e:
+        print(f"Failed to upload {file_path}: {e}")
+        return ""
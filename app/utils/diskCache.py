@@ -0,0 +1,157 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+from app.utils.metrics import record_cache
+
+
+def hash_key(*parts) -> str:
+    """SHA-256 over the parts (bytes, or anything str() can render), separated unambiguously."""
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def file_digest(path: str) -> bytes:
+    """SHA-256 of a file's contents, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+class DiskLRUCache:
+    """
+    Files cached in a directory under a size cap, evicting the least
+    recently used first. An SQLite index in the same directory tracks sizes
+    and access times, so the cache is shared by threads and processes.
+
+    Entries are copied in and out rather than linked, so callers can
+    overwrite their files and entries can be evicted while in use.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, name: str = "disk"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.name = name
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.db")
+        with self._index() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+
+    @contextmanager
+    def _index(self):
+        conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def fetch(self, key: str, dest_path: str) -> bool:
+        """Places the cached file for key at dest_path; returns False on a miss."""
+        with self._index() as conn:
+            row = conn.execute("SELECT filename FROM entries WHERE key = ?", (key,)).fetchone()
+            hit = False
+            if row is not None:
+                try:
+                    shutil.copyfile(os.path.join(self.directory, row[0]), dest_path)
+                    conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                    hit = True
+                except FileNotFoundError:
+                    # Removed behind the index's back
+                    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        record_cache(self.name, hit=hit)
+        return hit
+
+    def get_path(self, key: str, record: bool = True) -> Optional[str]:
+        """
+        Path of the cached file for key, or None. Use fetch() for a copy that
+        outlives eviction. record=False leaves the hit/miss metric to the
+        caller, for lookups that take more than one entry.
+        """
+        path = None
+        with self._index() as conn:
+            row = conn.execute("SELECT filename FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and os.path.exists(os.path.join(self.directory, row[0])):
+                conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                path = os.path.join(self.directory, row[0])
+        if record:
+            record_cache(self.name, hit=path is not None)
+        return path
+
+    def store(self, key: str, src_path: str) -> str:
+        """Adds a copy of src_path under key and returns its path in the cache."""
+        filename = f"{key}{os.path.splitext(src_path)[1]}"
+        path = os.path.join(self.directory, filename)
+        staging = os.path.join(self.directory, f".{uuid.uuid4().hex}.tmp")
+        # Copy then rename, so readers never see a partial file
+        shutil.copyfile(src_path, staging)
+        os.replace(staging, path)
+        self._add(key, filename, os.path.getsize(path))
+        return path
+
+    def _add(self, key: str, filename: str, size: int):
+        with self._index() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, filename, size, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, filename, size, time.time())
+            )
+        self.evict()
+
+    def store_bytes(self, key: str, data: bytes, suffix: str = "") -> str:
+        """Adds data under key and returns its path in the cache."""
+        filename = f"{key}{suffix}"
+        path = os.path.join(self.directory, filename)
+        staging = os.path.join(self.directory, f".{uuid.uuid4().hex}.tmp")
+        with open(staging, "wb") as f:
+            f.write(data)
+        os.replace(staging, path)
+        self._add(key, filename, len(data))
+        return path
+
+    def get_bytes(self, key: str, record: bool = True) -> Optional[bytes]:
+        """Contents of the cached file for key, or None."""
+        path = self.get_path(key, record)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes."""
+        with self._index() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, filename, size in conn.execute(
+                "SELECT key, filename, size FROM entries ORDER BY accessed_at"
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def size(self) -> int:
+        with self._index() as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
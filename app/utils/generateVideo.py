@@ -1,14 +1,71 @@
 import os
 import json
+import math
 import requests
 import subprocess
+import uuid
+from urllib.parse import urlparse
 from pydub.utils import mediainfo
-from app.utils.cloudinaryUploader import upload_video_to_cloudinary
+from app.utils.cloudinaryUploader import upload_raw_to_cloudinary, upload_video_to_cloudinary
+from app.utils.diskCache import DiskLRUCache, file_digest, hash_key
+from app.utils.metrics import record_bytes, track_stage
+from app.utils.narration import build_narration, encode_narration, load_segment
+
+# Rendered clips, keyed by their inputs, so rebuilding an edited video only encodes changed clips
+CLIP_CACHE_DIR = os.getenv("CLIP_CACHE_DIR", "data/cache/clips")
+CLIP_CACHE_MAX_MB = int(os.getenv("CLIP_CACHE_MAX_MB", "2048"))
+# Part of every clip's cache key; change it with the clip encoding below
+CLIP_ENCODE_SETTINGS = ["-c:v", "libx264", "-pix_fmt", "yuv420p"]
+_clip_cache = None
+
+# How subtitles reach the viewer:
+#   burn    - rendered into the picture, which re-encodes the whole video (default)
+#   soft    - muxed as a mov_text track that players can toggle; clips are joined by stream copy
+#   sidecar - uploaded as a separate WebVTT file; clips are joined by stream copy
+SUBTITLE_MODES = ("burn", "soft", "sidecar")
+VIDEO_SUBTITLE_MODE = os.getenv("VIDEO_SUBTITLE_MODE", "burn")
+
+# Join the sentence audio into one narration track muxed once, instead of muxing audio per clip
+VIDEO_NARRATION = os.getenv("VIDEO_NARRATION", "1") == "1"
+# Frame rate of image clips; clip lengths are snapped to it so image changes follow the narration
+VIDEO_FPS = 25
+
+# mp4 returns one file when it is complete; hls returns a playlist that grows as clips finish
+OUTPUT_FORMATS = ("mp4", "hls")
+VIDEO_OUTPUT_FORMAT = os.getenv("VIDEO_OUTPUT_FORMAT", "mp4")
+
+def build_hls_playlist(segments, target_duration, complete=False):
+    """
+    EVENT playlist over the segments uploaded so far; players keep polling
+    it for new segments until it ends with EXT-X-ENDLIST.
+    """
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        "#EXT-X-PLAYLIST-TYPE:EVENT",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+    ]
+    for segment in segments:
+        lines.append(f"#EXTINF:{segment['duration']:.3f},")
+        lines.append(segment["url"])
+    if complete:
+        lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+def get_clip_cache():
+    global _clip_cache
+    if _clip_cache is None and os.getenv("CLIP_CACHE", "1") == "1":
+        _clip_cache = DiskLRUCache(CLIP_CACHE_DIR, CLIP_CACHE_MAX_MB * 1024 * 1024, name="video_clip")
+    return _clip_cache
 
 class VideoGenerator:
-    def __init__(self, image_urls, audio_urls,story, output_filename="output.mp4"):
+    def __init__(self, image_urls, audio_urls,story, output_filename="output.mp4", subtitle_mode=None,
+                 narration=None):
+        # Each generation gets its own scratch directory so concurrent videos do not collide
+        run_dir = os.path.join("data/temp", uuid.uuid4().hex)
         # # Ensure data directories exist
-        self.data_temp_dir = "data/temp"
+        self.data_temp_dir = run_dir
         self.data_temp_audio_dir = os.path.join(self.data_temp_dir, "audio")
         self.data_temp_clips_dir = os.path.join(self.data_temp_dir, "clips")
         # print(self.data_temp_audio_dir,self.data_temp_clips_dir)
@@ -25,7 +82,7 @@ class VideoGenerator:
         # self.audio_metadata_path = os.path.join(self.data_temp_dir, "audioMetadata.json")
         # self.subtitles_path = os.path.join(self.data_temp_dir, "subtitles.ssa")
         # print(self.subtitles_path)
-        self.data_temp_dir = os.path.normpath("data/temp")
+        self.data_temp_dir = os.path.normpath(run_dir)
         self.data_temp_audio_dir = os.path.normpath(os.path.join(self.data_temp_dir, "audio"))
         self.data_temp_clips_dir = os.path.normpath(os.path.join(self.data_temp_dir, "clips"))
         
@@ -37,6 +94,16 @@ class VideoGenerator:
         self.output_filename = os.path.normpath(os.path.join(self.data_temp_dir, "output.mp4"))
         self.audio_metadata_path = os.path.normpath(os.path.join(self.data_temp_dir, "audioMetadata.json"))
         self.subtitles_path = os.path.normpath(os.path.join(self.data_temp_dir, "subtitles.ssa"))        
+        self.subtitles_vtt_path = os.path.normpath(os.path.join(self.data_temp_dir, "subtitles.vtt"))
+        self.narration_path = os.path.normpath(os.path.join(self.data_temp_dir, "narration.m4a"))
+
+        self.narration = VIDEO_NARRATION if narration is None else narration
+
+        self.subtitle_mode = subtitle_mode or VIDEO_SUBTITLE_MODE
+        if self.subtitle_mode not in SUBTITLE_MODES:
+            raise ValueError(f"Unknown subtitle mode '{self.subtitle_mode}'. Use one of {', '.join(SUBTITLE_MODES)}.")
+        # Set by generateVideo in sidecar mode
+        self.subtitles_url = None
 
     def fetch_audio_metadata(self):
         """
@@ -47,15 +114,19 @@ class VideoGenerator:
 
         for i, url in enumerate(self.audio_urls):
             try:
-                # Download the audio file
-                response = requests.get(url, stream=True)
+                # Keep the uploaded format (ogg, m4a or wav) so ffmpeg probes it correctly
+                audio_ext = os.path.splitext(urlparse(url).path)[1] or ".mp3"
+                temp_path = os.path.join(self.data_temp_audio_dir, f"audio_{i + 1}{audio_ext}")
+
+                # Download the audio file and save it locally, timed as one download
+                with track_stage("download"):
+                    response = requests.get(url, stream=True)
+                    if response.status_code == 200:
+                        with open(temp_path, "wb") as f:
+                            for chunk in response.iter_content(chunk_size=1024):
+                                f.write(chunk)
                 if response.status_code == 200:
-                    temp_path = os.path.join(self.data_temp_audio_dir, f"audio_{i + 1}.mp3")
-                    
-                    # Save the file locally
-                    with open(temp_path, "wb") as f:
-                        for chunk in response.iter_content(chunk_size=1024):
-                            f.write(chunk)
+                    record_bytes("download", os.path.getsize(temp_path))
                     
                     # Get audio duration using pydub
                     audio_info = mediainfo(temp_path)
@@ -78,9 +149,30 @@ class VideoGenerator:
         print(f"Audio metadata saved to {self.audio_metadata_path}")
         return audio_metadata
 
-    def create_ass_subtitles(self, audio_metadata):
+    def build_narration_track(self, audio_metadata):
         """
-        Create subtitle file based on story and audio metadata.
+        Decodes the sentence audio, joins it into one AAC narration track
+        and records each sentence's exact start, end and slot_end (seconds
+        into the track) on its metadata entry.
+        """
+        segments, rate = [], None
+        with track_stage("audio_decode"):
+            for item in audio_metadata:
+                samples, rate = load_segment(item["file_path"], rate)
+                segments.append(samples)
+        track, spans = build_narration(segments, rate)
+        encode_narration(track, rate, self.narration_path)
+        for item, span in zip(audio_metadata, spans):
+            item.update(span)
+        print(f"Narration track built: {len(track) / rate:.2f}s from {len(segments)} sentences")
+        return self.narration_path
+
+    def subtitle_cues(self, audio_metadata):
+        """
+        Splits the story into sentences, timed by the narration offsets when
+        there is one sentence per audio segment and evenly over the total
+        audio duration otherwise. Returns a list of (start, end, sentence),
+        or None.
         """
         sentences = [sentence.strip() for sentence in self.story.split('.') if sentence.strip()]
         
@@ -90,7 +182,25 @@ class VideoGenerator:
             print("Error: No sentences found in the story.")
             return None
 
+        if len(sentences) == len(audio_metadata) and all("start" in item for item in audio_metadata):
+            # Each cue stays up until the next sentence starts
+            return [(item["start"], item["slot_end"], sentence) for item, sentence in zip(audio_metadata, sentences)]
+
         duration_per_sentence = total_duration / len(sentences)
+        cues = []
+        current_time = 0.0
+        for sentence in sentences:
+            cues.append((current_time, current_time + duration_per_sentence, sentence))
+            current_time += duration_per_sentence
+        return cues
+
+    def create_ass_subtitles(self, audio_metadata):
+        """
+        Create subtitle file based on story and audio metadata.
+        """
+        cues = self.subtitle_cues(audio_metadata)
+        if cues is None:
+            return None
         
         def format_time(seconds):
             cs = int((seconds % 1) * 100)  # centiseconds
@@ -116,12 +226,8 @@ Style: Highlighted,Arial,12,&H00FFFF00,&H00000000,&H00000000,&H80000000,1,1,1,2.
 Format: Marked, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 """
         ass_events = []
-        current_time = 0.0
-        for sentence in sentences:
-            start_time = format_time(current_time)
-            end_time = format_time(current_time + duration_per_sentence)
-            ass_events.append(f"Dialogue: 0,{start_time},{end_time},Default,,0,0,0,,{sentence}")
-            current_time += duration_per_sentence
+        for start, end, sentence in cues:
+            ass_events.append(f"Dialogue: 0,{format_time(start)},{format_time(end)},Default,,0,0,0,,{sentence}")
 
         with open(self.subtitles_path, "w", encoding="utf-8") as ass_file:
             print(self.subtitles_path)
@@ -131,6 +237,94 @@ Format: Marked, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
         print("Subtitles generated successfully.")
         return self.subtitles_path
 
+    def create_vtt_subtitles(self, audio_metadata):
+        """
+        Create a WebVTT sidecar file with the same cues as the ASS subtitles.
+        """
+        cues = self.subtitle_cues(audio_metadata)
+        if cues is None:
+            return None
+
+        def format_time(seconds):
+            ms = int(round(seconds * 1000))
+            return f"{ms // 3600000:02}:{ms // 60000 % 60:02}:{ms // 1000 % 60:02}.{ms % 1000:03}"
+
+        with open(self.subtitles_vtt_path, "w", encoding="utf-8") as vtt_file:
+            vtt_file.write("WEBVTT\n\n")
+            for index, (start, end, sentence) in enumerate(cues, start=1):
+                vtt_file.write(f"{index}\n{format_time(start)} --> {format_time(end)}\n{sentence}\n\n")
+
+        print("WebVTT subtitles generated successfully.")
+        return self.subtitles_vtt_path
+
+    def render_clip(self, i, image_url, metadata, clip_cache=None, duration=None):
+        """
+        Renders one image and its audio into a clip with fade-in and
+        fade-out, or takes it from the clip cache. Returns the clip path.
+
+        With a duration the clip is video only and lasts exactly that long,
+        for muxing with the narration track.
+        """
+        with_audio = duration is None
+        # Keep the uploaded format (webp, jpg or png) so ffmpeg probes it correctly
+        image_ext = os.path.splitext(urlparse(image_url).path)[1] or ".png"
+        image_path = os.path.join(self.data_temp_clips_dir, f"image_{i + 1}{image_ext}")
+        audio_path = metadata["file_path"]
+        duration = metadata["duration"] if with_audio else duration
+        temp_output = os.path.join(self.data_temp_clips_dir, f"clip_{i + 1}.mp4")
+        
+        # Download the image
+        with track_stage("download"):
+            subprocess.run(["curl", "-o", image_path, image_url], check=True)
+        record_bytes("download", os.path.getsize(image_path))
+
+        # Combine image and audio into a video clip with fade-in and fade-out effects
+        fade_duration = min(1, duration / 2)  # Ensure fade duration does not exceed half the clip duration
+
+        # Reuse the clip rendered earlier from the same inputs
+        clip_key = None
+        if clip_cache is not None:
+            clip_key = hash_key(
+                file_digest(image_path), file_digest(audio_path) if with_audio else "video-only",
+                duration, fade_duration, *CLIP_ENCODE_SETTINGS
+            )
+            if clip_cache.fetch(clip_key, temp_output):
+                print(f"Reusing cached clip {i + 1}")
+                return temp_output
+
+        if with_audio:
+            command = [
+                "ffmpeg",
+                "-loop", "1",
+                "-i", image_path,
+                "-i", audio_path,
+                "-filter_complex", 
+                f"[0:v]fade=t=in:st=0:d={fade_duration},fade=t=out:st={duration - fade_duration}:d={fade_duration}[v];[1:a]anull[a]",
+                "-map", "[v]",
+                "-map", "[a]",
+                *CLIP_ENCODE_SETTINGS,
+                "-t", str(duration),
+                "-shortest",
+                temp_output
+            ]
+        else:
+            command = [
+                "ffmpeg",
+                "-loop", "1",
+                "-framerate", str(VIDEO_FPS),
+                "-i", image_path,
+                "-vf", f"fade=t=in:st=0:d={fade_duration},fade=t=out:st={duration - fade_duration}:d={fade_duration}",
+                *CLIP_ENCODE_SETTINGS,
+                "-r", str(VIDEO_FPS),
+                "-t", str(duration),
+                temp_output
+            ]
+        with track_stage("ffmpeg_encode"):
+            subprocess.run(command, check=True)
+        if clip_key is not None:
+            clip_cache.store(clip_key, temp_output)
+        return temp_output
+
     def create_video_with_audio(self, audio_metadata):
         """
         Create video by combining images and audio with subtitles.
@@ -140,36 +334,21 @@ Format: Marked, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                 raise ValueError("The number of images and audio metadata entries must be the same.")
             
             temp_video_clips = []
+            clip_cache = get_clip_cache()
+
+            narration = self.narration and os.path.exists(self.narration_path)
+            if narration:
+                # Snap each sentence's slot to whole frames so the clips add up to the narration exactly
+                boundaries = [round(item["start"] * VIDEO_FPS) for item in audio_metadata]
+                boundaries.append(round(audio_metadata[-1]["slot_end"] * VIDEO_FPS))
+                boundaries[0] = 0
+                clip_durations = [(end - start) / VIDEO_FPS for start, end in zip(boundaries, boundaries[1:])]
+            else:
+                clip_durations = [None] * len(audio_metadata)
 
             # Process each image and corresponding audio
             for i, (image_url, metadata) in enumerate(zip(self.image_urls, audio_metadata)):
-                image_path = os.path.join(self.data_temp_clips_dir, f"image_{i + 1}.png")
-                audio_path = metadata["file_path"]
-                duration = metadata["duration"]
-                temp_output = os.path.join(self.data_temp_clips_dir, f"clip_{i + 1}.mp4")
-                
-                # Download the image
-                subprocess.run(["curl", "-o", image_path, image_url], check=True)
-
-                # Combine image and audio into a video clip with fade-in and fade-out effects
-                fade_duration = min(1, duration / 2)  # Ensure fade duration does not exceed half the clip duration
-                command = [
-                    "ffmpeg",
-                    "-loop", "1",
-                    "-i", image_path,
-                    "-i", audio_path,
-                    "-filter_complex", 
-                    f"[0:v]fade=t=in:st=0:d={fade_duration},fade=t=out:st={duration - fade_duration}:d={fade_duration}[v];[1:a]anull[a]",
-                    "-map", "[v]",
-                    "-map", "[a]",
-                    "-c:v", "libx264",
-                    "-t", str(duration),
-                    "-pix_fmt", "yuv420p",
-                    "-shortest",
-                    temp_output
-                ]
-                subprocess.run(command, check=True)
-                temp_video_clips.append(temp_output)
+                temp_video_clips.append(self.render_clip(i, image_url, metadata, clip_cache, clip_durations[i]))
 
             # Concatenate all video clips
             concat_file = os.path.join(self.data_temp_clips_dir, "concat_list.txt")
@@ -178,25 +357,93 @@ Format: Marked, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                     f.write(f"file '{os.path.abspath(clip)}'\n")
             
             # Final video assembly with subtitles
-            print('place of error :',self.subtitles_path)
-            subPath = self.subtitles_path.replace('\\','/')
             concat_command = [
                 "ffmpeg",
                 "-f", "concat",
                 "-safe", "0",
                 "-i", concat_file,
-                "-vf", f"subtitles={subPath}",
-                "-c:v", "libx264",
-                "-pix_fmt", "yuv420p",
-                self.output_filename
             ]
-            subprocess.run(concat_command, check=True)
+            # The narration is already encoded, so it is only muxed
+            if narration:
+                concat_command += ["-i", self.narration_path]
+            streams = ["-map", "0:v", "-map", "1:a" if narration else "0:a"]
+            audio_codec = ["-c:a", "copy"] if narration else []
+            if self.subtitle_mode == "burn":
+                print('place of error :',self.subtitles_path)
+                subPath = self.subtitles_path.replace('\\','/')
+                concat_command += [
+                    *streams,
+                    "-vf", f"subtitles={subPath}",
+                    "-c:v", "libx264",
+                    "-pix_fmt", "yuv420p",
+                    *audio_codec,
+                ]
+            elif self.subtitle_mode == "soft":
+                # Clips share the same encode settings, so they are joined without re-encoding
+                concat_command += [
+                    "-i", self.subtitles_path,
+                    *streams, "-map", f"{2 if narration else 1}:s",
+                    "-c", "copy",
+                    "-c:s", "mov_text",
+                    "-movflags", "+faststart",
+                ]
+            else:
+                concat_command += [*streams, "-c", "copy", "-movflags", "+faststart"]
+            concat_command.append(self.output_filename)
+            with track_stage("ffmpeg_encode" if self.subtitle_mode == "burn" else "ffmpeg_concat"):
+                subprocess.run(concat_command, check=True)
             
             print(f"Video successfully created: {self.output_filename}")
         
         except Exception as e:
             print(f"Error occurred: {e}")
 
+    def generateHLS(self, on_segment):
+        """
+        Renders the video as HLS for progressive playback. Each clip is
+        remuxed (without re-encoding) into an MPEG-TS segment and uploaded
+        as soon as it is rendered, then reported through
+        on_segment(segment, index, total, target_duration) where segment is
+        a dict with the segment's url and duration. Subtitles are delivered
+        as a WebVTT sidecar (self.subtitles_url). Raises on failure.
+        """
+        try:
+            audio_metadata = self.fetch_audio_metadata()
+            if not audio_metadata or len(self.image_urls) != len(audio_metadata):
+                raise ValueError("The number of images and audio metadata entries must be the same.")
+
+            subtitles_path = self.create_vtt_subtitles(audio_metadata)
+            if subtitles_path:
+                self.subtitles_url = upload_raw_to_cloudinary(subtitles_path)
+
+            # Durations are known up front, so the target duration never has to change
+            target_duration = math.ceil(max(item["duration"] for item in audio_metadata))
+            clip_cache = get_clip_cache()
+            offset = 0.0
+            for i, (image_url, metadata) in enumerate(zip(self.image_urls, audio_metadata)):
+                clip = self.render_clip(i, image_url, metadata, clip_cache)
+                segment_path = os.path.join(self.data_temp_clips_dir, f"segment_{i + 1}.ts")
+                command = [
+                    "ffmpeg",
+                    "-i", clip,
+                    "-c", "copy",
+                    "-bsf:v", "h264_mp4toannexb",
+                    # Continue the timestamps of the previous segments
+                    "-output_ts_offset", str(offset),
+                    "-f", "mpegts",
+                    segment_path
+                ]
+                with track_stage("hls_segment"):
+                    subprocess.run(command, check=True)
+
+                segment_url = upload_raw_to_cloudinary(segment_path)
+                if not segment_url:
+                    raise RuntimeError(f"Failed to upload segment {i + 1}")
+                on_segment({"url": segment_url, "duration": metadata["duration"]}, i, len(audio_metadata), target_duration)
+                offset += metadata["duration"]
+        finally:
+            self.clean_temp_files()
+
     def clean_temp_files(self):
         """
         Remove all temporary files and directories.
@@ -216,14 +463,26 @@ Format: Marked, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
         try:
             # Fetch audio metadata
             audio_metadata = self.fetch_audio_metadata()
+
+            if self.narration and audio_metadata:
+                try:
+                    self.build_narration_track(audio_metadata)
+                except Exception as e:
+                    print(f"Narration track failed, muxing audio per clip: {e}")
+                    self.narration = False
             
             # Create subtitles
-            subtitles_path = self.create_ass_subtitles(audio_metadata)
+            if self.subtitle_mode == "sidecar":
+                subtitles_path = self.create_vtt_subtitles(audio_metadata)
+            else:
+                subtitles_path = self.create_ass_subtitles(audio_metadata)
             
             # Create video with audio and subtitles
             self.create_video_with_audio(audio_metadata)
 
             uploaded_url = upload_video_to_cloudinary(self.output_filename)
+            if self.subtitle_mode == "sidecar" and subtitles_path:
+                self.subtitles_url = upload_raw_to_cloudinary(subtitles_path)
             return uploaded_url
         
         except Exception as e:
@@ -0,0 +1,56 @@
+import io
+import os
+from PIL import Image, features
+
+# Output format and quality of generated images (webp, jpeg or png)
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "webp").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+# Longest side of the thumbnails shown in the UI grid
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "320"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "70"))
+
+EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg", "png": ".png"}
+
+
+def resolve_format(fmt: str = None) -> str:
+    """The format images requested as fmt are actually encoded in."""
+    fmt = (fmt or IMAGE_FORMAT).lower()
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if fmt not in EXTENSIONS:
+        raise ValueError(f"Unsupported image format '{fmt}'. Use webp, jpeg or png.")
+    # Pillow can be built without libwebp
+    if fmt == "webp" and not features.check("webp"):
+        return "jpeg"
+    return fmt
+
+
+def encode_image(image: Image.Image, fmt: str = None, quality: int = None) -> tuple:
+    """
+    Encodes a PIL image in memory.
+
+    :param image: Image to encode.
+    :param fmt: webp, jpeg or png (defaults to IMAGE_FORMAT).
+    :param quality: Lossy quality from 1 to 100 (defaults to IMAGE_QUALITY).
+    :return: Tuple of the encoded bytes and the file extension for them.
+    """
+    fmt = resolve_format(fmt)
+    quality = quality or IMAGE_QUALITY
+    buffer = io.BytesIO()
+    if fmt == "webp":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    elif fmt == "jpeg":
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue(), EXTENSIONS[fmt]
+
+
+def make_thumbnail(image: Image.Image, size: int = None, fmt: str = None, quality: int = None) -> tuple:
+    """
+    Encodes a copy of the image scaled down to fit in a size x size box,
+    keeping its aspect ratio. Returns the bytes and file extension.
+    """
+    size = size or THUMBNAIL_SIZE
+    thumbnail = image.copy()
+    thumbnail.thumbnail((size, size), Image.LANCZOS)
+    return encode_image(thumbnail, fmt, quality or THUMBNAIL_QUALITY)
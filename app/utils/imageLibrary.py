@@ -0,0 +1,85 @@
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Prompts at least this similar (cosine of their embeddings) share an image
+IMAGE_REUSE_THRESHOLD = float(os.getenv("IMAGE_REUSE_THRESHOLD", "0.92"))
+IMAGE_LIBRARY_MODEL = os.getenv("IMAGE_LIBRARY_MODEL", "all-MiniLM-L6-v2")
+
+
+class ImageLibrary:
+    """
+    Generated images indexed by the embedding of their prompt, so that a
+    near-identical prompt (from the same story or another session) can
+    reuse an image instead of running diffusion again.
+
+    Entries live in the image_library table; each process keeps an
+    in-memory matrix of the embeddings and picks up rows added by other
+    processes on the next lookup.
+    """
+
+    def __init__(self, db, encoder=None):
+        self.db = db
+        self._encoder = encoder
+        self._lock = threading.Lock()
+        self._entries: List[Dict] = []
+        self._embeddings = None
+        self._last_id = 0
+
+    @property
+    def encoder(self):
+        # Loaded on first use so the image model does not pay for it unless reuse is on
+        with self._lock:
+            if self._encoder is None:
+                from sentence_transformers import SentenceTransformer
+                self._encoder = SentenceTransformer(IMAGE_LIBRARY_MODEL)
+        return self._encoder
+
+    def embed(self, prompts: List[str]) -> np.ndarray:
+        """Unit-length prompt embeddings, one row per prompt."""
+        embeddings = np.asarray(self.encoder.encode(list(prompts)), dtype=np.float32)
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-9)
+
+    def _refresh(self):
+        rows = self.db.get_library_images(after_id=self._last_id)
+        if not rows:
+            return
+        added = np.stack([np.frombuffer(row.pop("embedding"), dtype=np.float32) for row in rows])
+        self._embeddings = added if self._embeddings is None else np.vstack([self._embeddings, added])
+        self._entries.extend(rows)
+        self._last_id = rows[-1]["id"]
+
+    def find(self, embedding: np.ndarray, width: int, height: int, image_format: str,
+             threshold: float = None, need_thumbnail: bool = False) -> Optional[Dict]:
+        """
+        Returns the stored image of the most similar prompt with the same
+        size and format, with its 'similarity', or None when no prompt
+        reaches the threshold.
+        """
+        threshold = IMAGE_REUSE_THRESHOLD if threshold is None else threshold
+        with self._lock:
+            self._refresh()
+            if self._embeddings is None:
+                return None
+            similarities = self._embeddings @ embedding
+            best, best_similarity = None, threshold
+            for row in np.flatnonzero(similarities >= threshold):
+                entry = self._entries[row]
+                if (entry["width"], entry["height"], entry["format"]) != (width, height, image_format):
+                    continue
+                if need_thumbnail and not entry["thumbnail_url"]:
+                    continue
+                if similarities[row] >= best_similarity:
+                    best, best_similarity = entry, float(similarities[row])
+        if best is None:
+            return None
+        return {**best, "similarity": best_similarity}
+
+    def add(self, prompt: str, embedding: np.ndarray, url: str, width: int, height: int,
+            image_format: str, seed: int = None, thumbnail_url: str = None):
+        self.db.add_library_image(
+            prompt, embedding.astype(np.float32).tobytes(), url, width, height,
+            image_format, seed=seed, thumbnail_url=thumbnail_url
+        )
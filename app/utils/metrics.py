@@ -0,0 +1,317 @@
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+from app.utils.tracing import span
+
+# Latency buckets (seconds) wide enough for a retrieval call up to a full video encode
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# How often each process of a preforked server writes its values for the others to merge
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+
+
+def _format_labels(labelnames: Sequence[str], values: Tuple[str, ...], extra: Optional[Dict[str, str]] = None) -> str:
+    pairs = list(zip(labelnames, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> List[list]:
+        """This process's values as JSON-friendly [label values, value] pairs."""
+        with self._lock:
+            return [[list(key), value] for key, value in self._data().items()]
+
+    def reset(self):
+        with self._lock:
+            self._data().clear()
+
+    def merge(self, snapshots: List[List[list]]) -> Dict[Tuple[str, ...], object]:
+        """Sums snapshots from several processes into {label values: value}."""
+        merged = {}
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                key = tuple(key)
+                merged[key] = self._add(merged[key], value) if key in merged else value
+        return merged
+
+    def render(self, values: Optional[Dict] = None) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _data(self) -> Dict:
+        return self._values
+
+    @staticmethod
+    def _add(a: float, b: float) -> float:
+        return a + b
+
+    def render(self, values: Optional[Dict] = None) -> List[str]:
+        lines = super().render()
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # per bucket counts, then sum and count
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def _data(self) -> Dict:
+        return self._series
+
+    @staticmethod
+    def _add(a: List[float], b: List[float]) -> List[float]:
+        return [x + y for x, y in zip(a, b)]
+
+    def snapshot(self) -> List[list]:
+        with self._lock:
+            return [[list(key), list(series)] for key, series in self._series.items()]
+
+    def render(self, values: Optional[Dict] = None) -> List[str]:
+        lines = super().render()
+        if values is None:
+            with self._lock:
+                values = {key: list(series) for key, series in self._series.items()}
+        for key, series in sorted(values.items()):
+            for bound, count in zip(self.buckets, series):
+                labels = _format_labels(self.labelnames, key, {"le": _format_value(bound)})
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    All metrics of the process. With a multiprocess directory (set by the
+    preforking server) every process writes its values there as
+    <pid>.json, and a scrape of any process renders the sum over all of
+    them, so /metrics does not depend on which worker answers.
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self.multiprocess_dir: Optional[str] = None
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def snapshot(self) -> Dict[str, List[list]]:
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def reset(self):
+        """Clears every value, e.g. in a forked worker that must not count its parent's again."""
+        for metric in self._metrics:
+            metric.reset()
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        snapshots = [self.snapshot()]
+        if self.multiprocess_dir:
+            snapshots.extend(self._other_processes())
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(metric.merge([s.get(metric.name, []) for s in snapshots])))
+        return "\n".join(lines) + "\n"
+
+    def _other_processes(self) -> List[Dict[str, List[list]]]:
+        own = os.path.join(self.multiprocess_dir, f"{os.getpid()}.json")
+        snapshots = []
+        for path in glob.glob(os.path.join(self.multiprocess_dir, "*.json")):
+            if path == own:
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # Removed or replaced while listing
+                continue
+        return snapshots
+
+    def flush(self):
+        """Writes this process's values for the other processes to merge."""
+        if not self.multiprocess_dir:
+            return
+        path = os.path.join(self.multiprocess_dir, f"{os.getpid()}.json")
+        _write_json(path, self.snapshot())
+
+    def start_flusher(self, interval: float = None):
+        """Flushes in a background thread every interval seconds."""
+        interval = interval or METRICS_FLUSH_INTERVAL
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except OSError as e:
+                    print(f"Error writing metrics: {e}")
+
+        threading.Thread(target=loop, name="metrics-flush", daemon=True).start()
+
+    def mark_process_dead(self, pid: int):
+        """
+        Folds an exited process's counters and histograms into dead.json so
+        totals never go backwards, and drops its gauges, which described
+        work that is no longer running. Called by the master only.
+        """
+        if not self.multiprocess_dir:
+            return
+        path = os.path.join(self.multiprocess_dir, f"{pid}.json")
+        dead_path = os.path.join(self.multiprocess_dir, "dead.json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return
+        try:
+            with open(dead_path, encoding="utf-8") as f:
+                dead = json.load(f)
+        except (OSError, ValueError):
+            dead = {}
+        for metric in self._metrics:
+            if metric.kind == "gauge":
+                continue
+            merged = metric.merge([dead.get(metric.name, []), snapshot.get(metric.name, [])])
+            dead[metric.name] = [[list(key), value] for key, value in merged.items()]
+        _write_json(dead_path, dead)
+        os.remove(path)
+
+
+def _write_json(path: str, data):
+    # Write then rename, so readers never see a partial file
+    staging = f"{path}.{os.getpid()}.tmp"
+    with open(staging, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(staging, path)
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_DURATION = Histogram("canvas_stage_duration_seconds", "Latency of each pipeline stage.", ["stage"])
+STAGE_TOTAL = Counter("canvas_stage_total", "Pipeline stage executions by outcome.", ["stage", "status"])
+STAGE_IN_FLIGHT = Gauge("canvas_stage_in_flight", "Pipeline stage executions currently running.", ["stage"])
+STAGE_BYTES = Counter("canvas_stage_bytes_total", "Bytes moved by upload and download stages.", ["stage"])
+
+LLM_TOKENS = Counter("canvas_llm_generated_tokens_total", "New tokens generated by the language model.")
+LLM_TOKENS_PER_SECOND = Histogram(
+    "canvas_llm_tokens_per_second", "Decode throughput of each generate call.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+CACHE_LOOKUPS = Counter("canvas_cache_lookups_total", "Cache lookups by cache and result.", ["cache", "result"])
+
+HTTP_DURATION = Histogram("canvas_http_request_duration_seconds", "Latency of HTTP requests.", ["endpoint", "method", "status"])
+HTTP_IN_FLIGHT = Gauge("canvas_http_requests_in_flight", "HTTP requests currently being served.", ["endpoint"])
+
+
+@contextmanager
+def track_stage(stage: str):
+    """Times a pipeline stage, tracks it as in flight and records it as a trace span."""
+    STAGE_IN_FLIGHT.inc(stage=stage)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        with span(stage):
+            yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - start, stage=stage)
+        STAGE_TOTAL.inc(stage=stage, status=status)
+        STAGE_IN_FLIGHT.dec(stage=stage)
+
+
+def timed(stage: str):
+    """Decorator form of track_stage."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with track_stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_bytes(stage: str, size: int):
+    STAGE_BYTES.inc(size, stage=stage)
+
+
+def record_tokens(new_tokens: int, seconds: float):
+    LLM_TOKENS.inc(new_tokens)
+    if seconds > 0 and new_tokens > 0:
+        LLM_TOKENS_PER_SECOND.observe(new_tokens / seconds)
+
+
+def record_cache(cache: str, hit: bool, count: int = 1):
+    if count:
+        CACHE_LOOKUPS.inc(count, cache=cache, result="hit" if hit else "miss")
@@ -0,0 +1,94 @@
+import os
+import subprocess
+from typing import Dict, List, Tuple
+
+import numpy as np
+from pydub import AudioSegment
+
+from app.utils.audioProcessor import PEAK_CEILING_DB, normalize_loudness
+from app.utils.metrics import track_stage
+
+# Overlap between consecutive sentences, faded equal-power
+NARRATION_CROSSFADE_MS = int(os.getenv("NARRATION_CROSSFADE_MS", "40"))
+# Silence added after every sentence before the crossfade
+NARRATION_PAUSE_MS = int(os.getenv("NARRATION_PAUSE_MS", "250"))
+NARRATION_BITRATE = os.getenv("NARRATION_BITRATE", "128k")
+
+
+def load_segment(path: str, rate: int = None) -> Tuple[np.ndarray, int]:
+    """Decodes an audio file (any format ffmpeg reads) to mono float32, resampled to rate if given."""
+    segment = AudioSegment.from_file(path).set_channels(1)
+    if rate and segment.frame_rate != rate:
+        segment = segment.set_frame_rate(rate)
+    samples = np.array(segment.get_array_of_samples(), dtype=np.float32) / (1 << (8 * segment.sample_width - 1))
+    return samples, segment.frame_rate
+
+
+def build_narration(segments: List[np.ndarray], rate: int, crossfade_ms: int = None,
+                    pause_ms: int = None) -> Tuple[np.ndarray, List[Dict]]:
+    """
+    Joins the per-sentence segments into one track: each is brought to the
+    same loudness, followed by pause_ms of silence and overlapped with the
+    next one by crossfade_ms.
+
+    Returns the track and, per sentence, its exact 'start' and 'end' (of
+    the speech) and 'slot_end' (where the next sentence starts), in seconds.
+    """
+    crossfade = int(rate * (NARRATION_CROSSFADE_MS if crossfade_ms is None else crossfade_ms) / 1000)
+    pause = np.zeros(int(rate * (NARRATION_PAUSE_MS if pause_ms is None else pause_ms) / 1000), dtype=np.float32)
+
+    parts = []
+    for i, samples in enumerate(segments):
+        samples = normalize_loudness(np.asarray(samples, dtype=np.float32), rate)
+        parts.append((len(samples), np.concatenate([samples, pause]) if i < len(segments) - 1 else samples))
+
+    # Start of every part, each overlapping the previous one by the crossfade,
+    # which is shortened when either part is shorter than it
+    starts, overlaps, position = [], [], 0
+    for i, (speech_length, part) in enumerate(parts):
+        overlap = min(crossfade, len(parts[i - 1][1]), len(part)) if i > 0 else 0
+        position -= overlap
+        starts.append(position)
+        overlaps.append(overlap)
+        position += len(part)
+    total = max((start + len(part) for (_, part), start in zip(parts, starts)), default=0)
+
+    track = np.zeros(total, dtype=np.float32)
+    for i, ((speech_length, part), start) in enumerate(zip(parts, starts)):
+        part = part.copy()
+        if overlaps[i]:
+            part[:overlaps[i]] *= _fade_in(overlaps[i])
+        if i + 1 < len(parts) and overlaps[i + 1]:
+            part[len(part) - overlaps[i + 1]:] *= 1 - _fade_in(overlaps[i + 1])
+        track[start:start + len(part)] += part
+
+    # The overlaps can add up above the ceiling
+    peak = np.max(np.abs(track)) if total else 0.0
+    ceiling = 10 ** (PEAK_CEILING_DB / 20)
+    if peak > ceiling:
+        track *= ceiling / peak
+
+    spans = []
+    for i, ((speech_length, part), start) in enumerate(zip(parts, starts)):
+        slot_end = starts[i + 1] if i + 1 < len(starts) else total
+        spans.append({"start": start / rate, "end": (start + speech_length) / rate, "slot_end": slot_end / rate})
+    return track, spans
+
+
+def _fade_in(length: int) -> np.ndarray:
+    """Equal-power fade-in curve; one minus it is the matching fade-out."""
+    return np.sin(np.linspace(0, np.pi / 2, length, dtype=np.float32)) ** 2
+
+
+def encode_narration(track: np.ndarray, rate: int, output_path: str, bitrate: str = None) -> str:
+    """Encodes the track to AAC (.m4a) by piping raw samples into ffmpeg."""
+    command = [
+        "ffmpeg", "-y",
+        "-f", "f32le", "-ar", str(rate), "-ac", "1",
+        "-i", "pipe:0",
+        "-c:a", "aac", "-b:a", bitrate or NARRATION_BITRATE,
+        output_path
+    ]
+    with track_stage("audio_encode"):
+        subprocess.run(command, input=track.astype("<f4").tobytes(), check=True, capture_output=True)
+    return output_path
@@ -0,0 +1,282 @@
+import contextvars
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import requests
+
+# Export finished traces: "" (keep in memory only), "json" (JSON lines file) or "otlp" (HTTP collector)
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+MAX_RECENT_TRACES = int(os.getenv("TRACE_KEEP", "200"))
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+_recent = OrderedDict()
+_recent_lock = threading.Lock()
+_export_lock = threading.Lock()
+# Optional shared store (save_trace, get_trace, get_recent_traces) used instead
+# of _recent, so every worker process can serve every trace
+_store = None
+
+
+class Span:
+    def __init__(self, name: str, parent_id: Optional[str], attributes: Dict):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.end = None
+        self.status = "ok"
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": round((self.end - self.start) * 1000, 2) if self.end else None,
+            "status": self.status,
+            "thread": self.thread,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    def __init__(self, request_id: str, name: str):
+        self.request_id = request_id
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.spans: List[Span] = []
+        self.profile = None
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            spans = [s.to_dict() for s in self.spans]
+        return {
+            "request_id": self.request_id,
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "spans": spans,
+            "profile": self.profile,
+        }
+
+
+def set_trace_store(store):
+    """Keeps finished traces in store (e.g. the app's DBInstance) instead of this process's memory."""
+    global _store
+    _store = store
+
+
+def current_request_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.request_id if trace else None
+
+
+def start_trace(name: str, request_id: Optional[str] = None):
+    """Starts a trace for the current request and opens its root span. Returns a token for finish_trace."""
+    trace = Trace(request_id or uuid.uuid4().hex, name)
+    root = Span(name, None, {"request_id": trace.request_id})
+    trace.add(root)
+    return trace, _current_trace.set(trace), _current_span.set(root)
+
+
+def finish_trace(handle, status: str = "ok", profile: Optional[str] = None):
+    """Closes the root span, stores the trace for /api/traces and exports it."""
+    trace, trace_token, span_token = handle
+    root = trace.spans[0]
+    root.end = time.time()
+    root.status = status
+    trace.profile = profile
+    try:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+    except ValueError:
+        # Streamed responses finish in a different context than they started in
+        _current_span.set(None)
+        _current_trace.set(None)
+
+    if _store is not None:
+        try:
+            _store.save_trace(trace.to_dict(), MAX_RECENT_TRACES)
+        except Exception as e:
+            print(f"Error storing trace {trace.request_id}: {e}")
+    else:
+        with _recent_lock:
+            _recent[trace.request_id] = trace
+            while len(_recent) > MAX_RECENT_TRACES:
+                _recent.popitem(last=False)
+
+    if TRACE_EXPORT:
+        threading.Thread(target=_export, args=(trace,), daemon=True).start()
+
+
+def get_trace(request_id: str) -> Optional[Dict]:
+    if _store is not None:
+        return _store.get_trace(request_id)
+    with _recent_lock:
+        trace = _recent.get(request_id)
+    return trace.to_dict() if trace else None
+
+
+def recent_traces() -> List[Dict]:
+    if _store is not None:
+        return _store.get_recent_traces(MAX_RECENT_TRACES)
+    with _recent_lock:
+        traces = list(_recent.values())
+    return [
+        {"request_id": t.request_id, "name": t.name, "duration_ms": t.spans[0].to_dict()["duration_ms"]}
+        for t in reversed(traces)
+    ]
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Records a nested span under the current one. A no-op outside a traced request."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+
+    parent = _current_span.get()
+    current = Span(name, parent.span_id if parent else None, attributes)
+    trace.add(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.attributes["error"] = str(e)
+        raise
+    finally:
+        current.end = time.time()
+        _current_span.reset(token)
+
+
+def traced(name: str):
+    """Decorator form of span."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def propagate(fn):
+    """Wraps fn so it runs in the caller's trace context when handed to another thread."""
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return wrapper
+
+
+def _export(trace: Trace):
+    try:
+        if TRACE_EXPORT == "json":
+            with _export_lock, open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(trace.to_dict()) + "\n")
+        elif TRACE_EXPORT == "otlp":
+            requests.post(TRACE_OTLP_ENDPOINT, json=_to_otlp(trace), timeout=5)
+    except Exception as e:
+        print(f"Error exporting trace {trace.request_id}: {e}")
+
+
+def _to_otlp(trace: Trace) -> Dict:
+    """Converts a trace to the OTLP/HTTP JSON payload."""
+    def attributes(values: Dict):
+        return [{"key": k, "value": {"stringValue": str(v)}} for k, v in values.items()]
+
+    spans = []
+    for s in list(trace.spans):
+        spans.append({
+            "traceId": trace.trace_id,
+            "spanId": s.span_id,
+            "parentSpanId": s.parent_id or "",
+            "name": s.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(s.start * 1e9)),
+            "endTimeUnixNano": str(int((s.end or time.time()) * 1e9)),
+            "attributes": attributes({**s.attributes, "thread": s.thread}),
+            "status": {"code": 2 if s.status == "error" else 1},
+        })
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": attributes({"service.name": "canvas-backend"})},
+            "scopeSpans": [{"scope": {"name": "app.utils.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+class RequestProfiler:
+    """
+    Profiles a single request. mode "cprofile" uses the deterministic
+    profiler on the request thread; mode "sample" samples the request
+    thread's stack every interval seconds and reports the hottest stacks.
+    """
+
+    def __init__(self, mode: str, interval: float = 0.005):
+        if mode not in ("cprofile", "sample"):
+            raise ValueError(f"Unknown profile mode '{mode}'. Use cprofile or sample")
+        self.mode = mode
+        self.interval = interval
+        self._profile = None
+        self._samples = Counter()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            thread_id = threading.get_ident()
+            self._sampler = threading.Thread(target=self._sample, args=(thread_id,), daemon=True)
+            self._sampler.start()
+
+    def _sample(self, thread_id: int):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            self._samples[";".join(f"{f.name} ({os.path.basename(f.filename)}:{f.lineno})" for f in stack)] += 1
+
+    def stop(self, limit: int = 40) -> str:
+        """Stops profiling and returns a text report."""
+        if self.mode == "cprofile":
+            self._profile.disable()
+            output = io.StringIO()
+            pstats.Stats(self._profile, stream=output).sort_stats("cumulative").print_stats(limit)
+            return output.getvalue()
+
+        self._stop.set()
+        self._sampler.join()
+        total = sum(self._samples.values())
+        lines = [f"{total} samples every {self.interval * 1000:.0f} ms (collapsed stacks, hottest first)"]
+        for stack, count in self._samples.most_common(limit):
+            lines.append(f"{count} {stack}")
+        return "\n".join(lines)
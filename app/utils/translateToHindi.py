@@ -34,43 +34,121 @@
 #     return ".".join(translated_chunks)
 
 import asyncio
-from googletrans import Translator
-from typing import Optional
+import os
+from typing import Dict, List, Optional
+from app.utils.translationCache import TranslationCache
+from app.utils.metrics import record_cache, track_stage
 
-async def translator(story: str) -> Optional[str]:
+# Maximum number of sentences in flight against the translation service
+MAX_CONCURRENT_TRANSLATIONS = int(os.getenv("TRANSLATOR_CONCURRENCY", "8"))
+
+_cache = None
+
+
+def get_translation_cache() -> TranslationCache:
+    global _cache
+    if _cache is None:
+        _cache = TranslationCache()
+    return _cache
+
+
+class GoogleTranslatorBackend:
+    """Translates sentences through the googletrans web API."""
+
+    def __init__(self):
+        from googletrans import Translator
+        self.translator = Translator()
+
+    async def translate(self, sentence: str, src: str, dest: str) -> str:
+        translation = await self.translator.translate(sentence, src=src, dest=dest)
+        return translation.text
+
+
+class LocalTranslatorBackend:
+    """
+    Offline stand-in for the translation service.
+
+    Returns the sentence tagged with the target language after an optional
+    simulated round trip, so the pipeline can be exercised without network access.
+    """
+
+    def __init__(self, latency: Optional[float] = None):
+        self.latency = latency if latency is not None else float(os.getenv("TRANSLATOR_LOCAL_LATENCY", "0"))
+
+    async def translate(self, sentence: str, src: str, dest: str) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return f"[{dest}] {sentence}"
+
+
+TRANSLATOR_BACKENDS = {
+    "google": GoogleTranslatorBackend,
+    "local": LocalTranslatorBackend,
+}
+
+
+def get_translator_backend(name: Optional[str] = None):
+    name = name or os.getenv("TRANSLATOR_BACKEND", "google")
+    if name not in TRANSLATOR_BACKENDS:
+        raise ValueError(f"Unknown translator backend '{name}'. Choose from {list(TRANSLATOR_BACKENDS)}")
+    return TRANSLATOR_BACKENDS[name]()
+
+
+async def _translate_missing(backend, sentences: List[str], src: str, dest: str) -> Dict[str, str]:
+    """Translates sentences concurrently, bounded by a semaphore."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_TRANSLATIONS)
+
+    async def translate_one(sentence):
+        async with semaphore:
+            try:
+                translated = await backend.translate(sentence, src, dest)
+                print(f"Og : {sentence}")
+                print(f"T : {translated}")
+                return sentence, translated
+            except Exception as e:
+                print(f"Error translating sentence '{sentence}': {str(e)}")
+                return sentence, None
+
+    results = await asyncio.gather(*(translate_one(s) for s in sentences))
+    return {sentence: translated for sentence, translated in results if translated}
+
+
+async def translator(story: str, src: str = 'en', dest: str = 'hi', backend=None) -> Optional[str]:
     try:
         # Input validation
         if not isinstance(story, str) or not story.strip():
             raise ValueError("Input must be a non-empty string")
-            
-        # Initialize translator
-        translator = Translator()
-        
+
         # Split the story into sentences
         sentences = [sent.strip() for sent in story.split('.') if sent.strip()]
-        
-        # Translate each sentence
-        translated_sentences = []
-        for sentence in sentences:
-            try:
-                # Properly await the translation
-                translation = await translator.translate(sentence, src='en', dest='hi')
-                translated_sentences.append(translation.text)
-                print(f"Og : {sentence}")
-                print(f"T : {translation.text}")
-            except Exception as e:
-                print(f"Error translating sentence '{sentence}': {str(e)}")
-                continue
-        
+
+        # Serve already translated sentences from the cache
+        cache = get_translation_cache()
+        translations = cache.get_many(sentences, src, dest)
+        missing = list(dict.fromkeys(s for s in sentences if s not in translations))
+        print(f"Translation cache: {len(set(sentences)) - len(missing)} hits, {len(missing)} misses")
+        record_cache("translation", hit=True, count=len(set(sentences)) - len(missing))
+        record_cache("translation", hit=False, count=len(missing))
+
+        if missing:
+            backend = backend or get_translator_backend()
+            with track_stage("translation"):
+                fresh = await _translate_missing(backend, missing, src, dest)
+            cache.put_many(fresh, src, dest)
+            translations.update(fresh)
+
+        # Keep the original sentence order, skipping sentences that failed
+        translated_sentences = [translations[s] for s in sentences if s in translations]
+
         # If no sentences were translated successfully
         if not translated_sentences:
             return None
-            
+
         # Join the translated sentences
         translated_story = '. '.join(translated_sentences) + '.'
-        
+
         return translated_story
-        
+
     except Exception as e:
         print(f"An error occurred: {str(e)}")
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,79 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+
+class TranslationCache:
+    """
+    Persistent sentence-level translation cache backed by SQLite.
+
+    Entries are keyed by (source language, target language, sha256 of the
+    sentence) so the same story translated by the audio and the video step
+    is only sent to the translation service once.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or os.getenv("TRANSLATION_CACHE_DB", "translations.db")
+        self._lock = threading.Lock()
+        self.create_table()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @staticmethod
+    def sentence_hash(sentence: str) -> str:
+        return hashlib.sha256(sentence.strip().encode("utf-8")).hexdigest()
+
+    def create_table(self):
+        """Creates the translations table if it doesn't exist."""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS translations (
+                    source TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    sentence_hash TEXT NOT NULL,
+                    translation TEXT NOT NULL,
+                    PRIMARY KEY (source, target, sentence_hash)
+                )
+                """
+            )
+
+    def get_many(self, sentences: List[str], source: str, target: str) -> Dict[str, str]:
+        """Returns a {sentence: translation} dict for every cached sentence."""
+        hashes = {self.sentence_hash(s): s for s in sentences}
+        if not hashes:
+            return {}
+
+        found = {}
+        keys = list(hashes)
+        with self._lock, self._connect() as conn:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" for _ in batch)
+                rows = conn.execute(
+                    "SELECT sentence_hash, translation FROM translations "
+                    f"WHERE source = ? AND target = ? AND sentence_hash IN ({placeholders})",
+                    [source, target, *batch],
+                ).fetchall()
+                for sentence_hash, translation in rows:
+                    found[hashes[sentence_hash]] = translation
+        return found
+
+    def put_many(self, translations: Dict[str, str], source: str, target: str):
+        """Stores {sentence: translation} pairs in a single transaction."""
+        if not translations:
+            return
+        rows = [
+            (source, target, self.sentence_hash(sentence), translation)
+            for sentence, translation in translations.items()
+        ]
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO translations (source, target, sentence_hash, translation) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
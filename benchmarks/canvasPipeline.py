@@ -0,0 +1,230 @@
+"""
+Runs every API route under concurrent load against stub or tiny models
+and local stand-ins for Pinecone, Cloudinary and the translator, so the
+whole pipeline can be benchmarked offline and compared between runs.
+
+For each scenario reports request latency percentiles, throughput and
+peak RSS, and per pipeline stage (taken from the request traces) the
+latency percentiles and the peak RSS seen while that stage was running.
+
+    python -m benchmarks.canvasPipeline --requests 20 --concurrency 4
+    python -m benchmarks.canvasPipeline --scenarios newScript prompts --script-model ./tiny-phi --output bench.json
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import psutil
+
+# Must be set before the app modules read them
+os.environ.setdefault("TRANSLATOR_BACKEND", "local")
+if "TRANSLATION_CACHE_DB" not in os.environ:
+    # Start every run with a cold translation cache
+    os.environ["TRANSLATION_CACHE_DB"] = os.path.join(tempfile.mkdtemp(prefix="canvas-bench-"), "translations.db")
+os.environ.setdefault("MODEL_PRELOAD", "1")
+
+from benchmarks.stubs import (  # noqa: E402
+    STORY_SENTENCES,
+    LocalObjectStore,
+    StubScriptGenModel,
+    install_fake_cloudinary,
+    make_context_model,
+    make_image_model,
+    make_tts_model,
+)
+
+STORY = '. '.join(STORY_SENTENCES) + '.'
+
+# name -> (path, JSON body); genVideo's body is filled in from the image and audio scenarios
+SCENARIOS = {
+    "newScript": ("/api/newScript", {"topic": "Ashoka the Great#Historical"}),
+    "newScriptStream": ("/api/newScript", {"topic": "Ashoka the Great#Historical", "stream": True}),
+    "prompts": ("/api/prompts", {"story": STORY + "#Cinematic"}),
+    "genImage": ("/api/genImage", {
+        "prompts": [f"A painting of {s.lower()}" for s in STORY_SENTENCES],
+        "width": 512, "height": 288, "inference_steps": 2, "guidance_scale": 0.0,
+    }),
+    "genImagePreview": ("/api/genImage", {
+        "prompts": [f"A painting of {s.lower()}" for s in STORY_SENTENCES],
+        "width": 512, "height": 288, "inference_steps": 2, "guidance_scale": 0.0, "preview": True,
+    }),
+    # Every request after the first finds its images in the library
+    "genImageReuse": ("/api/genImage", {
+        "prompts": [f"A painting of {s.lower()}" for s in STORY_SENTENCES],
+        "width": 512, "height": 288, "inference_steps": 2, "guidance_scale": 0.0, "reuse": True,
+    }),
+    "genAudio": ("/api/genAudio", {"texts": STORY, "url": None, "lang": "en"}),
+    "genAudioHindi": ("/api/genAudio", {"texts": STORY, "url": None, "lang": "hi"}),
+    "genVideo": ("/api/genVideo", None),
+}
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+    return {
+        "p50_ms": round(rank(50) * 1000, 2),
+        "p90_ms": round(rank(90) * 1000, 2),
+        "p99_ms": round(rank(99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+class RSSSampler:
+    """Samples the process RSS in the background so peaks can be matched to stage spans."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        process = psutil.Process()
+        while not self._stop.is_set():
+            self.samples.append((time.time(), process.memory_info().rss))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def peak_mb(self, windows=None) -> float:
+        rss = [r for t, r in self.samples if windows is None or any(s <= t <= e for s, e in windows)]
+        return round(max(rss) / (1024 * 1024), 1) if rss else None
+
+
+def run_scenario(app, path: str, body: dict, requests: int, concurrency: int) -> Dict:
+    """Fires `requests` POSTs at `concurrency` and summarises latencies and trace stages."""
+    from app.utils.tracing import get_trace
+
+    def call(_):
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.post(path, json=body)
+        response.get_data()
+        response.close()
+        latency = time.perf_counter() - start
+        return latency, response.status_code, get_trace(response.headers.get("X-Request-ID", ""))
+
+    with RSSSampler() as sampler:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(call, range(requests)))
+        wall = time.perf_counter() - start
+
+    stage_durations = defaultdict(list)
+    stage_windows = defaultdict(list)
+    for _, _, trace in results:
+        for span in (trace or {}).get("spans", [])[1:]:
+            if span["duration_ms"] is None:
+                continue
+            stage_durations[span["name"]].append(span["duration_ms"] / 1000)
+            stage_windows[span["name"]].append((span["start"], span["start"] + span["duration_ms"] / 1000))
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": sum(1 for _, status, _ in results if status >= 400),
+        "wall_seconds": round(wall, 2),
+        "throughput_rps": round(requests / wall, 2),
+        "latency": _percentiles([latency for latency, _, _ in results]),
+        "peak_rss_mb": sampler.peak_mb(),
+        "stages": {
+            name: {
+                "count": len(durations),
+                **_percentiles(durations),
+                "peak_rss_mb": sampler.peak_mb(stage_windows[name]),
+            }
+            for name, durations in sorted(stage_durations.items())
+        },
+    }
+
+
+def build_app(script_model: str, latency_scale: float):
+    from app import create_app
+    from app.database.db import DBInstance
+
+    def load_script_model():
+        if script_model == "stub":
+            return StubScriptGenModel(seconds_per_token=0.002 * latency_scale)
+        # A small causal LM (e.g. a local tiny checkpoint) through the real generator
+        from app.models.phi2textgen import Phi2Generator
+        return Phi2Generator(model_name=script_model)
+
+    return create_app(models={
+        "ScriptGenModel": load_script_model,
+        # Second handles on the app's topics.db, for the image library and the keyword index
+        "ImageGenModel": lambda: make_image_model(seconds_per_step=0.05 * latency_scale, db=DBInstance()),
+        "contextModel": lambda: make_context_model(db=DBInstance()),
+        "TTSModel": lambda: make_tts_model(seconds_per_char=0.002 * latency_scale),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=20, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--script-model", default="stub", help="'stub' or a causal LM name/path for Phi2Generator")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplies the stub model latencies")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    store = LocalObjectStore()
+    install_fake_cloudinary(store)
+    workdir = tempfile.mkdtemp(prefix="canvas-bench-run-")
+    cwd = os.getcwd()
+    try:
+        # Relative paths used by the app (temp files, topics.db) land in a scratch directory
+        os.chdir(workdir)
+        app = build_app(args.script_model, args.latency_scale)
+
+        report = {
+            "script_model": args.script_model,
+            "latency_scale": args.latency_scale,
+            "scenarios": {},
+        }
+        for name in args.scenarios:
+            path, body = SCENARIOS[name]
+            if name == "genVideo":
+                if shutil.which("ffmpeg") is None:
+                    print("Skipping genVideo: ffmpeg is not installed")
+                    continue
+                # Reuse one set of generated assets for every video request
+                client = app.test_client()
+                image_urls = client.post(SCENARIOS["genImage"][0], json=SCENARIOS["genImage"][1]).get_json()
+                audio_urls = client.post(SCENARIOS["genAudio"][0], json=SCENARIOS["genAudio"][1]).get_json()
+                body = {"story": STORY, "image_urls": image_urls, "audio_urls": audio_urls, "caption_lang": "en"}
+
+            print(f"Running {name} ({args.requests} requests, concurrency {args.concurrency})")
+            report["scenarios"][name] = run_scenario(app, path, body, args.requests, args.concurrency)
+
+        print(json.dumps(report, indent=4))
+        if args.output:
+            with open(os.path.join(cwd, args.output), "w") as f:
+                json.dump(report, f, indent=4)
+    finally:
+        os.chdir(cwd)
+        store.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Measures aggregate decode throughput of concurrent requests with and
+without the continuous-batching GenerationScheduler.
+
+    python -m benchmarks.phi2Batching --concurrency 8 --new-tokens 128
+    python -m benchmarks.phi2Batching --model microsoft/phi-2 --output bench_output.txt
+"""
+import argparse
+import json
+import threading
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from app.models.generationScheduler import GenerationScheduler
+
+PROMPTS = [
+    "Provide a historical account of the Maurya Empire.",
+    "Write an inspiring biography of Marie Curie.",
+    "Write a cinematic narration of the first Moon landing.",
+    "Provide a historical account of the Silk Road trade routes and the cities along them.",
+]
+
+
+def run_concurrently(generate_fn, tokenizer, concurrency: int, new_tokens: int) -> dict:
+    """Fires `concurrency` requests at once and reports aggregate tokens/sec."""
+    latencies = [0.0] * concurrency
+    generated = [0] * concurrency
+
+    def worker(i):
+        encoded = tokenizer(PROMPTS[i % len(PROMPTS)], return_tensors="pt")
+        start = time.perf_counter()
+        outputs = generate_fn(
+            input_ids=encoded["input_ids"],
+            attention_mask=encoded["attention_mask"],
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=True,
+            temperature=0.9,
+            top_k=40,
+            top_p=0.92,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+        latencies[i] = time.perf_counter() - start
+        generated[i] = outputs.shape[1] - encoded["input_ids"].shape[1]
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    return {
+        "requests": concurrency,
+        "wall_seconds": round(wall, 2),
+        "aggregate_tokens_per_sec": round(sum(generated) / wall, 2),
+        "mean_latency_seconds": round(sum(latencies) / concurrency, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="microsoft/phi-2")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--new-tokens", type=int, default=128)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32).eval()
+
+    # Serial baseline: the model can only run one generate() at a time
+    lock = threading.Lock()
+
+    def serial_generate(**kwargs):
+        with lock:
+            return model.generate(**kwargs)
+
+    scheduler = GenerationScheduler(model, pad_token_id=tokenizer.pad_token_id, max_batch_size=args.concurrency)
+
+    report = {
+        "model": args.model,
+        "new_tokens": args.new_tokens,
+        "serial": run_concurrently(serial_generate, tokenizer, args.concurrency, args.new_tokens),
+        "batched": run_concurrently(scheduler.generate, tokenizer, args.concurrency, args.new_tokens),
+    }
+    report["speedup"] = round(
+        report["batched"]["aggregate_tokens_per_sec"] / report["serial"]["aggregate_tokens_per_sec"], 2
+    )
+    print(json.dumps(report, indent=4))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
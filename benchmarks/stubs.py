@@ -0,0 +1,286 @@
+"""
+Stub models and local stand-ins for the external services, so the whole
+app can be benchmarked offline without model weights or API keys.
+
+The script model is stubbed as a whole. The image and TTS models are the
+real classes with only the diffusion pipeline and speech synthesizer
+replaced by fakes that sleep for a configurable latency, so encoding,
+caching and uploads run the production code. Uploads are redirected to
+a LocalObjectStore by install_fake_cloudinary.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict, List
+
+import numpy as np
+
+STORY_SENTENCES = [
+    "Ashoka was born into the Maurya dynasty in the third century BCE",
+    "He grew up as a fierce prince who led armies across northern India",
+    "After the bloody war in Kalinga he was filled with deep remorse",
+    "He embraced Buddhism and spread its message of peace across his empire",
+    "Edicts carved on pillars and rocks carried his words to every province",
+    "His lion capital still stands today as the national emblem of India",
+]
+
+
+class LocalObjectStore:
+    """Serves uploaded files over HTTP from a temporary directory, standing in for Cloudinary."""
+
+    def __init__(self, root: str = None):
+        self.root = root or tempfile.mkdtemp(prefix="canvas-objects-")
+        handler = partial(_QuietHandler, directory=self.root)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, name="object-store", daemon=True)
+        self.thread.start()
+
+    def put(self, file) -> str:
+        """Stores a file path or a named file-like object, as Cloudinary accepts both."""
+        source = getattr(file, "name", file)
+        name = f"{uuid.uuid4().hex}{os.path.splitext(str(source))[1]}"
+        if hasattr(file, "read"):
+            with open(os.path.join(self.root, name), "wb") as f:
+                f.write(file.read())
+        else:
+            shutil.copyfile(file, os.path.join(self.root, name))
+        return f"{self.base_url}/{name}"
+
+    def close(self):
+        self.server.shutdown()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def install_fake_cloudinary(store: LocalObjectStore, latency: float = 0.05):
+    """Redirects cloudinary.uploader.upload/destroy to the local object store."""
+    import cloudinary.uploader
+
+    def upload(file, **kwargs):
+        time.sleep(latency)
+        return {"secure_url": store.put(file)}
+
+    def destroy(public_id, **kwargs):
+        return {"result": "ok"}
+
+    cloudinary.uploader.upload = upload
+    cloudinary.uploader.destroy = destroy
+
+
+class FakePineconeIndex:
+    """In-memory stand-in for a Pinecone index with cosine similarity search."""
+
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.vectors: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors: List[Dict]):
+        with self._lock:
+            for vector in vectors:
+                self.vectors[vector["id"]] = vector
+        return {"upserted_count": len(vectors)}
+
+    def query(self, vector, top_k: int = 10, include_metadata: bool = True, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            items = list(self.vectors.values())
+        if not items:
+            return {"matches": []}
+
+        matrix = np.array([item["values"] for item in items], dtype=np.float32)
+        query = np.asarray(vector, dtype=np.float32)
+        scores = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-9)
+        matches = []
+        for row in np.argsort(-scores)[:top_k]:
+            match = {"id": items[row]["id"], "score": float(scores[row])}
+            if include_metadata:
+                match["metadata"] = items[row].get("metadata", {})
+            matches.append(match)
+        return {"matches": matches}
+
+    def fetch(self, ids: List[str], **kwargs):
+        with self._lock:
+            return {"vectors": {i: self.vectors[i] for i in ids if i in self.vectors}}
+
+
+class HashingEncoder:
+    """Deterministic bag-of-words embeddings with the SentenceTransformer encode() signature."""
+
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dimension] += 1
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def encode(self, sentences, convert_to_tensor: bool = False, **kwargs):
+        single = isinstance(sentences, str)
+        embeddings = np.stack([self._embed(s) for s in ([sentences] if single else sentences)])
+        if convert_to_tensor:
+            import torch
+            embeddings = torch.from_numpy(embeddings)
+        return embeddings[0] if single else embeddings
+
+
+def make_context_model(db=None, index: FakePineconeIndex = None, documents: List[str] = None):
+    """
+    Builds a real ContextRetriever wired to a fake index and a hashing
+    encoder. Passing the app's DBInstance enables hybrid keyword retrieval.
+    """
+    import pinecone
+    from app.models import contextRetrival
+    from app.models.contextRetrival import ContextRetriever
+
+    fake_index = index or FakePineconeIndex()
+
+    class FakePinecone:
+        def __init__(self, api_key=None):
+            pass
+
+        def list_indexes(self):
+            return type("Indexes", (), {"names": lambda _: ["benchmark"]})()
+
+        def Index(self, name):
+            return fake_index
+
+    real_pinecone, real_transformer = pinecone.Pinecone, contextRetrival.SentenceTransformer
+    os.environ.setdefault("PINECONE_API_KEY", "benchmark")
+    os.environ.setdefault("PINECONE_INDEX_NAME", "benchmark")
+    pinecone.Pinecone, contextRetrival.SentenceTransformer = FakePinecone, lambda name: HashingEncoder()
+    try:
+        retriever = ContextRetriever(db=db)
+    finally:
+        pinecone.Pinecone, contextRetrival.SentenceTransformer = real_pinecone, real_transformer
+
+    # Seed the vector and keyword indexes with chunks of the sample documents
+    for doc_index, document in enumerate(documents or [". ".join(STORY_SENTENCES) + "."]):
+        filename = f"doc{doc_index}"
+        chunks = [
+            {
+                "id": f"{filename}_{i}",
+                "values": retriever.model.encode(chunk).tolist(),
+                "metadata": {"text": chunk, "filename": filename, "chunk_index": i},
+            }
+            for i, chunk in enumerate(retriever._create_chunks(document))
+        ]
+        retriever.index.upsert(vectors=chunks)
+        if db is not None:
+            db.index_chunks(filename, [{"id": c["id"], "text": c["metadata"]["text"]} for c in chunks])
+    return retriever
+
+
+class StubScriptGenModel:
+    """Stands in for Phi2Generator, sleeping per generated token instead of decoding."""
+
+    def __init__(self, seconds_per_token: float = 0.002, story_tokens: int = 150, prompt_tokens: int = 30):
+        self.seconds_per_token = seconds_per_token
+        self.story_tokens = story_tokens
+        self.prompt_tokens = prompt_tokens
+
+    def _decode(self, tokens: int):
+        time.sleep(tokens * self.seconds_per_token)
+
+    def generate_with_custom_instructions(self, context: str, query: str, style_guide: str = "Historical", **kwargs):
+        self._decode(self.story_tokens)
+        return {'generated_text': '. '.join(STORY_SENTENCES) + '.'}
+
+    def stream_with_custom_instructions(self, context: str, query: str, style_guide: str = "Historical", **kwargs):
+        words = ('. '.join(STORY_SENTENCES) + '.').split()
+        per_word = self.story_tokens * self.seconds_per_token / len(words)
+        for word in words:
+            time.sleep(per_word)
+            yield {'token': word + ' '}
+        yield {'done': True, 'generated_text': ' '.join(words)}
+
+    def _prompt(self, sentence: str, style_guide: str) -> str:
+        return (f"A detailed painting of {sentence.strip().rstrip('.').lower()}, "
+                f"dramatic lighting, wide shot, rich colours, {style_guide}")
+
+    def generate_concise_image_prompts(self, story: str, style_guide: str = "cinematic, 8k", **kwargs) -> List[str]:
+        sentences = [s.strip() for s in story.split('.') if s.strip()]
+        self._decode(self.prompt_tokens * len(sentences))
+        return [self._prompt(s, style_guide) for s in sentences]
+
+    def generate_image_prompt_candidates(self, sentence: str, style_guide: str = "cinematic, 8k",
+                                         num_candidates: int = 4, **kwargs) -> List[str]:
+        # Candidates share one batched decode, as in Phi2Generator
+        self._decode(self.prompt_tokens)
+        return [self._prompt(sentence, style_guide) for _ in range(num_candidates)]
+
+    def get_speculative_stats(self) -> Dict[str, float]:
+        return {}
+
+
+class FakeDiffusionPipeline:
+    """
+    Stands in for the SDXL pipeline inside the real ImageGenerator: sleeps
+    per step, scaled by the pixel count, and returns a flat image coloured
+    by the prompt and starting noise. Encoding, the image library and
+    uploads run the real code.
+    """
+
+    def __init__(self, seconds_per_step: float = 0.05):
+        self.seconds_per_step = seconds_per_step
+
+    def __call__(self, prompt: str, width: int, height: int, num_inference_steps: int,
+                 guidance_scale: float = 0.0, latents=None, **kwargs):
+        from PIL import Image
+
+        # Diffusion cost grows with the pixel count; 1024x576 is the reference size
+        time.sleep(num_inference_steps * self.seconds_per_step * width * height / (1024 * 576))
+        noise = float(latents.sum()) if latents is not None else 0.0
+        rgb = bytes.fromhex(hashlib.md5(f"{prompt}:{noise:.4f}".encode()).hexdigest()[:6])
+        return SimpleNamespace(images=[Image.new("RGB", (width, height), tuple(rgb))])
+
+
+class FakeTTS:
+    """
+    Stands in for the Coqui model inside the real HuggingFaceTTS: returns a
+    tone per sentence after a per-character delay, so post-processing,
+    encoding, the TTS cache and uploads run the real code.
+    """
+
+    def __init__(self, seconds_per_char: float = 0.002, sample_rate: int = 24000):
+        self.seconds_per_char = seconds_per_char
+        self.synthesizer = SimpleNamespace(output_sample_rate=sample_rate)
+
+    def tts(self, text: str, language: str = None, speaker_wav: str = None, **kwargs) -> np.ndarray:
+        time.sleep(len(text) * self.seconds_per_char)
+        # Roughly 14 characters of speech per second
+        return _tone(max(len(text) / 14, 0.5), self.synthesizer.output_sample_rate)
+
+
+def make_image_model(seconds_per_step: float = 0.05, db=None):
+    """Builds a real ImageGenerator around a FakeDiffusionPipeline, with hashing embeddings for its library."""
+    from app.models.sdxlImageGen import ImageGenerator
+    return ImageGenerator(db=db, pipeline=FakeDiffusionPipeline(seconds_per_step), encoder=HashingEncoder())
+
+
+def make_tts_model(seconds_per_char: float = 0.002):
+    """Builds a real HuggingFaceTTS around a FakeTTS."""
+    from app.models.TTS import HuggingFaceTTS
+    return HuggingFaceTTS(tts=FakeTTS(seconds_per_char))
+
+
+def _tone(seconds: float, sample_rate: int) -> np.ndarray:
+    """A 220 Hz tone over light noise, with the leading and trailing silence TTS models tend to leave."""
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    pad = np.zeros(int(0.3 * sample_rate), dtype=np.float32)
+    tone = (0.2 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+    samples = np.concatenate([pad, tone, pad])
+    return samples + np.random.default_rng(0).normal(0, 0.0005, len(samples)).astype(np.float32)
@@ -0,0 +1,209 @@
+# serve.py
+"""
+Production entry point: loads and warms up the models once in a master
+process, then forks WORKERS processes that serve a shared listening
+socket with THREADS request threads each. Forked workers share the
+model weights copy-on-write instead of loading their own copies. Each
+worker's torch ops use TORCH_THREADS threads (by default the cores
+divided among the workers), so the workers do not oversubscribe the CPU.
+
+    WORKERS=2 THREADS=4 TORCH_THREADS=4 PORT=5000 python serve.py
+
+SIGTERM or SIGINT stops the workers gracefully: each one reports not
+ready on /ready, stops accepting connections and finishes in-flight
+requests (up to GRACEFUL_TIMEOUT seconds) before exiting. Workers that
+die unexpectedly are restarted.
+
+/metrics and /api/traces answer the same from every worker: workers write
+their metric values to METRICS_MULTIPROC_DIR (a temporary directory by
+default) where a scrape merges them, and finished traces are stored in
+the shared database.
+"""
+import gc
+import logging
+import os
+import glob
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from app import create_app
+from app.utils.metrics import REGISTRY as METRICS
+from app.utils.tracing import set_trace_store
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("serve")
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "5000"))
+# Every forward pass is already multi-threaded, so a few workers are enough to overlap requests
+WORKERS = int(os.getenv("WORKERS", str(min(4, max(1, (os.cpu_count() or 2) // 4)))))
+THREADS = int(os.getenv("THREADS", "4"))
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", str(max(1, (os.cpu_count() or 2) // WORKERS))))
+GRACEFUL_TIMEOUT = float(os.getenv("GRACEFUL_TIMEOUT", "30"))
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", "")
+
+
+class RequestHandler(WSGIRequestHandler):
+    # One request per connection so idle keep-alive clients do not hold pool threads
+    protocol_version = "HTTP/1.0"
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """WSGI server that handles requests on a fixed-size thread pool."""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads: int, fd: int):
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="request")
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def run_worker(app, listener: socket.socket):
+    import torch
+    # Intra-op threads are per process; split the cores between the workers
+    torch.set_num_threads(TORCH_THREADS)
+
+    # The master's values are already in its own file
+    METRICS.reset()
+    METRICS.start_flusher()
+
+    registry = app.config['ModelRegistry']
+    registry.after_fork()
+    registry.start_idle_reaper()
+
+    server = ThreadPoolWSGIServer(HOST, PORT, app, threads=THREADS, fd=listener.fileno())
+
+    def stop(signum, frame):
+        app.config['READY'] = False
+        # shutdown() blocks until serve_forever returns, so it cannot run on this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    app.config['READY'] = True
+    logger.info(f"Worker {os.getpid()} serving with {THREADS} threads")
+    server.serve_forever()
+    # Let in-flight requests finish before closing the socket
+    server.executor.shutdown(wait=True)
+    server.server_close()
+    METRICS.flush()
+    logger.info(f"Worker {os.getpid()} stopped")
+
+
+def spawn_worker(app, listener: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(app, listener)
+        except Exception as e:
+            logger.error(f"Worker {os.getpid()} failed: {str(e)}")
+            code = 1
+        finally:
+            # Skip the master's atexit handlers and finalizers
+            os._exit(code)
+    return pid
+
+
+def main():
+    app = create_app(start_reaper=False)
+    app.config['READY'] = False
+
+    start = time.perf_counter()
+    app.config['ModelRegistry'].warm_up()
+    logger.info(f"Models loaded and warmed up in {time.perf_counter() - start:.1f}s")
+
+    # Shared by the workers so any of them can answer /metrics and /api/traces
+    metrics_dir = METRICS_MULTIPROC_DIR or tempfile.mkdtemp(prefix="canvas-metrics-")
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        os.remove(path)
+    METRICS.multiprocess_dir = metrics_dir
+    METRICS.flush()
+    set_trace_store(app.config['DB'])
+
+    listener = socket.create_server((HOST, PORT), backlog=2048)
+    listener.set_inheritable(True)
+
+    # Move everything loaded so far out of the collector's reach, otherwise
+    # collections in the workers touch every object and un-share their pages
+    gc.collect()
+    gc.freeze()
+
+    workers = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(WORKERS):
+        pid = spawn_worker(app, listener)
+        workers[pid] = time.monotonic()
+    logger.info(
+        f"Master {os.getpid()} listening on {HOST}:{PORT} with {WORKERS} workers, "
+        f"{TORCH_THREADS} torch threads each"
+    )
+
+    deadline = None
+    while workers:
+        if stopping and deadline is None:
+            deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        if deadline is not None and time.monotonic() > deadline:
+            logger.warning(f"Killing {len(workers)} workers after {GRACEFUL_TIMEOUT:.0f}s")
+            for pid in workers:
+                os.kill(pid, signal.SIGKILL)
+            deadline = float("inf")
+
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        started = workers.pop(pid, None)
+        METRICS.mark_process_dead(pid)
+        if stopping or started is None:
+            continue
+
+        logger.warning(f"Worker {pid} exited with status {status}, restarting")
+        # Avoid a tight restart loop when workers crash on startup
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        workers[spawn_worker(app, listener)] = time.monotonic()
+
+    listener.close()
+    if not METRICS_MULTIPROC_DIR:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    logger.info("All workers stopped")
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+import torch
+from transformers import PhiConfig, PhiForCausalLM
+
+from app.models.generationScheduler import GenerationScheduler
+
+VOCAB_SIZE = 64
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = PhiConfig(
+        vocab_size=VOCAB_SIZE, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, max_position_embeddings=256, eos_token_id=0, pad_token_id=0, bos_token_id=0,
+    )
+    return PhiForCausalLM(config).eval()
+
+
+@pytest.fixture
+def scheduler(model):
+    scheduler = GenerationScheduler(model, pad_token_id=0, max_batch_size=4)
+    yield scheduler
+    scheduler.close()
+
+
+def _run_all(scheduler, prompts, max_new_tokens):
+    """Calls scheduler.generate for every prompt from its own thread; returns outputs or raised errors."""
+    results = [None] * len(prompts)
+
+    def run(i):
+        try:
+            results[i] = scheduler.generate(
+                torch.tensor([prompts[i]]), max_new_tokens=max_new_tokens, do_sample=False, eos_token_id=None
+            )[0]
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(len(prompts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+        assert not thread.is_alive(), "generate() did not return"
+    return results
+
+
+def test_matches_model_generate(model, scheduler):
+    prompts = [[5, 6, 7], [8, 9], [10, 11, 12, 13, 14, 15]]
+    results = _run_all(scheduler, prompts, max_new_tokens=12)
+    for prompt, result in zip(prompts, results):
+        expected = model.generate(
+            torch.tensor([prompt]), max_new_tokens=12, do_sample=False, pad_token_id=0, eos_token_id=None
+        )[0]
+        assert torch.equal(result, expected)
+
+
+def test_failed_prefill_only_fails_its_request(model, scheduler):
+    # An out-of-vocab id makes the prefill raise
+    prompts = [[5, 6, 7], [VOCAB_SIZE + 100, 3], [8, 9], [10, 11, 12, 13]]
+    results = _run_all(scheduler, prompts, max_new_tokens=12)
+
+    assert isinstance(results[1], Exception)
+    for i in (0, 2, 3):
+        expected = model.generate(
+            torch.tensor([prompts[i]]), max_new_tokens=12, do_sample=False, pad_token_id=0, eos_token_id=None
+        )[0]
+        assert torch.equal(results[i], expected)
+
+
+def test_padding_is_trimmed_when_long_rows_retire(model):
+    scheduler = GenerationScheduler(model, pad_token_id=0)
+    # Drive the steps from the test instead of the decode thread
+    scheduler.close()
+    scheduler.thread.join(timeout=10)
+
+    short = scheduler._build_request(torch.tensor([5, 6]), {"max_new_tokens": 6, "eos_token_id": None})
+    long = scheduler._build_request(torch.arange(1, 41), {"max_new_tokens": 1, "eos_token_id": None})
+    with torch.inference_mode():
+        scheduler._admit(short)
+        scheduler._admit(long)
+        assert scheduler.attention_mask.shape[1] == 40
+
+        # The long request retires after one token and its padding goes with it
+        scheduler._step()
+        assert scheduler.attention_mask.shape[1] == 3
+        assert all(k.shape[2] == 3 and v.shape[2] == 3 for k, v in scheduler.past)
+
+        while scheduler.active:
+            scheduler._step()
+
+    expected = model.generate(
+        torch.tensor([[5, 6]]), max_new_tokens=6, do_sample=False, pad_token_id=0, eos_token_id=None
+    )[0]
+    assert torch.equal(short.future.result(timeout=1), expected)
+    assert long.future.result(timeout=1).shape[0] == 41
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from app.utils.narration import build_narration
+
+RATE = 24000
+
+
+def _tone(samples: int) -> np.ndarray:
+    return (0.2 * np.sin(2 * np.pi * 220 * np.arange(samples) / RATE)).astype(np.float32)
+
+
+def test_spans_follow_pauses_and_crossfades():
+    track, spans = build_narration([_tone(24000), _tone(12000)], RATE, crossfade_ms=40, pause_ms=250)
+
+    # 250 ms of pause after the first sentence, of which the 40 ms crossfade overlaps the second
+    assert spans[0] == {"start": 0.0, "end": 1.0, "slot_end": pytest.approx(1.21)}
+    assert spans[1]["start"] == pytest.approx(1.21)
+    assert spans[1]["end"] == pytest.approx(1.71)
+    assert len(track) == int(round(1.71 * RATE))
+    assert np.max(np.abs(track)) <= 10 ** (-1 / 20) + 1e-6
+
+
+@pytest.mark.parametrize("last_length", [0, 1, 100, 959])
+def test_segments_shorter_than_the_crossfade(last_length):
+    # 40 ms at 24 kHz is a 960-sample crossfade
+    segments = [_tone(24000), _tone(12000), _tone(last_length)]
+    track, spans = build_narration(segments, RATE, crossfade_ms=40, pause_ms=250)
+
+    assert len(spans) == 3
+    assert all(span["start"] <= span["end"] <= span["slot_end"] for span in spans)
+    assert spans[-1]["end"] - spans[-1]["start"] == pytest.approx(last_length / RATE)
+    assert spans[-1]["slot_end"] == pytest.approx(len(track) / RATE)
+    assert np.all(np.isfinite(track))
+
+
+def test_no_segments():
+    track, spans = build_narration([], RATE)
+    assert len(track) == 0 and spans == []